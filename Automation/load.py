@@ -26,7 +26,6 @@ import pprint
 import operator
 import datetime
 import pynliner
-from multiprocessing.pool import ThreadPool
 
 from mako.template import Template
 from mako.lookup import TemplateLookup
@@ -34,36 +33,16 @@ from mako import exceptions
 
 import load_sender
 import psi_ops
+import psi_ops_fleet
+import psi_host_load_store
+
+# A host that hasn't answered the load check in this long is reported as
+# unreachable rather than holding up the report
+HOST_LOAD_CHECK_DEADLINE_SECONDS = 180
 
 def check_load_on_host(host):
     try:
         log_diagnostics('checking host: %s' % (host.id))
-        users = g_psinet._PsiphonNetwork__count_users_on_host(host.id)
-
-        load_commands = ['uptime | cut -d , -f 4 | cut -d : -f 2',
-                         'grep "model name" /proc/cpuinfo | wc -l',
-                         'free | grep "Mem" | awk \'{print $7/$2 * 100.0}\'',
-                         'free | grep "buffers/cache" | awk \'{print $4/($3+$4) * 100.0}\'',
-                         'free | grep "Swap" | awk \'{if ($2 == 0) {print 0} else {print $4/$2 * 100.0}}\'',
-                         'df -T / | grep "/" | awk \'{if ($4 == 0) {print 0} else {print $4/$3 * 100.0}}\'']
-        load_metrics = g_psinet.run_command_on_host(host, '; '.join(load_commands)).strip().split('\n')
-        if host.is_TCS or host.is_inproxy:
-            load_threshold = float(load_metrics[1].strip())
-        else:
-            load_threshold = 4.0 * float(load_metrics[1].strip()) - 1
-        load = str(float(load_metrics[0].strip())/load_threshold * 100.0)
-        if len(load_metrics) == 5:
-            # New versions of "free" do not include the "buffers/cache" line, that command had no output
-            free = load_metrics[2]
-            free_swap = load_metrics[3]
-            disk_load = load_metrics[4]
-        elif len(load_metrics) == 6:
-            # Skip the calculation based on the "Mem" line
-            free = load_metrics[3]
-            free_swap = load_metrics[4]
-            disk_load = load_metrics[5]
-        else:
-            raise Exception("Unexpected number of load metrics")
 
         processes_to_check = ['cron', 'rsyslogd', 'fail2ban-server', 'ntpd', 'systemctl', 'filebeat']
         inproxy_processes = ['cron', 'fail2ban-server', 'psiphon-inproxy']
@@ -81,12 +60,31 @@ def check_load_on_host(host):
             if len(vpn_servers) > 0:
                 processes_to_check.append('xl2tpd')
 
-        process_counts = g_psinet.run_command_on_host(host,
-            '; '.join(['pgrep -xc ' + process for process in processes_to_check])).split('\n')
+        if host.is_TCS:
+            geoip_filename, geoip_max_age_days = '/usr/local/share/GeoIP/GeoIP2-City.mmdb', 14
+        elif host.is_inproxy:
+            geoip_filename, geoip_max_age_days = None, None
+        else:
+            geoip_filename, geoip_max_age_days = '/usr/local/share/GeoIP/GeoIPCity.dat', None
+
+        # One remote command collects everything checked below
+        probe = g_psinet.probe_host(host, True, processes_to_check, geoip_filename, geoip_max_age_days)
+
+        users = g_psinet._PsiphonNetwork__count_users_in_host_probe(host, probe)
+
+        if host.is_TCS or host.is_inproxy:
+            load_threshold = float(probe['cpu_count'])
+        else:
+            load_threshold = 4.0 * float(probe['cpu_count']) - 1
+        load = str(probe['load_average']/load_threshold * 100.0)
+        free = '%g' % (probe['memory_free_percent'],)
+        free_swap = '%g' % (probe['swap_free_percent'],)
+        disk_load = '%g' % (probe['disk_used_percent'],)
+
         process_alerts = []
-        for index, process in enumerate(processes_to_check):
+        for process in processes_to_check:
             alert = False
-            instances = int(process_counts[index])
+            instances = probe['process_counts'][process]
             if process == 'cron':
                 alert = instances < 1
             elif process == 'xl2tpd':
@@ -102,43 +100,46 @@ def check_load_on_host(host):
             if alert:
                 process_alerts.append(process)
 
-        if host.is_TCS:
-            geoip_freshness_check = 'find /usr/local/share/GeoIP/GeoIP2-City.mmdb -mtime -14'
-        elif host.is_inproxy:
-            geoip_freshness_check = None
-        else:
-            geoip_freshness_check = 'find /usr/local/share/GeoIP/GeoIPCity.dat'
-
-        if geoip_freshness_check:
-            fresh_geoip_db = g_psinet.run_command_on_host(host, geoip_freshness_check)
-            if fresh_geoip_db == '':
+        if geoip_filename:
+            if not probe['geoip_fresh']:
                 process_alerts.append('geoip_db')
 
         if host.is_TCS:
-            if not g_psinet._PsiphonNetwork__check_host_is_accepting_tunnels(host.id):
+            if not (probe['psiphond_load'] and probe['psiphond_load']['establish_tunnels']):
                 process_alerts.append('closed')
 
-        return (host.id, users, load, free.rstrip(), free_swap.rstrip(), disk_load.rstrip(), ', '.join(process_alerts))
+        return (host.id, users, load, free, free_swap, disk_load, ', '.join(process_alerts))
     except Exception as e:
         log_diagnostics('failed host: %s %s' % (host.id, str(e)))
         return (host.id, -1, -1, -1, -1, -1, '')
 
+def check_load_on_hosts_in_parallel(hosts):
+    results = psi_ops_fleet.run_on_fleet(
+        check_load_on_host,
+        hosts,
+        concurrency=100,
+        deadline_seconds=HOST_LOAD_CHECK_DEADLINE_SECONDS)
+    for result in results:
+        if not result.succeeded:
+            log_diagnostics('failed host: %s %s' % (result.item.id, str(result.exception)))
+    return [result.value if result.succeeded else (result.item.id, -1, -1, -1, -1, -1, '')
+            for result in results]
+
 # TODO: print if server is discovery or propagation etc
 def check_load_on_hosts(psinet, hosts):
     loads = {}
 
-    pool = ThreadPool(100)
     global g_psinet
     g_psinet = psinet
     log_diagnostics('Checking Hosts...')
-    results = pool.map(check_load_on_host, hosts)
+    results = check_load_on_hosts_in_parallel(hosts)
     log_diagnostics('...done checking hosts')
 
     # retry failed hosts
     failed_hosts = [psinet._PsiphonNetwork__hosts[result[0]] for result in results if result[1] == -1 or result[6]]
     if len(failed_hosts):
         log_diagnostics('Retrying failed hosts')
-    new_results = pool.map(check_load_on_host, failed_hosts)
+    new_results = check_load_on_hosts_in_parallel(failed_hosts)
 
     for result in results + new_results:
         loads[result[0]] = result[1:]
@@ -178,11 +179,14 @@ def log_load():
     start_time = datetime.datetime.now()
     results = check_load()
     end_time = datetime.datetime.now()
+    store = psi_host_load_store.HostLoadStore(LOAD_STORE_DIR)
+    if os.path.exists(FILENAME):
+        # Bring the legacy history into the store before the first new run
+        import_load_results_log(store)
+        os.rename(FILENAME, FILENAME + '.imported')
+    store.append(end_time, results[3])
     results = (str(start_time), str(end_time), (results))
     print("Run completed at: %s\nTotal run time: %s" % (str(end_time), str(end_time-start_time)))
-    with open('psi_host_load_results.log', 'a') as outfile:
-        outfile.write(str(results))
-        outfile.write('\n')
     send_mail(results)
 
 def log_diagnostics(line):
@@ -217,74 +221,141 @@ def send_mail(record):
     log_diagnostics('Email sent.')
 
 
+# Legacy load history, one str(tuple) per run; imported into the store once
 FILENAME = 'psi_host_load_results.log'
+LOAD_STORE_DIR = 'psi_host_load_store'
+# Raw samples are kept this long; reports keep hourly averages indefinitely
+LOAD_STORE_RETENTION_DAYS = 90
 REPORTS_DIRNAME = 'host_reports'
 REPORTS_DIR = REPORTS_DIRNAME
-STAGING_DIR = os.path.join(REPORTS_DIR, 'staging')
 DATA_DIRNAME = 'data'
-DATA_DIR = os.path.join(STAGING_DIR, DATA_DIRNAME)
+DATA_DIR = os.path.join(REPORTS_DIR, DATA_DIRNAME)
 REPORT_EXT = '.dat'
 FRESH_AGE = datetime.timedelta(2)
 REPORT_LIST_FILENAME = 'data.json'
-REPORT_LIST_FILEPATH = os.path.join(STAGING_DIR, REPORT_LIST_FILENAME)
-
-def dump_host_reports(fresh_hosts_only=True):
-    # Note: this routine keeps a file handle open per host; adjust ulimits accordlingly
-
-    # Delete any leftover file
-    shutil.rmtree(STAGING_DIR, ignore_errors=True)
-    _makedirs(STAGING_DIR)
-    _makedirs(DATA_DIR)
-
-    # Like { hostname: [host_fp, host_fname, max_date], ... }
-    host_files = {}
-
-    with open(FILENAME, 'r') as f:
+REPORT_STATE_FILENAME = 'report_state.json'
+REPORT_INTERVAL_SECONDS = 3600
+
+def _parse_run_time(value):
+    # Run times are str(datetime), which omits the microseconds when zero
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+def import_load_results_log(store, filename=FILENAME):
+    # The import can be rerun after being interrupted: runs no later than the
+    # last one already stored for their day are skipped
+    last_timestamps = {}
+    with open(filename, 'r') as f:
         for line in f:
             data = ast.literal_eval(line)
-            start_time = data[0]
             end_time = data[1]
             loads = data[2]
-            if len(loads) != 3:
+            # Runs are recorded as (total_users, nonresponding_hosts, host_loads)
+            # or, since unreachable hosts were counted separately, as
+            # (total_users, total_hosts, unreachable_hosts, host_loads)
+            if len(loads) not in (3, 4):
                 # old format, skip
                 continue
-            total_users = loads[0]
-            nonresponding_hosts = loads[1]
-            host_loads = loads[2]
-            for host_load in host_loads:
-                hostname =  host_load[0]
-                host_load = host_load[1][0]
-                if not hostname in host_files:
-                    fname = os.path.join(DATA_DIR, hostname + REPORT_EXT)
-                    host_files[hostname] = [open(fname, 'w'), fname, None]
-
-                host_file = host_files[hostname]
-                host_file[0].write('%s,%s\n' % (end_time.replace(' ', 'T'), host_load))
-                host_file[2] = max(end_time, host_file[2])
-            # print end_time
+            host_loads = [(host_id, (tuple(host_load) + (-1, -1, -1, -1, ''))[:6])
+                          for host_id, host_load in loads[-1]]
+            time = _parse_run_time(end_time)
+            timestamp = psi_host_load_store.datetime_to_timestamp(time)
+            day = time.strftime(psi_host_load_store.DAY_FORMAT)
+            if day not in last_timestamps:
+                row_count = store.row_count(day)
+                last_timestamps[day] = None
+                if row_count > 0:
+                    last_timestamps[day] = store.read(day, row_count - 1, ('time',))[1]['time'][-1]
+            if last_timestamps[day] is not None and timestamp <= last_timestamps[day]:
+                continue
+            store.append(time, host_loads)
+            last_timestamps[day] = timestamp
+
+def _write_json_atomically(filename, value):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(value, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+def dump_host_reports(fresh_hosts_only=True):
+    # Reports are updated incrementally: only rows added to the load store
+    # since the last run are read, and each host's data file is appended with
+    # the hourly average user counts completed by those rows. The average for
+    # a host's latest hour is held in the report state until a later sample
+    # completes it.
+
+    store = psi_host_load_store.HostLoadStore(LOAD_STORE_DIR)
+    state_filename = os.path.join(REPORTS_DIR, REPORT_STATE_FILENAME)
+
+    if os.path.exists(state_filename):
+        with open(state_filename) as f:
+            state = json.load(f)
+    else:
+        # First run: rebuild the data files from the complete history
+        shutil.rmtree(DATA_DIR, ignore_errors=True)
+        state = {'rows': {}, 'hosts': {}}
+    _makedirs(DATA_DIR)
+
+    # Like { hostname: [(interval_start, mean_users), ...] }
+    completed_intervals = {}
+
+    for day in store.days():
+        start_row = state['rows'].get(day, 0)
+        hosts, columns = store.read(day, start_row)
+        for timestamp, host_index, users in zip(columns['time'], columns['host'], columns['users']):
+            hostname = hosts[host_index]
+            interval = timestamp - timestamp % REPORT_INTERVAL_SECONDS
+            host_state = state['hosts'].get(hostname)
+            if host_state is not None and interval < host_state['interval']:
+                # Already reported
+                continue
+            if host_state is None or interval > host_state['interval']:
+                # An interval in which every check failed has no average
+                if host_state is not None and host_state['count'] > 0:
+                    completed_intervals.setdefault(hostname, []).append(
+                        (host_state['interval'], host_state['sum'] / host_state['count']))
+                host_state = {'interval': interval, 'sum': 0, 'count': 0, 'failures': 0}
+                state['hosts'][hostname] = host_state
+            host_state['last_seen'] = timestamp
+            if users < 0:
+                # Failed checks are stored with -1 users
+                host_state['failures'] = host_state.get('failures', 0) + 1
+                continue
+            host_state['sum'] += users
+            host_state['count'] += 1
+        state['rows'][day] = start_row + len(columns['time'])
+
+    for hostname, intervals in completed_intervals.items():
+        with open(os.path.join(DATA_DIR, hostname + REPORT_EXT), 'a') as host_file:
+            for interval, mean_users in intervals:
+                host_file.write('%s,%g\n' % (
+                    psi_host_load_store.timestamp_to_datetime(interval).isoformat(), mean_users))
 
     # Collect data file info to put into the JSON index file
     data_files = []
+    fresh_after = psi_host_load_store.datetime_to_timestamp(datetime.datetime.now() - FRESH_AGE)
 
-    for host_file in host_files.values():
-        host_file[0].close()
-        if fresh_hosts_only and datetime.datetime.strptime(host_file[2], '%Y-%m-%d %H:%M:%S.%f') + FRESH_AGE < datetime.datetime.now():
+    for hostname, host_state in sorted(state['hosts'].items()):
+        fname = hostname + REPORT_EXT
+        if fresh_hosts_only and host_state['last_seen'] < fresh_after:
             # Defunct. Delete.
-            os.unlink(host_file[1])
-        else:
-            fname = os.path.basename(host_file[1])
-            hostname = os.path.splitext(fname)[0]
+            if os.path.exists(os.path.join(DATA_DIR, fname)):
+                os.unlink(os.path.join(DATA_DIR, fname))
+            del state['hosts'][hostname]
+        elif os.path.exists(os.path.join(DATA_DIR, fname)):
             data_files.append((hostname, './'+DATA_DIRNAME+'/'+fname))
 
+    # Raw samples past the retention period are no longer needed once
+    # they're in the reports
+    store.prune(LOAD_STORE_RETENTION_DAYS)
+    days = store.days()
+    for day in list(state['rows'].keys()):
+        if day not in days:
+            del state['rows'][day]
+
     # Dump the file list to a JSON index file.
-    with open(REPORT_LIST_FILEPATH, 'w') as listfile:
-        json.dump(data_files, listfile, indent=2)
-
-    # Move from staging to the final location
-    os.unlink(os.path.join(REPORTS_DIR, REPORT_LIST_FILENAME))
-    shutil.move(REPORT_LIST_FILEPATH, os.path.join(REPORTS_DIR, REPORT_LIST_FILENAME))
-    shutil.rmtree(os.path.join(REPORTS_DIR, DATA_DIRNAME))
-    shutil.move(DATA_DIR, os.path.join(REPORTS_DIR, DATA_DIRNAME))
+    _write_json_atomically(os.path.join(REPORTS_DIR, REPORT_LIST_FILENAME), data_files)
+    _write_json_atomically(state_filename, state)
 
 
 def _makedirs(path):
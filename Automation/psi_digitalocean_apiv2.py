@@ -121,7 +121,7 @@ def upgrade_debian_distro(digitalocean_account, ip_address, old_version, new_ver
         ssh.exec_command('apt-get update && apt-get autoremove -y -f')
         ssh.exec_command('shutdown -r now')
     finally:
-        ssh.close()
+        ssh.close(discard=True)
 
 
 def update_kernel(digitalocean_account, do_mgr, droplet):
@@ -151,7 +151,8 @@ def update_kernel(digitalocean_account, do_mgr, droplet):
                     current_kernel_name = line.split(': ')[1].split('+')[0]
                     break
     finally:
-        ssh.close()
+        # The droplet may be power cycled below, so don't pool the connection
+        ssh.close(discard=True)
 
     if not current_kernel_name:
         raise Exception('Current Kernel version is not found')
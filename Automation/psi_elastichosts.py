@@ -215,7 +215,7 @@ class ElasticHosts(object):
         '''
         ssh = psi_ssh.make_ssh_session(*ssh_info, verbose=self._verbose) 
         ssh.exec_command('reboot')
-        ssh.close()
+        ssh.close(discard=True)
         
         # Try to connect again, retrying. When it succeeds, the reboot will be done.
         
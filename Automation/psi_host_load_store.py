@@ -0,0 +1,210 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2024, Psiphon Inc.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Append-only columnar store for host load samples.
+
+Samples are partitioned by day. Each day's directory holds one binary file
+per column, so appending a load check run writes a few hundred bytes per
+column, and readers load only the columns and rows they need:
+
+    <root>/<YYYY-MM-DD>/time       uint32, seconds since the epoch
+    <root>/<YYYY-MM-DD>/host       uint32, index into hosts
+    <root>/<YYYY-MM-DD>/users      int32
+    <root>/<YYYY-MM-DD>/load       float32
+    <root>/<YYYY-MM-DD>/memory     float32, percent free
+    <root>/<YYYY-MM-DD>/swap       float32, percent free
+    <root>/<YYYY-MM-DD>/disk       float32, percent used
+    <root>/<YYYY-MM-DD>/hosts      host IDs, one per line; the host index
+    <root>/<YYYY-MM-DD>/alerts     "<row>\\t<alerts>" lines, for rows with alerts
+
+Columns are appended one after the other, so after an interrupted append
+some may be longer than others; readers use the shortest length, and the next
+append first truncates every column, and the alerts, to that length. Host IDs
+are written before the rows that refer to them, and alerts only once all the
+columns are written.
+"""
+
+import array
+import calendar
+import datetime
+import os
+import shutil
+
+
+COLUMNS = [
+    ('time', 'I'),
+    ('host', 'I'),
+    ('users', 'i'),
+    ('load', 'f'),
+    ('memory', 'f'),
+    ('swap', 'f'),
+    ('disk', 'f'),
+]
+
+DAY_FORMAT = '%Y-%m-%d'
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return -1.0
+
+
+def datetime_to_timestamp(value):
+    # Load check times are naive local datetimes; they're stored as if UTC
+    # so that they convert back to the same wall-clock time
+    return calendar.timegm(value.timetuple())
+
+
+def timestamp_to_datetime(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+class HostLoadStore(object):
+
+    def __init__(self, root):
+        self.root = root
+
+    def __day_dir(self, day):
+        return os.path.join(self.root, day)
+
+    def days(self):
+        if not os.path.isdir(self.root):
+            return []
+        days = []
+        for name in os.listdir(self.root):
+            try:
+                datetime.datetime.strptime(name, DAY_FORMAT)
+            except ValueError:
+                continue
+            days.append(name)
+        return sorted(days)
+
+    def __read_hosts(self, day):
+        filename = os.path.join(self.__day_dir(day), 'hosts')
+        if not os.path.exists(filename):
+            return []
+        with open(filename) as f:
+            return f.read().splitlines()
+
+    def __truncate(self, day, row_count):
+        # Discards whatever an interrupted append wrote past row_count
+        day_dir = self.__day_dir(day)
+        for name, typecode in COLUMNS:
+            filename = os.path.join(day_dir, name)
+            size = row_count * array.array(typecode).itemsize
+            if os.path.exists(filename) and os.path.getsize(filename) > size:
+                with open(filename, 'r+b') as f:
+                    f.truncate(size)
+        filename = os.path.join(day_dir, 'alerts')
+        if os.path.exists(filename):
+            with open(filename) as f:
+                lines = f.readlines()
+            kept = [line for line in lines
+                    if line.endswith('\n') and int(line.split('\t', 1)[0]) < row_count]
+            if len(kept) < len(lines):
+                with open(filename + '.tmp', 'w') as f:
+                    f.write(''.join(kept))
+                os.replace(filename + '.tmp', filename)
+
+    def append(self, time, host_loads):
+        '''
+        Appends one load check run. time is a datetime and host_loads is a list
+        of (host_id, (users, load, memory_free, swap_free, disk_used, alerts)),
+        as produced by load.check_load_on_hosts.
+        '''
+        day = time.strftime(DAY_FORMAT)
+        day_dir = self.__day_dir(day)
+        if not os.path.isdir(day_dir):
+            os.makedirs(day_dir)
+
+        hosts = self.__read_hosts(day)
+        host_indexes = dict((host_id, index) for index, host_id in enumerate(hosts))
+        new_hosts = []
+
+        row = self.row_count(day)
+        self.__truncate(day, row)
+        timestamp = datetime_to_timestamp(time)
+        columns = dict((name, array.array(typecode)) for name, typecode in COLUMNS)
+        alerts = []
+        for host_id, (users, load, memory, swap, disk, host_alerts) in host_loads:
+            if host_id not in host_indexes:
+                host_indexes[host_id] = len(host_indexes)
+                new_hosts.append(host_id)
+            columns['time'].append(timestamp)
+            columns['host'].append(host_indexes[host_id])
+            columns['users'].append(int(users))
+            columns['load'].append(_to_float(load))
+            columns['memory'].append(_to_float(memory))
+            columns['swap'].append(_to_float(swap))
+            columns['disk'].append(_to_float(disk))
+            if host_alerts:
+                alerts.append('%d\t%s\n' % (row, host_alerts))
+            row += 1
+
+        # Host IDs are written before the rows that refer to them; one left
+        # unreferenced by an interrupted append is reused by the next. Alerts
+        # are written last, so they only ever refer to complete rows.
+        if new_hosts:
+            with open(os.path.join(day_dir, 'hosts'), 'a') as f:
+                f.write(''.join(host_id + '\n' for host_id in new_hosts))
+        for name, _ in COLUMNS:
+            with open(os.path.join(day_dir, name), 'ab') as f:
+                columns[name].tofile(f)
+        if alerts:
+            with open(os.path.join(day_dir, 'alerts'), 'a') as f:
+                f.write(''.join(alerts))
+
+    def row_count(self, day):
+        day_dir = self.__day_dir(day)
+        counts = []
+        for name, typecode in COLUMNS:
+            filename = os.path.join(day_dir, name)
+            size = os.path.getsize(filename) if os.path.exists(filename) else 0
+            counts.append(size // array.array(typecode).itemsize)
+        return min(counts)
+
+    def read(self, day, start_row=0, columns=('time', 'host', 'users')):
+        '''
+        Returns (hosts, {column: array}) for the rows of day from start_row on.
+        hosts maps the host column's indexes to host IDs.
+        '''
+        day_dir = self.__day_dir(day)
+        end_row = self.row_count(day)
+        typecodes = dict(COLUMNS)
+        values = {}
+        for name in columns:
+            column = array.array(typecodes[name])
+            if end_row > start_row:
+                with open(os.path.join(day_dir, name), 'rb') as f:
+                    f.seek(start_row * column.itemsize)
+                    column.fromfile(f, end_row - start_row)
+            values[name] = column
+        return self.__read_hosts(day), values
+
+    def prune(self, keep_days, now=None):
+        # Removes day partitions older than keep_days
+        if now is None:
+            now = datetime.datetime.now()
+        oldest = (now - datetime.timedelta(days=keep_days)).strftime(DAY_FORMAT)
+        for day in self.days():
+            if day < oldest:
+                shutil.rmtree(self.__day_dir(day), ignore_errors=True)
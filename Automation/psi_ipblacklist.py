@@ -19,6 +19,7 @@
 
 import os
 import re
+import socket
 import subprocess
 import sys
 
@@ -32,7 +33,6 @@ try:
 except ImportError as error:
     print(error)
 
-EXECUTABLE = 0o744
 BASE_PATH = '/usr/local/share/PsiphonV'
 BLACKLIST_DIR = 'malware_blacklist'
 IPSET_DIR = os.path.abspath(os.path.join(BASE_PATH, BLACKLIST_DIR, 'ipset'))
@@ -40,6 +40,13 @@ LIST_DIR = os.path.abspath(os.path.join(BASE_PATH, BLACKLIST_DIR, 'lists'))
 
 LISTS_URL = 'https://s3.amazonaws.com/p3_malware_lists/'
 
+IPSET_TYPE = 'hash:ip'
+IPSET_MIN_MAXELEM = 65536
+IPSET_MAX_NAME_LENGTH = 31
+# A live set is updated in place when the changes are at most this fraction
+# of the list; otherwise a new set is loaded and swapped in
+IPSET_MAX_DIFF_FRACTION = 0.5
+
 
 def build_malware_dictionary(url):
     """Build a dict containing malware lists."""
@@ -78,9 +85,24 @@ def update_list(tracker):
         sys.exit()
 
 
+def normalize_ip(entry):
+    """Return the canonical form of an IPv4 address or network, or None."""
+    address, _, prefix = entry.partition('/')
+    try:
+        address = socket.inet_ntop(socket.AF_INET, socket.inet_pton(socket.AF_INET, address))
+    except (socket.error, ValueError):
+        return None
+    if not prefix or prefix == '32':
+        return address
+    if not prefix.isdigit() or int(prefix) > 32:
+        return None
+    return '%s/%d' % (address, int(prefix))
+
+
 def parse_ip_list(raw_list_filename, read_mode):
     """Iterate through each list item to create an ipset file."""
     blackhole_list = []
+    invalid_count = 0
     with open(os.path.join(LIST_DIR, raw_list_filename), read_mode) as f:
         for line in f:
             if re.search(r"(^#)", line):  # find comments
@@ -88,33 +110,95 @@ def parse_ip_list(raw_list_filename, read_mode):
             elif not line.strip():  # remove blank lines
                 next
             else:
-                blackhole_list.append(line.strip())
+                # ipset restore stops at the first bad entry, so they're
+                # dropped here
+                ip = normalize_ip(line.strip())
+                if ip:
+                    blackhole_list.append(ip)
+                else:
+                    invalid_count += 1
+    if invalid_count:
+        print('Skipped %d invalid entries in %s' % (invalid_count, raw_list_filename))
     return list(set(blackhole_list))
 
 
-# Create the ipset script which includes creating the set name and blocklist
-# which is stored in a file for execution
-def create_ipset_commands(tracker):
-    """Create the ipset name and add elements of the list."""
-    ipset_base = ["ipset -N %s iphash" % str(tracker['set_name'])]
-    tracker['ipset_rules'] = ipset_base + \
-        ["ipset -q -A %s %s" % (str(tracker['set_name']), str(ip)) for ip in tracker['ip_list']]
+def get_live_ipset(set_name):
+    """Return (members, maxelem) of the loaded set, or (None, None)."""
+    proc = subprocess.Popen(['ipset', 'save', set_name],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        return None, None
+    members = set()
+    maxelem = IPSET_MIN_MAXELEM
+    for line in stdout.decode().split('\n'):
+        fields = line.split()
+        if fields[:1] == ['add']:
+            members.add(fields[2])
+        elif fields[:1] == ['create'] and 'maxelem' in fields:
+            maxelem = int(fields[fields.index('maxelem') + 1])
+    return members, maxelem
+
+
+# Create the ipset restore commands, which either update the live set with
+# the changes or load the whole list into a temporary set and swap it in
+def create_ipset_commands(tracker, live_members, live_maxelem):
+    """Create the ipset restore commands for the list."""
+    set_name = str(tracker['set_name'])
+    ip_list = tracker['ip_list']
+    tracker['ipset_temp_set_name'] = None
+
+    # A network added to a hash:ip set is saved as its addresses, so lists
+    # with networks can't be compared with the live set
+    if (live_members is not None and len(ip_list) <= live_maxelem and
+            not any('/' in ip for ip in ip_list)):
+        wanted = set(ip_list)
+        additions = wanted - live_members
+        deletions = live_members - wanted
+        if len(additions) + len(deletions) <= IPSET_MAX_DIFF_FRACTION * max(len(wanted), 1):
+            tracker['ipset_rules'] = \
+                ['add %s %s' % (set_name, ip) for ip in sorted(additions)] + \
+                ['del %s %s' % (set_name, ip) for ip in sorted(deletions)]
+            return
+
+    maxelem = max(IPSET_MIN_MAXELEM, 2 * len(ip_list))
+    temp_set_name = ('tmp-' + set_name)[:IPSET_MAX_NAME_LENGTH]
+    tracker['ipset_temp_set_name'] = temp_set_name
+    rules = ['create %s %s maxelem %d' % (temp_set_name, IPSET_TYPE, maxelem)]
+    rules += ['add %s %s' % (temp_set_name, ip) for ip in ip_list]
+    if live_members is None:
+        rules.append('create %s %s maxelem %d' % (set_name, IPSET_TYPE, maxelem))
+    rules += ['swap %s %s' % (temp_set_name, set_name),
+              'destroy %s' % (temp_set_name,)]
+    tracker['ipset_rules'] = rules
 
 
 def write_ipset_list_file(tracker):
-    """Create an .ipset file for loading the list into iptables."""
-    script = os.path.join(IPSET_DIR, tracker['ipset_file'])
+    """Create an .ipset file, in ipset restore format, with the whole list."""
+    set_name = str(tracker['set_name'])
+    filename = os.path.join(IPSET_DIR, tracker['ipset_file'])
     subprocess.call(['mkdir', '-p', IPSET_DIR])
-    with open(script, 'w') as f:
-        for rule in tracker['ipset_rules']:
-            f.write('%s\n' % rule)
-    os.chmod(script, EXECUTABLE)  # Make the file world readable.
+    with open(filename, 'w') as f:
+        f.write('create %s %s maxelem %d\n' % (
+            set_name, IPSET_TYPE, max(IPSET_MIN_MAXELEM, 2 * len(tracker['ip_list']))))
+        for ip in tracker['ip_list']:
+            f.write('add %s %s\n' % (set_name, ip))
 
 
 def apply_ipset_list(tracker):
-    """Run the .ipset file which creates the list to be used by iptables."""
-    script = os.path.join(IPSET_DIR, tracker['ipset_file'])
-    subprocess.call(script, shell=True)
+    """Load the ipset restore commands with a single ipset call."""
+    if not tracker['ipset_rules']:
+        return
+    if tracker['ipset_temp_set_name']:
+        # Left over from an interrupted update
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['ipset', 'destroy', tracker['ipset_temp_set_name']], stderr=devnull)
+    proc = subprocess.Popen(['ipset', '-exist', 'restore'], stdin=subprocess.PIPE)
+    proc.communicate(''.join('%s\n' % rule for rule in tracker['ipset_rules']).encode())
+    if proc.returncode != 0:
+        # The iptables rules would reference a missing or partial set
+        print('Failed to load ipset %s' % tracker['set_name'])
+        sys.exit(1)
 
 
 def get_iptables_chain(chain):
@@ -125,19 +209,27 @@ def get_iptables_chain(chain):
     return stdout
 
 
-def modify_iptables_insert_tracker(tracker, chain, rules):
+def get_iptables_insert_tracker_rule(tracker, chain, rules, flags="dst", job='-j DROP'):
     """
         Check if the tracker already exists in the iptables rules.  Don't add
         if it already exists as it creates duplicate entries
     """
-    add_tracker = True
     for line in rules.decode().split('\n'):
         if tracker['set_name'] in line:       # return if we see the tracker
-            add_tracker = False
-            break
+            return None
     
-    if add_tracker:
-        modify_iptables(tracker, '-I', chain)
+    return "-I %s -m set --match-set %s %s %s" % (chain, tracker['set_name'], flags, job)
+
+
+def apply_iptables_rules(rules):
+    """Add the rules to the filter table with a single iptables-restore."""
+    if not rules:
+        return
+    proc = subprocess.Popen(['iptables-restore', '--noflush'], stdin=subprocess.PIPE)
+    proc.communicate(('*filter\n' + ''.join('%s\n' % rule for rule in rules) + 'COMMIT\n').encode())
+    if proc.returncode != 0:
+        print('Failed to add the iptables rules')
+        sys.exit(1)
 
 
 def modify_iptables(tracker, opt, chain, flags="dst", job='-j DROP'):
@@ -159,16 +251,22 @@ if __name__ == "__main__":
         iptables_chains[chain] = get_iptables_chain(chain)
     
     if mal_lists:
+        iptables_rules = []
         # lists to use:
         for item in mal_lists:
             update_list(mal_lists[item])
             mal_lists[item]['ip_list'] = parse_ip_list(mal_lists[item]['rawlist'], 'r')
-            create_ipset_commands(mal_lists[item])
+            live_members, live_maxelem = get_live_ipset(mal_lists[item]['set_name'])
+            create_ipset_commands(mal_lists[item], live_members, live_maxelem)
             write_ipset_list_file(mal_lists[item])
             apply_ipset_list(mal_lists[item])
             
             for chain in iptables_chains:
-                modify_iptables_insert_tracker(mal_lists[item], chain, iptables_chains[chain])
+                rule = get_iptables_insert_tracker_rule(mal_lists[item], chain, iptables_chains[chain])
+                if rule:
+                    iptables_rules.append(rule)
+        
+        apply_iptables_rules(iptables_rules)
             
     else:
         print('Malware list is empty, exiting')
@@ -51,6 +51,7 @@ from builtins import input
 import psi_utils
 import psi_ops_cms
 import psi_ops_discovery
+import psi_ops_host_probe
 
 # Import library based on version
 try:
@@ -168,6 +169,11 @@ try:
 except ImportError as error:
     print(error)
 
+try:
+    import psi_ops_fleet
+except ImportError as error:
+    print(error)
+
 try:
     import psi_ops_build_windows
 except ImportError as error:
@@ -216,6 +222,15 @@ except ImportError as error:
 
 WEBSITE_GENERATION_DIR = './website-out'
 
+# paver output, by a hash of its inputs, so that OSLs are only repaved when
+# the OSL config, the paving server list or the OSL time period changes
+OSL_PAVE_CACHE_DIR = './osl-pave-cache'
+OSL_PAVE_CACHE_ENTRIES = 4
+# Records the paving last written to each bucket
+OSL_PAVE_UPLOADS_FILENAME = 'uploaded.json'
+# OSLs are paved from this long before now, unless pave_OSLs is given an offset
+OSL_PAVE_DEFAULT_OFFSET = '2880h' # 120 days
+
 
 EMAIL_RESPONDER_CONFIG_BUCKET_KEY = 'EmailResponder/conf.json'
 
@@ -263,7 +278,7 @@ SponsorHomePage = psi_utils.recordtype(
 SponsorCampaign = psi_utils.recordtype(
     'SponsorCampaign',
     'propagation_channel_id, propagation_mechanism_type, account, ' +
-    's3_bucket_name, alternate_s3_bucket_name, languages, platforms, custom_download_site')
+    's3_bucket_name, alternate_s3_bucket_name, languages, platforms, custom_download_site, id')
 
 SponsorRegex = psi_utils.recordtype(
     'SponsorRegex',
@@ -329,6 +344,60 @@ def copy_server_capabilities(caps):
     return capabilities
 
 
+def parse_go_duration(duration):
+    # Parses the durations taken by paver, like "2880h" or "1h30m"
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 1e-3, 'us': 1e-6, 'ns': 1e-9}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(h|ms|us|ns|m|s)', duration)
+    if not parts or ''.join(number + unit for number, unit in parts) != duration:
+        raise ValueError('invalid duration: %s' % (duration,))
+    return datetime.timedelta(seconds=sum(float(number) * units[unit] for number, unit in parts))
+
+
+def get_OSL_paving_window(osl_config, now, offset=None, period=None):
+    # paver output covers whole OSL time periods, from the period containing
+    # now - offset to the period containing the end of the paving, which is
+    # now or, with a paving period, the start plus that period. The output
+    # only changes when either end (UTC) moves into a new period. Returns the
+    # start and end periods of each scheme.
+    try:
+        start = now - parse_go_duration(str(offset) if offset else OSL_PAVE_DEFAULT_OFFSET)
+        end = start + parse_go_duration(str(period)) if period else now
+        window = []
+        for scheme in osl_config['Schemes']:
+            epoch = datetime.datetime.strptime(scheme['Epoch'], '%Y-%m-%dT%H:%M:%SZ')
+            osl_period_nanoseconds = scheme['SeedPeriodNanoseconds']
+            for key_split in scheme['SeedPeriodKeySplits']:
+                osl_period_nanoseconds *= key_split['Total']
+            def get_period(time):
+                elapsed = time - epoch
+                elapsed_nanoseconds = ((elapsed.days * 86400 + elapsed.seconds) * 1000000 + elapsed.microseconds) * 1000
+                return elapsed_nanoseconds // osl_period_nanoseconds
+            window.append([get_period(start), get_period(end)])
+        return window
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        # Unrecognized config or duration; repave hourly
+        return now.strftime('%Y-%m-%d %H')
+
+
+def make_OSL_paving_key(osl_config, osl_payload, signing_key_pair, offset, period, now):
+    paving_inputs = json.dumps([osl_config,
+                                osl_payload,
+                                signing_key_pair,
+                                str(offset),
+                                str(period),
+                                get_OSL_paving_window(json.loads(osl_config), now, offset, period)])
+    return hashlib.sha256(paving_inputs.encode()).hexdigest()
+
+
+def prune_OSL_pave_cache():
+    # Keeps the most recent OSL_PAVE_CACHE_ENTRIES pavings
+    pavings = [os.path.join(OSL_PAVE_CACHE_DIR, name) for name in os.listdir(OSL_PAVE_CACHE_DIR)]
+    pavings = sorted([paving for paving in pavings if os.path.isdir(paving)],
+                     key=os.path.getmtime, reverse=True)
+    for paving in pavings[OSL_PAVE_CACHE_ENTRIES:]:
+        shutil.rmtree(paving, ignore_errors=True)
+
+
 ClientVersion = psi_utils.recordtype(
     'ClientVersion',
     'version, description')
@@ -468,6 +537,15 @@ RoutesSigningKeyPair = psi_utils.recordtype(
     'pem_key_pair, password')
 
 
+# Default number of server-entry-signer processes run concurrently when
+# signing a batch of server entries. It is read on each batch, so it can be
+# changed at run time, and sign_encoded_server_entries takes a pool_size.
+SERVER_ENTRY_SIGNER_POOL_SIZE = 16
+
+# Number of campaign buckets updated concurrently when publishing builds and
+# remote server lists in deploy()
+CAMPAIGN_UPLOAD_POOL_SIZE = 16
+
 CLIENT_PLATFORM_WINDOWS = 'Windows'
 CLIENT_PLATFORM_ANDROID = 'Android'
 CLIENT_PLATFORM_IOS = 'iOS'
@@ -564,10 +642,34 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         self.__standard_ossh_ports = set()
 
+        self.__cleared_record_log_keys = set()
+        self.initialize_transient_state()
+
         if initialize_plugins:
             self.initialize_plugins()
 
-    class_version = '0.84'
+    class_version = '0.85'
+
+    # Secondary indexes over __hosts and __servers are derived state: they
+    # are not persisted and are rebuilt on first use after loading (see __get_indexes)
+    transient_attributes = ('_PsiphonNetwork__indexes',
+                            '_PsiphonNetwork__date_range_indexes',
+                            '_PsiphonNetwork__encoded_server_entry_cache',
+                            '_PsiphonNetwork__cleared_record_log_keys')
+
+    # Record collections saved incrementally (see PersistentObject.save).
+    # Campaigns are saved with the sponsor record that contains them.
+    journaled_attributes = ('_PsiphonNetwork__hosts',
+                            '_PsiphonNetwork__deleted_hosts',
+                            '_PsiphonNetwork__servers',
+                            '_PsiphonNetwork__deleted_servers',
+                            '_PsiphonNetwork__paused_hosts',
+                            '_PsiphonNetwork__paused_servers',
+                            '_PsiphonNetwork__sponsors',
+                            '_PsiphonNetwork__propagation_channels')
+
+    __server_index_fields = ('ip_address', 'internal_ip_address', 'host_id', 'propagation_channel_id')
+    __host_index_fields = ('provider_id',)
 
     def upgrade(self):
         if cmp(parse_version(self.version), parse_version('0.1')) < 0:
@@ -1049,7 +1151,104 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             for server in list(self.__servers.values()) + list(self.__deleted_servers.values()):
                 server.capabilities['INPROXY-WEBRTC-FRONTED-MEEK-OSSH'] = False
             self.version = '0.84'
-
+        if cmp(parse_version(self.version), parse_version('0.85')) < 0:
+            for sponsor in self.__sponsors.values():
+                for campaign in sponsor.campaigns:
+                    campaign.id = self.__generate_id()
+            # The logs move to the log store on the next save. If that save
+            # fails after the logs are stored, the upgrade runs again, so
+            # whatever is in the store is replaced.
+            self.__cleared_record_log_keys = set(key for key, _ in self.__iterate_logged_records())
+            self.version = '0.85'
+
+
+    def initialize_transient_state(self):
+        # Built on first lookup, so that tools which never look anything up
+        # don't load every host and server from a binary snapshot
+        self.__indexes = None
+        self.__date_range_indexes = None
+        # Maps server id -> (fingerprint of the server entry inputs, signed
+        # encoded server entry). See __get_encoded_server_entry
+        self.__encoded_server_entry_cache = {}
+        # Keys whose stored logs are replaced on the next save. See
+        # __restore_record_logs. An upgrade may already have set them.
+        if self.__cleared_record_log_keys is None:
+            self.__cleared_record_log_keys = set()
+        # Routes record.get_logs() to the log store
+        psi_utils.register_record_log_reader(self, PsiphonNetwork.__read_record_logs)
+
+    def __rebuild_indexes(self):
+        # Each index maps a field value to an insertion ordered dict of
+        # record id -> record, so lookups are constant time and per-host and
+        # per-channel server lists preserve the order of __servers
+        self.__indexes = {}
+        for field in self.__server_index_fields:
+            self.__indexes['server_' + field] = defaultdict(dict)
+        for field in self.__host_index_fields:
+            self.__indexes['host_' + field] = defaultdict(dict)
+        for host in self.__hosts.values():
+            self.__index_host(host)
+        for server in self.__servers.values():
+            self.__index_server(server)
+
+    def __get_indexes(self):
+        # The indexes are reset when unpickled, e.g. from the db config
+        if self.__indexes is None:
+            self.__rebuild_indexes()
+        return self.__indexes
+
+    def __get_date_range_indexes(self):
+        # Indexes of servers by discovery and OSL discovery date range, built
+        # on first use and discarded whenever servers or their ranges change
+        if self.__date_range_indexes is None:
+            self.__date_range_indexes = {
+                'discovery': psi_ops_discovery.DateRangeIndex(
+                    [(server.discovery_date_range[0], server.discovery_date_range[1], server)
+                     for server in self.__servers.values() if server.discovery_date_range]),
+                'osl_discovery': psi_ops_discovery.DateRangeIndex(
+                    [(server.osl_discovery_date_range[0], server.osl_discovery_date_range[1], server)
+                     for server in self.__servers.values() if server.osl_discovery_date_range])
+            }
+        return self.__date_range_indexes
+
+    def __invalidate_date_range_indexes(self):
+        self.__date_range_indexes = None
+
+    def __index_server(self, server):
+        self.__invalidate_date_range_indexes()
+        indexes = self.__get_indexes()
+        for field in self.__server_index_fields:
+            indexes['server_' + field][getattr(server, field)][server.id] = server
+
+    def __unindex_server(self, server):
+        self.__invalidate_date_range_indexes()
+        indexes = self.__get_indexes()
+        for field in self.__server_index_fields:
+            index = indexes['server_' + field]
+            value = getattr(server, field)
+            if value in index:
+                index[value].pop(server.id, None)
+                if not index[value]:
+                    del index[value]
+
+    def __index_host(self, host):
+        indexes = self.__get_indexes()
+        for field in self.__host_index_fields:
+            indexes['host_' + field][getattr(host, field)][host.id] = host
+
+    def __unindex_host(self, host):
+        indexes = self.__get_indexes()
+        for field in self.__host_index_fields:
+            index = indexes['host_' + field]
+            value = getattr(host, field)
+            if value in index:
+                index[value].pop(host.id, None)
+                if not index[value]:
+                    del index[value]
+
+    def __get_indexed_servers(self, field, value):
+        index = self.__get_indexes()['server_' + field]
+        return list(index[value].values()) if value in index else []
 
     def initialize_plugins(self):
         for plugin in plugins:
@@ -1219,8 +1418,84 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             for client_version in self.__client_versions[platform]:
                 print(client_version.logs[0][0], client_version.version, client_version.description)
 
+    def __iterate_logged_records(self):
+        # Deleted hosts aren't included: host IDs may be reused, so deleted
+        # hosts are archived with their logs (see remove_host)
+        for hosts in (self.__hosts, self.__paused_hosts):
+            for host in hosts.values():
+                yield 'Host:' + host.id, host
+        for servers in (self.__servers, self.__paused_servers, self.__deleted_servers):
+            for server in servers.values():
+                yield 'Server:' + server.id, server
+        for sponsor in self.__sponsors.values():
+            yield 'Sponsor:' + sponsor.id, sponsor
+            for campaign in sponsor.campaigns:
+                yield 'SponsorCampaign:' + campaign.id, campaign
+        for propagation_channel in self.__propagation_channels.values():
+            yield 'PropagationChannel:' + propagation_channel.id, propagation_channel
+
+    def __get_record_log_key(self, record):
+        if isinstance(record, (Host, Server, Sponsor, SponsorCampaign, PropagationChannel)):
+            return '%s:%s' % (type(record).__name__, record.id)
+        return None
+
+    def __flush_record_logs(self):
+        # Record logs are kept out of the document, in the append-only log
+        # store (see psi_ops_cms.RecordLogStore), so that the records hold
+        # only current state. Records accumulate new logs until the next save
+        # appends them to the store. Without a store, as for compartmentalized
+        # copies, logs stay in the records.
+        if self._log_store is None:
+            return
+        entries = [(key, None, None) for key in self.__cleared_record_log_keys]
+        records = []
+        for key, record in self.__iterate_logged_records():
+            if record.logs:
+                entries.extend((key, timestamp, message) for timestamp, message in record.logs)
+                records.append(record)
+        self._log_store.append(entries)
+        for record in records:
+            record.logs = []
+        self.__cleared_record_log_keys = set()
+
+    def __get_record_logs(self, record):
+        # Stored logs are read on demand
+        key = self.__get_record_log_key(record)
+        if key is None or self._log_store is None or key in self.__cleared_record_log_keys:
+            return record.logs
+        return self._log_store.get(key) + record.logs
+
+    def __read_record_logs(self, record):
+        # Only records held by this network are read from its log store;
+        # compartmentalized copies hold records with the same ids
+        if isinstance(record, Host):
+            held = [self.__hosts.get(record.id), self.__paused_hosts.get(record.id)]
+        elif isinstance(record, Server):
+            held = [servers.get(record.id) for servers in
+                    (self.__servers, self.__paused_servers, self.__deleted_servers)]
+        elif isinstance(record, Sponsor):
+            held = [self.__sponsors.get(record.id)]
+        elif isinstance(record, SponsorCampaign):
+            held = [campaign for sponsor in self.__sponsors.values() for campaign in sponsor.campaigns]
+        elif isinstance(record, PropagationChannel):
+            held = [self.__propagation_channels.get(record.id)]
+        else:
+            return None
+        if not any(held_record is record for held_record in held):
+            return None
+        return self.__get_record_logs(record)
+
+    def __restore_record_logs(self, record):
+        # Moves a record's stored logs back into the record, for records
+        # which are archived with their logs or whose logs are edited. The
+        # next save replaces the stored logs with the record's.
+        key = self.__get_record_log_key(record)
+        if key is not None and self._log_store is not None and key not in self.__cleared_record_log_keys:
+            record.logs = self._log_store.get(key) + record.logs
+            self.__cleared_record_log_keys.add(key)
+
     def __show_logs(self, obj):
-        for timestamp, message in obj.get_logs():
+        for timestamp, message in self.__get_record_logs(obj):
             print('%s: %s' % (timestamp.isoformat(), message))
         print('')
 
@@ -1284,30 +1559,30 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         if now == None:
             now = datetime.datetime.now()
         p = self.get_propagation_channel_by_name(propagation_channel_name)
-        embedded_servers = [server.id + (' (permanent)' if server.is_permanent else '') for server in self.__servers.values()
-                            if server.propagation_channel_id == p.id and server.is_embedded]
-        old_propagation_servers = [server.id for server in self.__servers.values()
-                                   if server.propagation_channel_id == p.id and
-                                   not server.is_embedded and not server.discovery_date_range]
+        channel_servers = self.get_servers_for_propagation_channel(p.id)
+        embedded_servers = [server.id + (' (permanent)' if server.is_permanent else '') for server in channel_servers
+                            if server.is_embedded]
+        old_propagation_servers = [server.id for server in channel_servers
+                                   if not server.is_embedded and not server.discovery_date_range]
         current_discovery_servers = ['%s - %s : %s' % (server.discovery_date_range[0].isoformat(),
                                                        server.discovery_date_range[1].isoformat(),
                                                        server.id)
-                                     for server in self.__servers.values()
-                                     if server.propagation_channel_id == p.id and server.discovery_date_range and
+                                     for server in channel_servers
+                                     if server.discovery_date_range and
                                      (server.discovery_date_range[0] <= now < server.discovery_date_range[1])]
         current_discovery_servers.sort()
         future_discovery_servers = ['%s - %s : %s' % (server.discovery_date_range[0].isoformat(),
                                                       server.discovery_date_range[1].isoformat(),
                                                       server.id)
-                                    for server in self.__servers.values()
-                                    if server.propagation_channel_id == p.id and server.discovery_date_range and
+                                    for server in channel_servers
+                                    if server.discovery_date_range and
                                        server.discovery_date_range[0] > now]
         future_discovery_servers.sort()
         old_discovery_servers = ['%s - %s : %s' % (server.discovery_date_range[0].isoformat(),
                                                    server.discovery_date_range[1].isoformat(),
                                                    server.id)
-                                 for server in self.__servers.values()
-                                 if server.propagation_channel_id == p.id and server.discovery_date_range and
+                                 for server in channel_servers
+                                 if server.discovery_date_range and
                                     now >= server.discovery_date_range[1]]
         old_discovery_servers.sort()
 
@@ -1354,9 +1629,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             self.show_server(s.id)
 
     def show_servers_on_host(self, host_id):
-        for s in self.__servers.values():
-            if s.host_id == host_id:
-                self.show_server(s.id)
+        for s in self.get_servers_for_host(host_id):
+            self.show_server(s.id)
 
     def show_server(self, server_id):
         s = self.__servers[server_id]
@@ -1399,9 +1673,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
     def show_host(self, host_id, show_logs=False):
         host = self.__hosts[host_id]
-        servers = [self.__servers[s].id + (' (permanent)' if self.__servers[s].is_permanent else '')
-                   for s in self.__servers
-                   if self.__servers[s].host_id == host_id]
+        servers = [s.id + (' (permanent)' if s.is_permanent else '')
+                   for s in self.get_servers_for_host(host_id)]
 
         print(textwrap.dedent('''
             Host ID:                 %(id)s%(is_TCS)s
@@ -1562,6 +1835,18 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             self.__deploy_website_required_for_sponsors.add(sponsor.id)
             sponsor.log('website updated, marked for publish')
 
+    def __sponsor_has_campaign(self, sponsor, campaign):
+        # Campaigns are compared by their settings; the new campaign has no id
+        # or logs yet
+        fields = campaign.todict()
+        del fields['id'], fields['logs']
+        for existing in sponsor.campaigns:
+            existing_fields = existing.todict()
+            del existing_fields['id'], existing_fields['logs']
+            if existing_fields == fields:
+                return True
+        return False
+
     def add_sponsor_email_campaign(self, sponsor_name, propagation_channel_name, email_account):
         assert(self.is_locked)
         sponsor = self.get_sponsor_by_name(sponsor_name)
@@ -1576,8 +1861,10 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                    None,
                                    None,
                                    None,
-                                   False)
-        if campaign not in sponsor.campaigns:
+                                   False,
+                                   None)
+        if not self.__sponsor_has_campaign(sponsor, campaign):
+            campaign.id = self.__generate_id()
             sponsor.campaigns.append(campaign)
             sponsor.log('add email campaign %s' % (email_account,))
             for platform in self.__deploy_builds_required_for_campaigns:
@@ -1631,8 +1918,10 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                    None,
                                    None,
                                    None,
-                                   False)
-        if campaign not in sponsor.campaigns:
+                                   False,
+                                   None)
+        if not self.__sponsor_has_campaign(sponsor, campaign):
+            campaign.id = self.__generate_id()
             sponsor.campaigns.append(campaign)
             sponsor.log('add twitter campaign %s' % (twitter_account_name,))
             for platform in self.__deploy_builds_required_for_campaigns:
@@ -1654,8 +1943,10 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                    None,
                                    None,
                                    None,
-                                   False)
-        if campaign not in sponsor.campaigns:
+                                   False,
+                                   None)
+        if not self.__sponsor_has_campaign(sponsor, campaign):
+            campaign.id = self.__generate_id()
             sponsor.campaigns.append(campaign)
             sponsor.log('add static download campaign')
             for platform in self.__deploy_builds_required_for_campaigns:
@@ -1809,13 +2100,13 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         sponsor.log('set use data from sponsor \'%s\'' % (use_data_from_sponsor_name))
 
     def get_server_by_ip_address(self, ip_address):
-        servers = list(filter(lambda x: x.ip_address == ip_address, self.__servers.values()))
+        servers = self.__get_indexed_servers('ip_address', ip_address)
         if len(servers) == 1:
             return servers[0]
         return None
 
     def get_server_by_internal_ip_address(self, ip_address):
-        servers = list(filter(lambda x: x.internal_ip_address == ip_address, self.__servers.values()))
+        servers = self.__get_indexed_servers('internal_ip_address', ip_address)
         if len(servers) == 1:
             return servers[0]
         return None
@@ -1952,7 +2243,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         for host_id in host_id_list:
             host = self.__hosts[host_id]
-            servers = [s for s in self.get_servers() if s.host_id == host.id]
+            servers = self.get_servers_for_host(host.id)
             exp_servers_entry = list()
 
             exp_host = (host.id,
@@ -2054,12 +2345,14 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                 host = Host(*imp_entry[0])
                 assert(host.id not in self.__hosts)
                 self.__hosts[host.id] = host
+                self.__index_host(host)
                 host_id_list.append(host.id)
 
                 for imp_server in imp_entry[1]:
                     server = Server(*imp_server)
                     assert(server.id not in self.__servers)
                     self.__servers[server.id] = server
+                    self.__index_server(server)
 
         return host_id_list
 
@@ -2083,6 +2376,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         assert(host.id not in self.__hosts)
         self.__hosts[host.id] = host
+        self.__index_host(host)
 
     # obsolete
     def import_server(self, server_id, host_id, ip_address, egress_ip_address, internal_ip_address,
@@ -2113,11 +2407,12 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         assert(server.id not in self.__servers)
         self.__servers[server.id] = server
+        self.__index_server(server)
 
     def __disable_host(self, host_id):
         assert(self.is_locked)
         host = self.__hosts[host_id]
-        servers = [s for s in self.__servers.values() if s.host_id == host_id]
+        servers = self.get_servers_for_host(host_id)
         # Prevent users from establishing new connections to this host,
         # while allowing existing connections to be maintained.
         for server in servers:
@@ -2139,23 +2434,35 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # NOTE: caller is responsible for saving now
         #self.save()
 
-    def __count_users_on_host(self, host_id):
-        host = self.__hosts[host_id]
+    def probe_host(self, host, metrics=False, processes=(), geoip_filename=None, geoip_max_age_days=None):
+        # Collects the user count and, with metrics, load, memory, disk,
+        # process counts and GeoIP freshness, in one remote command
+        if type(host) == str:
+            host = self.__hosts[host]
+        return psi_ops_host_probe.parse_host_probe_output(
+            self.run_command_on_host(
+                host,
+                psi_ops_host_probe.make_host_probe_command(
+                    host.is_TCS, metrics, processes, geoip_filename, geoip_max_age_days),
+                muted=True))
+
+    def __count_users_in_host_probe(self, host, probe):
         if host.is_TCS:
-            return int(self.run_command_on_host(host,
-                'tac /var/log/psiphond/psiphond.log | grep -m1 \\"establish_tunnels\\": | python -c \'import sys, json; print (json.loads(sys.stdin.read())["ALL"]["established_clients"])\''))
+            if not probe['psiphond_load']:
+                raise Exception('no load record in psiphond log on host %s' % (host.id,))
+            return int(probe['psiphond_load']['established_clients'])
         else:
-            vpn_users = int(self.run_command_on_host(host,
-                                                 'ifconfig | grep ppp | wc -l'))
-            ssh_users = int(self.run_command_on_host(host,
-                                                 'ps ax | grep ssh | grep psiphon | wc -l')) / 2
-            return int(vpn_users + ssh_users)
+            return int(probe['vpn_users'] + probe['ssh_users'])
+
+    def __count_users_on_host(self, host_id):
+        host = self.__hosts[host_id]
+        return self.__count_users_in_host_probe(host, self.probe_host(host))
 
     def __check_host_is_accepting_tunnels(self, host_id):
         host = self.__hosts[host_id]
         if host.is_TCS:
-            return 'True' == self.run_command_on_host(host,
-                'tac /var/log/psiphond/psiphond.log | grep -m1 \\"establish_tunnels\\": | python -c \'import sys, json; print (json.loads(sys.stdin.read())["establish_tunnels"])\'').strip()
+            probe = self.probe_host(host)
+            return bool(probe['psiphond_load'] and probe['psiphond_load']['establish_tunnels'])
         else:
             raise Exception("not implemented")
 
@@ -2186,8 +2493,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             except:
                 hosts_failed.add(host_id)
 
-        pool = ThreadPool(30)
-        pool.map(_prune_host, [server.host_id for server in servers])
+        psi_ops_fleet.run_on_fleet(_prune_host, [server.host_id for server in servers], concurrency=30)
 
         number_removed = 0
         for host_id in hosts_to_remove:
@@ -2216,10 +2522,9 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         if max_osl_discovery_server_age_in_days == None:
             max_osl_discovery_server_age_in_days = propagation_channel.max_osl_discovery_server_age_in_days
         if max_osl_discovery_server_age_in_days > 0:
-            old_osl_discovery_servers = [server for server in self.__servers.values()
+            old_osl_discovery_servers = [server for server in self.__get_date_range_indexes()['osl_discovery'].ended_before(
+                    today - datetime.timedelta(days=max_osl_discovery_server_age_in_days))
                 if server.propagation_channel_id == propagation_channel.id
-                and server.osl_discovery_date_range
-                and server.osl_discovery_date_range[1] < (today - datetime.timedelta(days=max_osl_discovery_server_age_in_days))
                 and self.__hosts[server.host_id].provider in providers]
             removed, disabled = self.__prune_servers(old_osl_discovery_servers)
             number_removed += removed
@@ -2228,10 +2533,9 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         if max_discovery_server_age_in_days == None:
             max_discovery_server_age_in_days = propagation_channel.max_discovery_server_age_in_days
         if max_discovery_server_age_in_days > 0:
-            old_discovery_servers = [server for server in self.__servers.values()
+            old_discovery_servers = [server for server in self.__get_date_range_indexes()['discovery'].ended_before(
+                    today - datetime.timedelta(days=max_discovery_server_age_in_days))
                 if server.propagation_channel_id == propagation_channel.id
-                and server.discovery_date_range
-                and server.discovery_date_range[1] < (today - datetime.timedelta(days=max_discovery_server_age_in_days))
                 and self.__hosts[server.host_id].provider in providers]
             removed, disabled = self.__prune_servers(old_discovery_servers)
             number_removed += removed
@@ -2240,12 +2544,11 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         if max_propagation_server_age_in_days == None:
             max_propagation_server_age_in_days = propagation_channel.max_propagation_server_age_in_days
         if max_propagation_server_age_in_days > 0:
-            old_propagation_servers = [server for server in self.__servers.values()
-                if server.propagation_channel_id == propagation_channel.id
-                and not server.osl_discovery_date_range
+            old_propagation_servers = [server for server in self.get_servers_for_propagation_channel(propagation_channel.id)
+                if not server.osl_discovery_date_range
                 and not server.discovery_date_range
                 and not server.is_embedded
-                and server.logs[0][0] < (today - datetime.timedelta(days=max_propagation_server_age_in_days))
+                and self.__get_record_logs(server)[0][0] < (today - datetime.timedelta(days=max_propagation_server_age_in_days))
                 and self.__hosts[server.host_id].provider in providers]
             removed, disabled = self.__prune_servers(old_propagation_servers)
             number_removed += removed
@@ -2336,7 +2639,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
     def add_server_to_host(self, host, new_servers):
 
-        existing_servers = [server for server in self.get_servers() if server.host_id == host.id]
+        existing_servers = self.get_servers_for_host(host.id)
         servers_on_host = existing_servers + new_servers
 
         psi_ops_install.install_host(host, servers_on_host, self.get_existing_server_ids(), self.__TCS_psiphond_config_values, self.__ssh_ip_address_whitelist, self.__TCS_iptables_output_rules, plugins)
@@ -2347,6 +2650,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         for server in new_servers:
             assert(server.id not in self.__servers)
             self.__servers[server.id] = server
+            self.__index_server(server)
             # If the Host is TCS, the Server should have this capability
             if host.is_TCS:
                 server.capabilities['ssh-api-requests'] = True
@@ -2460,7 +2764,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             host.meek_cookie_encryption_private_key = private_key
 
     def install_meek_for_host(self, host):
-        servers = [s for s in self.__servers.values() if s.host_id == host.id]
+        servers = self.get_servers_for_host(host.id)
         psi_ops_install.install_firewall_rules(host, servers, self.__TCS_psiphond_config_values, self.__ssh_ip_address_whitelist, self.__TCS_iptables_output_rules, plugins, False) # No need to update the malware blacklist
         psi_ops_install.install_psi_limit_load(host, servers)
         psi_ops_deploy.deploy_implementation(
@@ -2499,10 +2803,12 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # data will not include this host and server
         assert(host.id not in self.__hosts)
         self.__hosts[host.id] = host
+        self.__index_host(host)
 
         for server in servers:
             assert(server.id not in self.__servers)
             self.__servers[server.id] = server
+            self.__index_server(server)
             # If the Host is TCS, the Server should have this capability
             if host.is_TCS:
                 server.capabilities['ssh-api-requests'] = True
@@ -2576,9 +2882,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             # (they are still active, but not embedded in builds or discovered)
             # NEW: don't replace servers marked with is_permanent
             if is_embedded_server:
-                for old_server in self.__servers.values():
-                    if (old_server.propagation_channel_id == propagation_channel.id and
-                        old_server.is_embedded and
+                for old_server in self.get_servers_for_propagation_channel(propagation_channel.id):
+                    if (old_server.is_embedded and
                         not old_server.is_permanent):
                         old_server.is_embedded = False
                         old_server.log('unembedded')
@@ -2864,7 +3169,6 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                 # already been removed, so there is no need to save() yet.
 
         poolsize = 20
-        @psi_ops_deploy.retry_decorator_returning_exception
         def remove_host_from_provider(params):
             provider_remove_host = params[0]
             provider_account = params[1]
@@ -2874,16 +3178,20 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             # Remove the actual host through the provider's API
             provider_remove_host(provider_account, host.provider_id)
 
-        pool = ThreadPool(poolsize)
-        results = pool.map(remove_host_from_provider, params_list)
+        # Provider APIs are rate-limited, so concurrency only adapts down from
+        # poolsize, on errors
+        results = psi_ops_fleet.run_on_fleet(
+            remove_host_from_provider,
+            params_list,
+            concurrency=poolsize,
+            max_concurrency=poolsize,
+            attempts=psi_ops_deploy.DEPLOY_ATTEMPTS)
         
         # special case: clean up digitalocean floating IPs no longer associated with a droplet
         server_ips = self.get_provider_server_ips('digitalocean')
         psi_digitalocean.remove_orphan_ips(self.__digitalocean_account, server_ips)
 
-        for result in results:
-            if result:
-                raise result
+        psi_ops_fleet.raise_first_failure(results)
 
         if need_to_save:
             self.save()
@@ -2941,13 +3249,11 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # Mark host and its servers as deleted in the database. We keep the
         # records around for historical info and to ensure we never recycle
         # server IDs
-        server_ids_on_host = []
-        for server in self.__servers.values():
-            if server.host_id == host.id:
-                server_ids_on_host.append(server.id)
+        server_ids_on_host = [server.id for server in self.get_servers_for_host(host.id)]
         for server_id in server_ids_on_host:
             assert(server_id not in self.__deleted_servers)
             deleted_server = self.__servers.pop(server_id)
+            self.__unindex_server(deleted_server)
             # Clear some unneeded data that might be contributing to a MemoryError
             deleted_server.web_server_certificate = None
             deleted_server.web_server_secret = None
@@ -2963,6 +3269,8 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # We don't assign host IDs and can't guarentee uniqueness, so not
         # archiving deleted host keyed by ID.
         deleted_host = self.__hosts.pop(host.id)
+        self.__unindex_host(deleted_host)
+        self.__restore_record_logs(deleted_host)
         # Don't archive "deploy" logs.  They are noisy, and may contribute to
         # a MemoryError we have observed when serializing the PsiphonNetwork object
         for log in copy.copy(deleted_host.logs):
@@ -2988,20 +3296,22 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         host = self.__hosts[host_id]
 
         server_ids_on_host = []
-        for server in self.__servers.values():
-            if server.host_id == host.id and pause_server_id == server.id:
+        for server in self.get_servers_for_host(host.id):
+            if pause_server_id == server.id:
                 server_ids_on_host.append(server.id)
                 break
-            elif server.host_id == host.id and pause_server_id == 'all':
+            elif pause_server_id == 'all':
                 server_ids_on_host.append(server.id)
         for server_id in server_ids_on_host:
             assert(server_id not in self.__paused_servers)
             paused_server = self.__servers.pop(server_id)
+            self.__unindex_server(paused_server)
             paused_server.log("paused")
             self.__paused_servers[server_id] = paused_server
         
         if pause_server_id == 'all':
             paused_host = self.__hosts.pop(host.id)
+            self.__unindex_host(paused_host)
             paused_host.log("paused")
             self.__paused_hosts[host.id] = paused_host
         else:
@@ -3020,18 +3330,22 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         paused_servers = [self.__paused_servers[server_id] for server_id in self.__paused_servers.keys() if self.__paused_servers[server_id].host_id == host_id]
 
         if paused_host != None:
+            self.__restore_record_logs(paused_host)
             for log in copy.copy(paused_host.logs):
                 if 'paused' in log[1]:
                     paused_host.logs.remove(log)
             assert(paused_host not in self.__hosts)
             self.__hosts[paused_host.id] = paused_host
+            self.__index_host(paused_host)
 
         if len(paused_servers) > 0:
             for paused_server in paused_servers:
+                self.__restore_record_logs(paused_server)
                 for log in copy.copy(paused_server.logs):
                     if 'paused' in log[1]:
                         paused_server.logs.remove(log)
                 self.__servers[paused_server.id] = paused_server
+                self.__index_server(paused_server)
                 self.__paused_servers.pop(paused_server.id)
         
     def backup_and_restore_for_migrate(self, action, host):
@@ -3120,7 +3434,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
     def reinstall_host(self, host_id):
         assert(self.is_locked)
         host = self.__hosts[host_id]
-        servers = [server for server in self.__servers.values() if server.host_id == host_id]
+        servers = self.get_servers_for_host(host_id)
         psi_ops_install.install_host(host, servers, self.get_existing_server_ids(), self.__TCS_psiphond_config_values, self.__ssh_ip_address_whitelist, self.__TCS_iptables_output_rules, plugins)
         psi_ops_install.change_weekly_crontab_runday(host, None)
         psi_ops_deploy.deploy_implementation(
@@ -3159,8 +3473,11 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         for server_name in server_names:
             server = self.__servers[server_name]
+            self.__unindex_server(server)
             server.propagation_channel_id = propagation_channel.id
+            self.__index_server(server)
             server.discovery_date_range = self.__copy_date_range(discovery_date_range)
+            self.__invalidate_date_range_indexes()
             server.log('propagation channel set to %s' % (propagation_channel.id,))
             server.log('discovery_date_range set to %s - %s' % (server.discovery_date_range[0].isoformat(),
                                                                 server.discovery_date_range[1].isoformat()))
@@ -3319,15 +3636,15 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
     def __replace_propagation_channel_discovery_servers(self, propagation_channel_id):
         assert(self.is_locked)
         now = datetime.datetime.now()
-        for old_server in self.__servers.values():
+        for old_server in self.get_servers_for_propagation_channel(propagation_channel_id):
             # NOTE: don't instantiate today outside of this loop, otherwise jsonpickle will
             # serialize references to it (for all but the first server in this loop) which
             # are not unpickle-able
             today = datetime.datetime(now.year, now.month, now.day)
-            if (old_server.propagation_channel_id == propagation_channel_id and
-                old_server.discovery_date_range and
+            if (old_server.discovery_date_range and
                 (old_server.discovery_date_range[0] <= today < old_server.discovery_date_range[1])):
                 old_server.discovery_date_range = (old_server.discovery_date_range[0], today)
+                self.__invalidate_date_range_indexes()
                 old_server.log('replaced')
 
     def _weighted_random_choice(self, choices):
@@ -3688,8 +4005,56 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             f.close()
         return upgrade_filename
 
+    def __make_signed_remote_server_list(self, propagation_channel_id):
+        remote_server_list = \
+            psi_ops_crypto_tools.make_signed_data(
+                self.__get_remote_server_list_signing_key_pair().pem_key_pair,
+                REMOTE_SERVER_SIGNING_KEY_PAIR_PASSWORD,
+                '\n'.join(self.__get_encoded_server_list(propagation_channel_id)[0]))
+
+        # compressed server_list
+        # the entire file is compressed instead of just the payload
+        # because the compressed payload would need to be base64 encoded
+        # in the json contents of the file, losing compression
+        remote_server_list_compressed = zlib.compress(remote_server_list.encode())
+
+        return remote_server_list, remote_server_list_compressed
+
+    def __publish_campaign_builds(self, campaign_uploads, remote_server_lists):
+        # Uploads builds and the propagation channel's remote server list to
+        # each campaign's buckets concurrently. Returns a dict of the targets
+        # with a failed upload, mapped to the first exception raised.
+        failed_targets = {}
+        if not campaign_uploads:
+            return failed_targets
+
+        def _publish(campaign_upload):
+            target, campaign, builds = campaign_upload
+            remote_server_list, remote_server_list_compressed = \
+                remote_server_lists[campaign.propagation_channel_id]
+            try:
+                psi_ops_s3.update_s3_download_in_buckets(
+                    self.__aws_account,
+                    builds,
+                    remote_server_list,
+                    remote_server_list_compressed,
+                    [campaign.s3_bucket_name, campaign.alternate_s3_bucket_name])
+                # Don't log this, too much noise
+                #campaign.log('updated s3 bucket %s' % (campaign.s3_bucket_name,))
+            except Exception as ex:
+                sys.stderr.write('Failed to update s3 bucket %s: %s\n' % (campaign.s3_bucket_name, str(ex)))
+                failed_targets.setdefault(target, ex)
+
+        pool = ThreadPool(min(CAMPAIGN_UPLOAD_POOL_SIZE, len(campaign_uploads)))
+        try:
+            pool.map(_publish, campaign_uploads)
+        finally:
+            pool.close()
+
+        return failed_targets
+
     def __deploy_implementation_to_hosts(self, hosts):
-        hosts_and_servers = [(host, [server for server in self.__servers.values() if server.host_id == host.id]) for host in hosts]
+        hosts_and_servers = [(host, self.get_servers_for_host(host.id)) for host in hosts]
         psi_ops_deploy.deploy_implementation_to_hosts(
             hosts_and_servers,
             self.__get_own_encoded_server_entries_for_host,
@@ -3727,8 +4092,13 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         # Build
 
+        # Remote server lists are signed and compressed once per propagation
+        # channel for the whole deploy and shared by all of its campaigns
+        remote_server_lists = {}
+
         for platform in self.__deploy_builds_required_for_campaigns:
             deployed_builds_for_platform = False
+            campaign_uploads = []
             for target in self.__deploy_builds_required_for_campaigns[platform].copy():
 
                 propagation_channel_id, sponsor_id = target
@@ -3770,17 +4140,9 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                         if hasattr(plugin, 'info_link_url'):
                             info_link_url = plugin.info_link_url(platform)
 
-                    remote_server_list = \
-                        psi_ops_crypto_tools.make_signed_data(
-                            self.__get_remote_server_list_signing_key_pair().pem_key_pair,
-                            REMOTE_SERVER_SIGNING_KEY_PAIR_PASSWORD,
-                            '\n'.join(self.__get_encoded_server_list(propagation_channel.id)[0]))
-
-                    # compressed server_list
-                    # the entire file is compressed instead of just the payload
-                    # because the compressed payload would need to be base64 encoded
-                    # in the json contents of the file, losing compression
-                    remote_server_list_compressed = zlib.compress(remote_server_list.encode())
+                    if propagation_channel.id not in remote_server_lists:
+                        remote_server_lists[propagation_channel.id] = \
+                            self.__make_signed_remote_server_list(propagation_channel.id)
 
                     # Build for each client platform
 
@@ -3843,35 +4205,41 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                         builds = [(build_filename, client_version, client_build_filenames[platform]),
                                  (upgrade_filename, client_version, s3_upgrade_resource_name)]
 
-                    # Publish to propagation mechanisms
+                    campaign_uploads.append((target, campaign, builds))
 
-                    psi_ops_s3.update_s3_download_in_buckets(
-                        self.__aws_account,
-                        builds,
-                        remote_server_list,
-                        remote_server_list_compressed,
-                        [campaign.s3_bucket_name, campaign.alternate_s3_bucket_name])
-                    # Don't log this, too much noise
-                    #campaign.log('updated s3 bucket %s' % (campaign.s3_bucket_name,))
-
-                    if campaign.propagation_mechanism_type == 'twitter':
-                        message = psi_templates.get_tweet_message(campaign.s3_bucket_name)
-                        psi_ops_twitter.tweet(campaign.account, message)
-                        campaign.log('tweeted')
-                    elif campaign.propagation_mechanism_type == 'email-autoresponder':
-                        if not self.__deploy_email_config_required:
-                            self.__deploy_email_config_required = True
-                            # Don't log this, too much noise
-                            #campaign.log('email push scheduled')
-
-                # NOTE: before we added remote server lists, it used to be that
-                # multiple campaigns with different buckets but the same prop/sponsor IDs
-                # could share one build. The "deploy_builds_required_for_campaigns" dirty
-                # flag granularity is a hold-over from that. In the current code, this
-                # means some builds may be repeated unnecessarily in a failure case.
-
-                self.__deploy_builds_required_for_campaigns[platform].remove(target)
-                deployed_builds_for_platform = True
+            # Publish to propagation mechanisms
+
+            failed_targets = self.__publish_campaign_builds(campaign_uploads, remote_server_lists)
+
+            for target, campaign, _ in campaign_uploads:
+                if target in failed_targets:
+                    continue
+
+                if campaign.propagation_mechanism_type == 'twitter':
+                    message = psi_templates.get_tweet_message(campaign.s3_bucket_name)
+                    psi_ops_twitter.tweet(campaign.account, message)
+                    campaign.log('tweeted')
+                elif campaign.propagation_mechanism_type == 'email-autoresponder':
+                    if not self.__deploy_email_config_required:
+                        self.__deploy_email_config_required = True
+                        # Don't log this, too much noise
+                        #campaign.log('email push scheduled')
+
+            # NOTE: before we added remote server lists, it used to be that
+            # multiple campaigns with different buckets but the same prop/sponsor IDs
+            # could share one build. The "deploy_builds_required_for_campaigns" dirty
+            # flag granularity is a hold-over from that. In the current code, this
+            # means some builds may be repeated unnecessarily in a failure case.
+
+            for target in self.__deploy_builds_required_for_campaigns[platform].copy():
+                if target not in failed_targets:
+                    self.__deploy_builds_required_for_campaigns[platform].remove(target)
+                    deployed_builds_for_platform = True
+
+            if failed_targets:
+                if deployed_builds_for_platform:
+                    self.save()
+                raise list(failed_targets.values())[0]
 
             # NOTE: it is too expensive to save too frequently.
             # Save only after finishing all builds for a platform.
@@ -3898,8 +4266,12 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             # Generate the static website from source
             website_generator.generate(WEBSITE_GENERATION_DIR)
 
-            # Iterate through a copy so that we can remove as we go
-            for sponsor_id in self.__deploy_website_required_for_sponsors.copy():
+            # Publish every campaign's site in one sync, so that the
+            # generated files are read and hashed once, and the buckets are
+            # updated concurrently
+            sponsor_ids = list(self.__deploy_website_required_for_sponsors)
+            campaigns = []
+            for sponsor_id in sponsor_ids:
                 sponsor = self.__sponsors[sponsor_id]
                 for campaign in sponsor.campaigns:
                     if not campaign.s3_bucket_name:
@@ -3907,8 +4279,17 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                         campaign.log('created s3 bucket %s' % (campaign.s3_bucket_name,))
                         self.save()  # don't leak buckets
 
-                    self.update_static_site_content(sponsor, campaign)
+                    campaigns.append((sponsor, campaign))
 
+            psi_ops_s3.update_websites(
+                        self.__aws_account,
+                        WEBSITE_GENERATION_DIR,
+                        [self.__get_static_site_content(sponsor, campaign)
+                         for sponsor, campaign in campaigns])
+
+            for _, campaign in campaigns:
+                campaign.log('updated website in S3 bucket %s' % (campaign.s3_bucket_name,))
+            for sponsor_id in sponsor_ids:
                 self.__deploy_website_required_for_sponsors.remove(sponsor_id)
 
             self.save()
@@ -3946,38 +4327,127 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
     def pave_OSLs(self, target_propagation_channel_ids, offset=None, period=None):
         # Note: Only writes to buckets for campaigns in target_propagation_channel_ids
 
-        osl_config_filename = os.path.join('.', 'osl_config.json')
-        osl_payload_filename = os.path.join('.', 'osl_payload.json')
-        signing_key_filename = os.path.join('.', 'signing_key.pem')
-        output_dir = tempfile.mkdtemp(prefix='osl')
-
         now = datetime.datetime.now()
-        osl_servers = [server for server in self.__servers.values()
-                       if server.osl_ids and server.osl_discovery_date_range and
-                       server.osl_discovery_date_range[0] <= now < server.osl_discovery_date_range[1]]
+        osl_servers = [server for server in self.__get_date_range_indexes()['osl_discovery'].in_range(now)
+                       if server.osl_ids]
 
         osl_payload = []
-        for osl_server in osl_servers:
-            osl_payload.append({'ServerEntry' : self.__get_encoded_server_entry(osl_server),
+        for osl_server, encoded_server_entry in zip(osl_servers, self.__get_encoded_server_entries(osl_servers)):
+            osl_payload.append({'ServerEntry' : encoded_server_entry,
                                 'OSLIDs' : osl_server.osl_ids})
+        osl_payload = json.dumps(osl_payload)
 
-        try:
-            # Pave full OSL file sets for all propagation channels in the OSL config.
+        config = json.loads(self.__TCS_OSL_config)
+        signing_key_pair = self.__get_remote_server_list_signing_key_pair().pem_key_pair
+
+        # Pave full OSL file sets for all propagation channels in the OSL
+        # config, unless the same inputs have already been paved in this
+        # OSL time period
+
+        paving_key = make_OSL_paving_key(self.__TCS_OSL_config, osl_payload, signing_key_pair,
+                                         offset, period, datetime.datetime.utcnow())
+        output_dir = os.path.join(OSL_PAVE_CACHE_DIR, paving_key)
+        if os.path.isdir(output_dir):
+            print('using cached OSL paving %s' % (paving_key,))
+            os.utime(output_dir)
+        else:
+            self.__run_OSL_paver(osl_payload, signing_key_pair, offset, period, output_dir)
+            prune_OSL_pave_cache()
+
+        # Only write to buckets that don't already have this paving
+
+        uploads_filename = os.path.join(OSL_PAVE_CACHE_DIR, OSL_PAVE_UPLOADS_FILENAME)
+        uploads = {}
+        if os.path.exists(uploads_filename):
+            with open(uploads_filename) as uploads_file:
+                uploads = json.load(uploads_file)
+        # Buckets with an earlier paving are rewritten anyway, so only the
+        # buckets with the current paving are kept
+        uploads = dict((bucket_id, uploaded_paving_key) for bucket_id, uploaded_paving_key in uploads.items()
+                       if uploaded_paving_key == paving_key)
+
+        def get_campaign_bucket_ids(propagation_channel_id):
+            bucket_ids = []
+            for sponsor in self.__sponsors.values():
+                for campaign in sponsor.campaigns:
+                    if campaign.propagation_channel_id == str(propagation_channel_id):
+                        bucket_ids += [bucket_id for bucket_id in
+                                       [campaign.s3_bucket_name, campaign.alternate_s3_bucket_name]
+                                       if bucket_id and uploads.get(bucket_id) != paving_key]
+            return bucket_ids
+
+        paved_propagation_channel_ids = set()
+        for scheme_index, scheme in enumerate(config['Schemes']):
+            for propagation_channel_id in scheme['PropagationChannelIDs']:
+                paved_propagation_channel_ids.add(propagation_channel_id)
+
+        bucket_osl_filenames = {}
+        for propagation_channel_id in paved_propagation_channel_ids:
+
+            if not propagation_channel_id in target_propagation_channel_ids:
+                continue
+
+            prop_dir = os.path.join(output_dir, propagation_channel_id)
+            upload_filenames = [os.path.join(prop_dir, filename) for filename in os.listdir(prop_dir)]
+
+            for bucket_id in get_campaign_bucket_ids(propagation_channel_id):
+                bucket_osl_filenames[bucket_id] = upload_filenames
+
+        # Ensure all other buckets have a valid, empty osl-registry. Clients will
+        # expect this to exist regardless of whether a propagation channel is part
+        # of the OSL config.
+
+        bucket_osl_keys = {}
+        for propagation_channel_id in target_propagation_channel_ids:
+            if propagation_channel_id in paved_propagation_channel_ids:
+                continue
+            for bucket_id in get_campaign_bucket_ids(propagation_channel_id):
+                bucket_osl_keys[bucket_id] = {'osl-registry': None}
+
+        if bucket_osl_keys:
+            empty_osl_registry = zlib.compress(psi_ops_crypto_tools.make_signed_data(
+                    signing_key_pair,
+                    REMOTE_SERVER_SIGNING_KEY_PAIR_PASSWORD,
+                    base64.b64encode('{"FileSpecs" : []}'.encode())).encode())
+            for osl_keys in bucket_osl_keys.values():
+                osl_keys['osl-registry'] = empty_osl_registry
+
+        if not bucket_osl_filenames and not bucket_osl_keys:
+            print('OSLs are up to date')
+            return
+
+        # Uploads run concurrently across all buckets, and skip unchanged files
+        psi_ops_s3.update_s3_osls(self.__aws_account, bucket_osl_filenames, bucket_osl_keys)
 
+        for bucket_id in list(bucket_osl_filenames) + list(bucket_osl_keys):
+            uploads[bucket_id] = paving_key
+        with open(uploads_filename + '.tmp', 'w') as uploads_file:
+            json.dump(uploads, uploads_file)
+        os.replace(uploads_filename + '.tmp', uploads_filename)
+
+    def __run_OSL_paver(self, osl_payload, signing_key_pair, offset, period, output_dir):
+        osl_config_filename = os.path.join('.', 'osl_config.json')
+        osl_payload_filename = os.path.join('.', 'osl_payload.json')
+        signing_key_filename = os.path.join('.', 'signing_key.pem')
+        if not os.path.isdir(OSL_PAVE_CACHE_DIR):
+            os.makedirs(OSL_PAVE_CACHE_DIR)
+        # Paved into a temporary directory, which replaces output_dir only
+        # when paver succeeds
+        paver_output_dir = tempfile.mkdtemp(prefix='osl', dir=OSL_PAVE_CACHE_DIR)
+
+        try:
             osl_config_file = open(osl_config_filename, 'w')
             osl_config_file.write(self.__TCS_OSL_config)
             osl_config_file.close()
 
             osl_payload_file = open(osl_payload_filename, 'w')
-            osl_payload_file.write(json.dumps(osl_payload))
+            osl_payload_file.write(osl_payload)
             osl_payload_file.close()
 
             signing_key_file = open(signing_key_filename, 'w')
-            signing_key_file.write(self.__get_remote_server_list_signing_key_pair().pem_key_pair)
+            signing_key_file.write(signing_key_pair)
             signing_key_file.close()
 
-            config = json.loads(self.__TCS_OSL_config)
-
             # Source: https://github.com/Psiphon-Labs/psiphon-tunnel-core/tree/master/psiphon/common/osl/paver
             paver_binary = 'paver.exe'
             if os.name == 'posix':
@@ -3989,12 +4459,12 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                  "-payload", osl_payload_filename,
                  "-key", signing_key_filename,
                  "-omit-md5sums", "0",
-                 "-output", output_dir]
+                 "-output", paver_output_dir]
 
             if offset:
                 paver_command_line += ["-offset", str(offset)]
             else:
-                paver_command_line += ["-offset", "2880h"] # 120 days
+                paver_command_line += ["-offset", OSL_PAVE_DEFAULT_OFFSET]
 
             if period:
                 paver_command_line += ["-period", str(period)]
@@ -4003,52 +4473,14 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             output = subprocess.check_output(paver_command_line, stderr=subprocess.STDOUT).decode()
             print(output)
 
-            paved_propagation_channel_ids = set()
-            for scheme_index, scheme in enumerate(config['Schemes']):
-                for propagation_channel_id in scheme['PropagationChannelIDs']:
-                    paved_propagation_channel_ids.add(propagation_channel_id)
-
-            for propagation_channel_id in paved_propagation_channel_ids:
-
-                if not propagation_channel_id in target_propagation_channel_ids:
-                    continue
-
-                prop_dir = os.path.join(output_dir, propagation_channel_id)
-                upload_filenames = [os.path.join(prop_dir, filename) for filename in os.listdir(prop_dir)]
-
-                for sponsor in self.__sponsors.values():
-                    for campaign in sponsor.campaigns:
-                        if campaign.propagation_channel_id == str(propagation_channel_id):
-                            psi_ops_s3.update_s3_osl_with_files_in_buckets(
-                                self.__aws_account,
-                                [campaign.s3_bucket_name, campaign.alternate_s3_bucket_name],
-                                upload_filenames)
-
-            # Ensure all other buckets have a valid, empty osl-registry. Clients will
-            # expect this to exist regardless of whether a propagation channel is part
-            # of the OSL config.
-
-            empty_osl_registry = zlib.compress(psi_ops_crypto_tools.make_signed_data(
-                    self.__get_remote_server_list_signing_key_pair().pem_key_pair,
-                    REMOTE_SERVER_SIGNING_KEY_PAIR_PASSWORD,
-                    base64.b64encode('{"FileSpecs" : []}'.encode())).encode())
-
-            for sponsor in self.__sponsors.values():
-                for campaign in sponsor.campaigns:
-                    if not campaign.propagation_channel_id in paved_propagation_channel_ids:
-                        if campaign.propagation_channel_id in target_propagation_channel_ids:
-                            psi_ops_s3.update_s3_osl_key_in_buckets(
-                                self.__aws_account,
-                                [campaign.s3_bucket_name, campaign.alternate_s3_bucket_name],
-                                'osl-registry',
-                                empty_osl_registry)
+            os.rename(paver_output_dir, output_dir)
 
         finally:
             try:
                 os.remove(osl_config_filename)
                 os.remove(osl_payload_filename)
                 os.remove(signing_key_filename)
-                shutil.rmtree(output_dir, ignore_errors=True)
+                shutil.rmtree(paver_output_dir, ignore_errors=True)
             except:
                 pass
 
@@ -4098,6 +4530,14 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             # Generate the static website from source
             website_generator.generate(WEBSITE_GENERATION_DIR)
 
+        psi_ops_s3.update_websites(
+                        self.__aws_account,
+                        WEBSITE_GENERATION_DIR,
+                        [self.__get_static_site_content(sponsor, campaign)])
+        campaign.log('updated website in S3 bucket %s' % (campaign.s3_bucket_name,))
+
+    def __get_static_site_content(self, sponsor, campaign):
+        # Returns the campaign's site, as psi_ops_s3.update_websites takes it
         assert(self.__default_email_autoresponder_account)
         get_new_version_email = self.__default_email_autoresponder_account.email_address
         if type(campaign.account) == EmailPropagationAccount:
@@ -4109,15 +4549,11 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             sponsor_website_banner = self.__sponsors[sponsor.use_data_from_sponsor_id].website_banner
             sponsor_website_banner_link = self.__sponsors[sponsor.use_data_from_sponsor_id].website_banner_link
 
-        psi_ops_s3.update_website_in_buckets(
-                        self.__aws_account,
-                        [campaign.s3_bucket_name, campaign.alternate_s3_bucket_name],
-                        campaign.custom_download_site,
-                        WEBSITE_GENERATION_DIR,
-                        sponsor_website_banner,
-                        sponsor_website_banner_link,
-                        get_new_version_email)
-        campaign.log('updated website in S3 bucket %s' % (campaign.s3_bucket_name,))
+        return ([campaign.s3_bucket_name, campaign.alternate_s3_bucket_name],
+                campaign.custom_download_site,
+                sponsor_website_banner,
+                sponsor_website_banner_link,
+                get_new_version_email)
 
     def update_routes(self):
         assert(self.is_locked)  # (host.log is called by deploy)
@@ -4357,13 +4793,13 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         self.__deploy_data_required_for_all = True
 
     def get_server_entry(self, server_id):
-        server = list(filter(lambda x: x.id == server_id, self.__servers.values()))[0]
+        server = self.__servers[server_id]
         return self.__get_encoded_server_entry(server)
 
     def deploy_implementation_and_data_for_host_with_server(self, server_id):
-        server = list(filter(lambda x: x.id == server_id, self.__servers.values()))[0]
-        host = list(filter(lambda x: x.id == server.host_id, self.__hosts.values()))[0]
-        servers = [server for server in self.__servers.values() if server.host_id == host.id]
+        server = self.__servers[server_id]
+        host = self.__hosts[server.host_id]
+        servers = self.get_servers_for_host(host.id)
         psi_ops_deploy.deploy_implementation(
             host,
             servers,
@@ -4382,7 +4818,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
     def deploy_implementation_and_data_for_propagation_channel(self, propagation_channel_name):
         propagation_channel = self.get_propagation_channel_by_name(propagation_channel_name)
-        servers = [server for server in self.__servers.values() if server.propagation_channel_id == propagation_channel.id]
+        servers = self.get_servers_for_propagation_channel(propagation_channel.id)
         for server in servers:
             self.deploy_implementation_and_data_for_host_with_server(server.id)
 
@@ -4543,12 +4979,91 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             self.__deploy_data_required_for_all = True
 
     def __get_encoded_server_entry(self, server):
+        return self.__get_encoded_server_entries([server])[0]
+
+    def __get_encoded_server_entries(self, servers):
+        # Encoding and signing a server entry is expensive and deploys encode
+        # each server many times, for every build, server list and host
+        # data. Entries are cached until any of their inputs change, and the
+        # entries missing from the cache are signed as one batch.
+        #
+        # The meek fronting addresses and hosts are randomly selected once per
+        # cached entry, so all server lists in a session carry the same
+        # selection for a server; a new selection is made when the candidates
+        # change or the network is next loaded.
+        if self.__encoded_server_entry_cache is None:
+            self.__encoded_server_entry_cache = {}
+        encoded_server_entries = []
+        missing = []
+        for server in servers:
+            host = self.__hosts[server.host_id]
+            fingerprint = self.__get_encoded_server_entry_fingerprint(server, host)
+            cached = self.__encoded_server_entry_cache.get(server.id)
+            if cached and cached[0] == fingerprint:
+                encoded_server_entries.append(cached[1])
+                continue
+            meek_fronting_addresses, meek_fronting_hosts = self.__select_meek_fronting_for_host(host)
+            encoded_server_entries.append(
+                self.__encode_server_entry(server, host, meek_fronting_addresses, meek_fronting_hosts))
+            missing.append((len(encoded_server_entries) - 1, server.id, fingerprint))
+
+        # The following server entries will be signed, once server_entry_signing_key_pair is initialized:
+        # entries embedded in client builds; entries paved into remote and obfuscated server lists; entries
+        # used in test_server; discovery entries paved into psinet for psiphond.
+        #
+        # The following will _not_ be signed: discovery entries issued by legacy, psi_web-based servers.
+
+        if missing and self.__server_entry_signing_key_pair != None:
+            signed_server_entries = self.sign_encoded_server_entries(
+                [encoded_server_entries[index] for index, _, _ in missing])
+            for (index, _, _), signed_server_entry in zip(missing, signed_server_entries):
+                encoded_server_entries[index] = signed_server_entry
+
+        for index, server_id, fingerprint in missing:
+            self.__encoded_server_entry_cache[server_id] = (fingerprint, encoded_server_entries[index])
+        return encoded_server_entries
+
+    def __get_encoded_server_entry_fingerprint(self, server, host):
+        # Logs are the only fields that don't contribute to the server entry
+        def fields(record):
+            return [(name, getattr(record, name, None)) for name in record.__slots__ if name != 'logs']
+
+        fronting_domain = host.meek_server_fronting_domain
+        fronting_inputs = None
+        if fronting_domain:
+            fronting_inputs = (sorted(self.__alternate_meek_fronting_addresses.get(fronting_domain, [])),
+                               self.__alternate_meek_fronting_addresses_regex.get(fronting_domain, ''),
+                               self.__meek_fronting_disable_SNI.get(fronting_domain, False))
+        return hashlib.sha1(pickle.dumps(
+            (fields(server),
+             fields(host),
+             fronting_inputs,
+             self.__server_entry_signing_key_pair))).digest()
+
+    def __select_meek_fronting_for_host(self, host):
+        meek_fronting_addresses = None
+        if host.meek_server_fronting_domain:
+            # Copy the set to avoid shuffling the original
+            alternate_meek_fronting_addresses = list(self.__alternate_meek_fronting_addresses[host.meek_server_fronting_domain])
+            if len(alternate_meek_fronting_addresses) > 0:
+                random.shuffle(alternate_meek_fronting_addresses)
+                meek_fronting_addresses = alternate_meek_fronting_addresses[:3]
+
+        meek_fronting_hosts = None
+        if host.alternate_meek_server_fronting_hosts:
+            # Copy the set to avoid shuffling the original
+            alternate_meek_server_fronting_hosts = list(host.alternate_meek_server_fronting_hosts)
+            random.shuffle(alternate_meek_server_fronting_hosts)
+            meek_fronting_hosts = alternate_meek_server_fronting_hosts[:3]
+
+        return meek_fronting_addresses, meek_fronting_hosts
+
+    def __encode_server_entry(self, server, host, meek_fronting_addresses, meek_fronting_hosts):
 
         # TCS web server certificate has PEM headers and newlines, so strip those now
         # for legacy format compatibility
         web_server_certificate = server.web_server_certificate
-        host = self.get_host_for_server(server)
-        if host and host.is_TCS:
+        if host.is_TCS:
             web_server_certificate = ''.join(server.web_server_certificate.split('\n')[1:-2])
 
         # Double-check that we're not giving our blank server credentials
@@ -4631,7 +5146,6 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         if server.ssh_obfuscated_conjure_port:
             extended_config['sshObfuscatedConjurePort'] = int(server.ssh_obfuscated_conjure_port)
 
-        host = self.__hosts[server.host_id]
         extended_config['region'] = host.region
 
         server_capabilities = copy_server_capabilities(server.capabilities) if server.capabilities else None
@@ -4651,20 +5165,14 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             extended_config['meekCookieEncryptionPublicKey'] = host.meek_cookie_encryption_public_key
 
         if host.meek_server_fronting_domain:
-            # Copy the set to avoid shuffling the original
-            alternate_meek_fronting_addresses = list(self.__alternate_meek_fronting_addresses[host.meek_server_fronting_domain])
-            if len(alternate_meek_fronting_addresses) > 0:
-                random.shuffle(alternate_meek_fronting_addresses)
-                extended_config['meekFrontingAddresses'] = alternate_meek_fronting_addresses[:3]
+            if meek_fronting_addresses:
+                extended_config['meekFrontingAddresses'] = meek_fronting_addresses
 
             extended_config['meekFrontingAddressesRegex'] = self.__alternate_meek_fronting_addresses_regex[host.meek_server_fronting_domain]
             extended_config['meekFrontingDisableSNI'] = self.__meek_fronting_disable_SNI[host.meek_server_fronting_domain]
 
-        if host.alternate_meek_server_fronting_hosts:
-            # Copy the set to avoid shuffling the original
-            alternate_meek_server_fronting_hosts = list(host.alternate_meek_server_fronting_hosts)
-            random.shuffle(alternate_meek_server_fronting_hosts)
-            extended_config['meekFrontingHosts'] = alternate_meek_server_fronting_hosts[:3]
+        if meek_fronting_hosts:
+            extended_config['meekFrontingHosts'] = meek_fronting_hosts
             if server_capabilities['FRONTED-MEEK']:
                 server_capabilities['FRONTED-MEEK-HTTP'] = True
 
@@ -4741,15 +5249,6 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                     prefix_web_server_certificate,
                                     json.dumps(extended_config)).encode()).decode()
 
-        # The following server entries will be signed, once server_entry_signing_key_pair is initialized:
-        # entries embedded in client builds; entries paved into remote and obfuscated server lists; entries
-        # used in test_server; discovery entries paved into psinet for psiphond.
-        #
-        # The following will _not_ be signed: discovery entries issued by legacy, psi_web-based servers.
-
-        if self.__server_entry_signing_key_pair != None:
-            encoded_server_entry = self.sign_encoded_server_entry(encoded_server_entry)
-
         return encoded_server_entry
 
     def sign_encoded_server_entry(self, encoded_server_entry):
@@ -4760,7 +5259,28 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         env = {'SIGNER_PUBLIC_KEY': str(self.__server_entry_signing_key_pair[0]),
                'SIGNER_PRIVATE_KEY': str(self.__server_entry_signing_key_pair[1]),
                'SIGNER_SERVER_ENTRY': encoded_server_entry}
-        return subprocess.Popen(args, env=env, stdout=subprocess.PIPE).communicate()[0].decode().strip()
+        proc = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = proc.communicate()
+        signed_server_entry = output.decode().strip()
+        # An unsigned or empty entry must never be cached or published
+        if proc.returncode != 0 or not signed_server_entry:
+            raise Exception('server-entry-signer failed (%s): %s' % (proc.returncode, error.decode().strip()))
+        return signed_server_entry
+
+    def sign_encoded_server_entries(self, encoded_server_entries, pool_size=None):
+        # The signer signs one entry per invocation, so batches are signed by
+        # running up to pool_size signer processes concurrently
+        if pool_size is None:
+            pool_size = SERVER_ENTRY_SIGNER_POOL_SIZE
+        if len(encoded_server_entries) <= 1 or pool_size <= 1:
+            return [self.sign_encoded_server_entry(encoded_server_entry)
+                    for encoded_server_entry in encoded_server_entries]
+        pool = ThreadPool(min(pool_size, len(encoded_server_entries)))
+        try:
+            return pool.map(self.sign_encoded_server_entry, encoded_server_entries)
+        finally:
+            pool.close()
+            pool.join()
 
     def __get_encoded_server_list(self, propagation_channel_id,
                                   client_ip_address_strategy_value=None, event_logger=None, discovery_date=None, test=False, include_propagation_servers=True, client_platform=None):
@@ -4777,6 +5297,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             else:
                 permanent_server_ids = permanent_server_ids[0:400]
 
+            permanent_server_ids = set(permanent_server_ids)
             servers = [server for server in self.__servers.values()
                        if (server.propagation_channel_id == propagation_channel_id and
                            (server.is_permanent or (server.is_embedded and include_propagation_servers)))
@@ -4792,17 +5313,18 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             # do not, making more discovery servers more broadly available and feeding into
             # the following discovery strategies.
 
-            candidate_servers = [server for server in self.__servers.values()
-                                 if server.discovery_date_range is not None and
-                                 server.discovery_date_range[0] <= discovery_date < server.discovery_date_range[1]]
+            # The candidates and their discovery buckets are precomputed for
+            # each period in which the set of discoverable servers is constant.
 
-            servers = psi_ops_discovery.select_servers(candidate_servers, client_ip_address_strategy_value)
+            servers = psi_ops_discovery.select_server_from_buckets(
+                self.__get_date_range_indexes()['discovery'].in_range_buckets(discovery_date),
+                client_ip_address_strategy_value)
 
         # optional logger (used by server to log each server IP address disclosed)
         if event_logger:
             for server in servers:
                 event_logger(server.ip_address)
-        return ([self.__get_encoded_server_entry(server) for server in servers],
+        return (self.__get_encoded_server_entries(servers),
                 [server.egress_ip_address for server in servers])
 
     def __get_sponsor_home_pages(self, sponsor_id, region, client_platform):
@@ -4897,8 +5419,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         # SSH Session ID is a randomly generated unique ID used for
         # client-side session duration reporting
         #
-        server = next(server for server in self.__servers.values()
-                      if server.internal_ip_address == server_ip_address)
+        server = next(iter(self.__get_indexed_servers('internal_ip_address', server_ip_address)))
 
         config['ssh_username'] = server.ssh_username
         config['ssh_password'] = server.ssh_password
@@ -4942,13 +5463,19 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         return config
 
     def get_host_by_provider_id(self, provider_id):
-        for host in self.__hosts.values():
-            if host.provider_id and host.provider_id == provider_id:
-                return host
+        index = self.__get_indexes()['host_provider_id']
+        if provider_id and provider_id in index:
+            return next(iter(index[provider_id].values()))
 
     def get_host_for_server(self, server):
         return self.__hosts[server.host_id]
 
+    def get_servers_for_host(self, host_id):
+        return self.__get_indexed_servers('host_id', host_id)
+
+    def get_servers_for_propagation_channel(self, propagation_channel_id):
+        return self.__get_indexed_servers('propagation_channel_id', propagation_channel_id)
+
     def get_hosts(self):
         return list(self.__hosts.values())
 
@@ -4958,7 +5485,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
     def get_servers_newer_than(self, newer_than_datetime=datetime.datetime.now()-datetime.timedelta(days=1)):
         # This only take datetime object for the time or default to 1 day ago
         # Use datetime.datetime(2024, 03, 17, 0, 30, 0, 0) to generate datetime object
-        return [server for server in self.__servers.values() if [log for log in server.logs if 'created' in log][0][0] > newer_than_datetime]
+        return [server for server in self.__servers.values() if [log for log in self.__get_record_logs(server) if 'created' in log][0][0] > newer_than_datetime]
 
     def get_propagation_channels(self):
         return list(self.__propagation_channels.values())
@@ -5254,13 +5781,13 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             valid_server_entry_tags[tag] = True
 
         discovery_servers = []
-        for server in self.__servers.values():
-            if server.discovery_date_range and server.discovery_date_range[1] > discovery_date:
-                discovery_server = {
-                    "discovery_date_range": [server.discovery_date_range[0], server.discovery_date_range[1]],
-                    "encoded_server_entry": self.__get_encoded_server_entry(server)
-                }
-                discovery_servers.append(discovery_server)
+        servers = self.__get_date_range_indexes()['discovery'].ending_after(discovery_date)
+        for server, encoded_server_entry in zip(servers, self.__get_encoded_server_entries(servers)):
+            discovery_server = {
+                "discovery_date_range": [server.discovery_date_range[0], server.discovery_date_range[1]],
+                "encoded_server_entry": encoded_server_entry
+            }
+            discovery_servers.append(discovery_server)
 
         return json.dumps({
             "client_versions": copy.__client_versions,
@@ -5273,9 +5800,9 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
     def __get_own_encoded_server_entries_for_host(self, host_id):
         own_encoded_server_entries = {}
-        for server in self.__servers.values():
-            if server.host_id == host_id:
-                own_encoded_server_entries[self.__get_server_tag(server)] = self.__get_encoded_server_entry(server)
+        servers = self.get_servers_for_host(host_id)
+        for server, encoded_server_entry in zip(servers, self.__get_encoded_server_entries(servers)):
+            own_encoded_server_entries[self.__get_server_tag(server)] = encoded_server_entry
         return own_encoded_server_entries
 
     def __compartmentalize_data_for_devops_server(self):
@@ -5329,7 +5856,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                             None, # Omit: host.inproxy_proxy_public_key
                                             host.run_packet_manipulator
                                             )
-            copy.__hosts[host.id].logs = host.logs
+            copy.__hosts[host.id].logs = self.__get_record_logs(host)
 
         for server in self.__servers.values():
             copy.__servers[server.id] = Server(
@@ -5365,7 +5892,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                             server.shadowsocks_key,
                                             server.alternate_ssh_obfuscated_ports)
                                             # Omit: propagation, web server, ssh info, version
-            copy.__servers[server.id].logs = server.logs
+            copy.__servers[server.id].logs = self.__get_record_logs(server)
 
         for deleted_server in self.__deleted_servers.values():
             copy.__deleted_servers[deleted_server.id] = Server(
@@ -5380,7 +5907,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                             '', # Omit: deleted_server.discovery_date_range,
                                             deleted_server.capabilities)
                                             # Omit: propagation, web server, ssh info, version
-            copy.__deleted_servers[deleted_server.id].logs = deleted_server.logs
+            copy.__deleted_servers[deleted_server.id].logs = self.__get_record_logs(deleted_server)
 
         for propagation_channel in self.__propagation_channels.values():
             copy.__propagation_channels[propagation_channel.id] = PropagationChannel(
@@ -5471,7 +5998,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                             None, # Omit: host.inproxy_proxy_public_key
                                             host.run_packet_manipulator
                                             )
-            copy.__hosts[host.id].logs = host.logs
+            copy.__hosts[host.id].logs = self.__get_record_logs(host)
 
         for server in self.__servers.values():
             copy.__servers[server.id] = Server(
@@ -5487,7 +6014,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                             server.capabilities)
                                             # Omit: propagation, web server, ssh info, version
             copy.__servers[server.id].osl_discovery_date_range = server.osl_discovery_date_range
-            copy.__servers[server.id].logs = server.logs
+            copy.__servers[server.id].logs = self.__get_record_logs(server)
 
         for deleted_server in self.__deleted_servers.values():
             copy.__deleted_servers[deleted_server.id] = Server(
@@ -5502,7 +6029,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                             '', # Omit: deleted_server.discovery_date_range,
                                             deleted_server.capabilities)
                                             # Omit: propagation, web server, ssh info, version
-            copy.__deleted_servers[deleted_server.id].logs = deleted_server.logs
+            copy.__deleted_servers[deleted_server.id].logs = self.__get_record_logs(deleted_server)
 
         for propagation_channel in self.__propagation_channels.values():
             copy.__propagation_channels[propagation_channel.id] = PropagationChannel(
@@ -5558,11 +6085,11 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
     def run_command_on_hosts(self, command):
 
-        @psi_ops_deploy.retry_decorator_returning_exception
         def do_run_command_on_host(host):
             self.run_command_on_host(host, command)
 
-        psi_ops_deploy.run_in_parallel(20, do_run_command_on_host, self.__hosts.values())
+        psi_ops_deploy.run_in_parallel(20, do_run_command_on_host, self.__hosts.values(),
+                                       attempts=psi_ops_deploy.DEPLOY_ATTEMPTS)
 
     def copy_file_from_host(self, host, remote_source_filename, local_destination_filename):
         ssh = psi_ssh.SSH(
@@ -5582,22 +6109,24 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
     def copy_file_to_hosts(self, source_filename, dest_filename):
 
-        @psi_ops_deploy.retry_decorator_returning_exception
         def do_copy_file_to_host(host):
             self.copy_file_to_host(host, source_filename, dest_filename)
 
-        psi_ops_deploy.run_in_parallel(50, do_copy_file_to_host, self.__hosts.values())
+        psi_ops_deploy.run_in_parallel(50, do_copy_file_to_host, self.__hosts.values(),
+                                       attempts=psi_ops_deploy.DEPLOY_ATTEMPTS)
 
     def swap_host_ip_address(self, host, new_ip_address):
         assert(self.is_locked)
         if type(host) == str:
             host = self.__hosts[host]
-        server = [s for s in self.get_servers() if s.host_id == host.id][0]
+        server = self.get_servers_for_host(host.id)[0]
         try:
+            self.__unindex_server(server)
             host.ip_address = new_ip_address
             server.ip_address = new_ip_address
             server.egress_ip_address = new_ip_address
             server.internal_ip_address = new_ip_address
+            self.__index_server(server)
             self.reinstall_host(host.id)
         except:
             pass
@@ -5613,6 +6142,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
             deleted_server.log('restored')
 
             # Clean up old Deleted log
+            self.__restore_record_logs(deleted_server)
             for log in copy.copy(deleted_host.logs):
                 if 'deleted' in log[1]:
                     deleted_host.logs.remove(log)
@@ -5621,8 +6151,10 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                     deleted_server.logs.remove(log)
 
             self.__hosts[deleted_host.id] = deleted_host
+            self.__index_host(deleted_host)
             self.__deleted_hosts.remove(deleted_host)
             self.__servers[deleted_server.id] = self.__deleted_servers.pop(deleted_server.id)
+            self.__index_server(deleted_server)
         except:
             pass
 
@@ -5631,7 +6163,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
 
         host = self.__hosts[server.host_id]
         egress_ip_addresses = list(set([server.egress_ip_address] +
-                                        [s.ip_address for s in self.get_servers() if s.host_id == host.id] +
+                                        [s.ip_address for s in self.get_servers_for_host(host.id)] +
                                         [host.ip_address]))
 
         if sys.platform in ['win32', 'cygwin']:
@@ -5666,6 +6198,43 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                     executable_path=os.path.join(os.path.abspath('.'), 'secrets', 'tunnel-core', 'psiphon-tunnel-core'),
                                     config_file=os.path.join(os.path.abspath('.'), 'secrets', 'tunnel-core', 'psiphon-tunnel-core.config'))
 
+    def __test_servers_with_tunnel_core(self, servers, test_cases, test_propagation_channel_id):
+        server_tests = []
+        for server in servers:
+            host = self.__hosts[server.host_id]
+            egress_ip_addresses = list(set([server.egress_ip_address] +
+                                            [s.ip_address for s in self.get_servers_for_host(host.id)] +
+                                            [host.ip_address]))
+            server_tests.append((server, host, self.__get_encoded_server_entry(server), egress_ip_addresses))
+
+        return psi_ops_test_tunnel_core.test_servers(
+                                server_tests,
+                                self.__split_tunnel_url_format(),
+                                self.__split_tunnel_signature_public_key(),
+                                self.__split_tunnel_dns_server(),
+                                test_propagation_channel_id,
+                                test_sponsor_id='0000000000000000',
+                                client_platform='',
+                                client_version='',
+                                use_indistinguishable_tls=True,
+                                test_cases=test_cases,
+                                executable_path=os.path.join(os.path.abspath('.'), 'secrets', 'tunnel-core', 'psiphon-tunnel-core'))
+
+    def __print_test_metrics(self, results):
+        # Median tunnel-core metrics for each protocol
+        protocol_metrics = defaultdict(lambda: defaultdict(list))
+        for result in results.values():
+            for test_case, test_result in result.items():
+                if not isinstance(test_result, dict):
+                    continue
+                for metric in ('connect_seconds', 'latency_seconds', 'throughput_bytes_per_second'):
+                    if test_result.get(metric) is not None:
+                        protocol_metrics[test_case][metric].append(test_result[metric])
+        for test_case in sorted(protocol_metrics):
+            sys.stderr.write('%-36s %s\n' % (test_case, ', '.join(
+                '%s %g (median of %d)' % (metric, sorted(values)[len(values) // 2], len(values))
+                for metric, values in sorted(protocol_metrics[test_case].items()))))
+
     def __test_servers(self, servers, test_cases, build_with_embedded_servers=False):
         results = {}
         passes = 0
@@ -5719,23 +6288,28 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                                     '',         # additional_parameters
                                     False)      # test
 
-        for server in servers:
-            result = self.__test_server(server, test_cases, version, test_propagation_channel_id, executable_path)
-            results[server.id] = result
-            for test_result in result.values():
-                if 'FAIL' in test_result:
-                    servers_with_errors.add(server.id)
-                    break
-        # One final pass to re-test servers that failed
-        for server_id in servers_with_errors:
-            server = self.__servers[server_id]
-            result = self.__test_server(server, test_cases, version, test_propagation_channel_id, executable_path)
-            results[server.id] = result
+        if sys.platform in ['win32', 'cygwin']:
+            for server in servers:
+                result = self.__test_server(server, test_cases, version, test_propagation_channel_id, executable_path)
+                results[server.id] = result
+                for test_result in result.values():
+                    if 'FAIL' in test_result:
+                        servers_with_errors.add(server.id)
+                        break
+            # One final pass to re-test servers that failed
+            for server_id in servers_with_errors:
+                server = self.__servers[server_id]
+                result = self.__test_server(server, test_cases, version, test_propagation_channel_id, executable_path)
+                results[server.id] = result
+        else:
+            # The harness tests all servers concurrently, and retries failed
+            # test cases itself
+            results = self.__test_servers_with_tunnel_core(servers, test_cases, test_propagation_channel_id)
         # Process results
         servers_with_errors.clear()
         for server_id, result in results.items():
             for test_result in result.values():
-                if 'FAIL' in test_result:
+                if psi_ops_test_tunnel_core.is_test_result_failure(test_result):
                     failures += 1
                     servers_with_errors.add(server_id)
                 else:
@@ -5744,6 +6318,7 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
                 pprint.pprint((server_id, result), stream=sys.stderr)
             else:
                 pprint.pprint((server_id, result))
+        self.__print_test_metrics(results)
         sys.stderr.write('servers tested:      %d\n' % (len(servers),))
         sys.stderr.write('servers with errors: %d\n' % (len(servers_with_errors),))
         sys.stderr.write('tests passed:        %d\n' % (passes,))
@@ -5764,12 +6339,12 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         if not host_id in self.__hosts:
             print('Host "%s" not found' % (host_id,))
         else:
-            servers = [server for server in self.__servers.values() if server.host_id == host_id and server.propagation_channel_id != None]
+            servers = [server for server in self.get_servers_for_host(host_id) if server.propagation_channel_id != None]
             self.__test_servers(servers, test_cases)
 
     def test_propagation_channel(self, propagation_channel_name, test_cases=None):
         propagation_channel = self.get_propagation_channel_by_name(propagation_channel_name)
-        servers = [server for server in self.__servers.values() if server.propagation_channel_id == propagation_channel.id]
+        servers = self.get_servers_for_propagation_channel(propagation_channel.id)
         self.__test_servers(servers, test_cases)
 
     def test_sponsor(self, sponsor_name, test_cases=None):
@@ -5797,10 +6372,11 @@ class PsiphonNetwork(psi_ops_cms.PersistentObject):
         for host_user_count in sorted_users_on_host:
             print(host_user_count[1])
 
-    def save(self):
+    def save(self, compact=False):
         assert(self.is_locked)
         print('saving...')
-        super(PsiphonNetwork, self).save()
+        self.__flush_record_logs()
+        super(PsiphonNetwork, self).save(compact)
 
     def reload(self):
         print('reloading...')
@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import atexit
 import os
 import sys
 import subprocess
@@ -24,12 +25,21 @@ import shlex
 import tempfile
 import jsonpickle
 import getpass
+import json
+import pickle
+import hashlib
+import binascii
+import struct
+import datetime
 
 #==============================================================================
 
 
 PSI_OPS_ROOT = os.path.abspath(os.path.join('..', 'Data', 'PsiOps'))
 PSI_OPS_DB_FILENAME = os.path.join(PSI_OPS_ROOT, 'psi_ops.dat')
+PSI_OPS_JOURNAL_SUFFIX = '.journal'
+PSI_OPS_BINARY_SNAPSHOT_SUFFIX = '.bin'
+PSI_OPS_LOGS_SUFFIX = '.logs'
 
 
 if os.path.isfile('psi_data_config.py'):
@@ -86,7 +96,15 @@ def lock_document():
         raise Exception('CipherShare lock failed: ' + str(output))
 
 
-def export_document(dest_filename):
+def journal_document_is_configured():
+    return hasattr(psi_ops_config, 'CIPHERSHARE_PSI_OPS_JOURNAL_DOCUMENT_PATH')
+
+
+def logs_document_is_configured():
+    return hasattr(psi_ops_config, 'CIPHERSHARE_PSI_OPS_LOGS_DOCUMENT_PATH')
+
+
+def export_document(dest_filename, for_journal=False, for_logs=False):
     if sys.platform in ['win32','cygwin']:
         cmd = 'CipherShareScriptingClient.exe'
         # os.remove(dest_filename) is not necessary on windows OS as it will overwrite the psi_ops.db file.
@@ -105,7 +123,9 @@ def export_document(dest_filename):
             psi_ops_config.CIPHERSHARE_DATABASEPATH,
             psi_ops_config.CIPHERSHARE_SERVERHOST,
             psi_ops_config.CIPHERSHARE_SERVERPORT,
-            psi_ops_config.CIPHERSHARE_PSI_OPS_DOCUMENT_PATH,
+            psi_ops_config.CIPHERSHARE_PSI_OPS_JOURNAL_DOCUMENT_PATH if for_journal else
+                psi_ops_config.CIPHERSHARE_PSI_OPS_LOGS_DOCUMENT_PATH if for_logs else
+                psi_ops_config.CIPHERSHARE_PSI_OPS_DOCUMENT_PATH,
             dest_filename)
 
     print("Exporting CipherShare Document...")
@@ -116,7 +136,7 @@ def export_document(dest_filename):
         raise Exception('CipherShare export failed: ' + str(output))
 
 
-def import_document(source_filename, for_stats=False, for_devops=False, for_db=False):
+def import_document(source_filename, for_stats=False, for_devops=False, for_db=False, for_journal=False, for_logs=False):
     cmd = 'CipherShareScriptingClient.exe \
             ImportDocument \
             -UserName %s -Password %s \
@@ -138,13 +158,15 @@ def import_document(source_filename, for_stats=False, for_devops=False, for_db=F
             psi_ops_config.CIPHERSHARE_PSI_OPS_FOR_STATS_DOCUMENT_PATH if for_stats else
                 psi_ops_config.CIPHERSHARE_PSI_OPS_FOR_DEVOPS_DOCUMENT_PATH if for_devops else
                 psi_ops_config.CIPHERSHARE_PSI_OPS_FOR_DB_DOCUMENT_PATH if for_db else
+                psi_ops_config.CIPHERSHARE_PSI_OPS_JOURNAL_DOCUMENT_PATH if for_journal else
+                psi_ops_config.CIPHERSHARE_PSI_OPS_LOGS_DOCUMENT_PATH if for_logs else
                 psi_ops_config.CIPHERSHARE_PSI_OPS_DOCUMENT_PATH,
             psi_ops_config.CIPHERSHARE_STATS_SHAREGROUP if for_stats else
                 psi_ops_config.CIPHERSHARE_DEVOPS_SHAREGROUP if for_devops else
                 psi_ops_config.CIPHERSHARE_DB_SHAREGROUP if for_db else
                 psi_ops_config.CIPHERSHARE_SHAREGROUP,
             psi_ops_config.CIPHERSHARE_PSI_OPS_DOCUMENT_DESCRIPTION,
-            '' if for_stats or for_devops or for_db else '-KeepLocked')
+            '' if for_stats or for_devops or for_db or for_journal or for_logs else '-KeepLocked')
 
     proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     output = proc.communicate()
@@ -184,6 +206,234 @@ def delete_document(for_stats=False, for_devops=False, for_db=False):
             raise Exception('CipherShare delete failed: ' + output)
 
 
+# A binary snapshot is a pickled copy of a jsonpickle document, written next
+# to it and keyed by the document's digest. The record collections are
+# pickled into separate sections which are only unpickled on first access, so
+# read-only tools don't pay for collections they never use.
+#
+# Layout: magic, 4 byte header length, JSON header, section data. The header
+# holds the source document digest, a digest of the section data, and the
+# offset and length of each section.
+#
+# The snapshot is only a cache: a missing, stale or damaged snapshot is
+# ignored and rewritten from the jsonpickle document.
+
+BINARY_SNAPSHOT_MAGIC = b'PSIOPSBIN1\n'
+
+
+class BinarySnapshotSections(object):
+
+    def __init__(self, data, sections):
+        self.data = data
+        self.sections = sections
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def names(self):
+        return list(self.sections.keys())
+
+    def load(self, name):
+        offset, length = self.sections.pop(name)
+        value = pickle.loads(self.data[offset:offset + length])
+        if not self.sections:
+            # Release the raw data once every section has been unpickled
+            self.data = None
+        return value
+
+
+def write_binary_snapshot(filename, source_digest, obj_class, state, section_names):
+    core = {}
+    sections = []
+    for name, value in state.items():
+        if name in section_names:
+            sections.append((name, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        else:
+            core[name] = value
+    sections.insert(0, ('', pickle.dumps((obj_class, core), pickle.HIGHEST_PROTOCOL)))
+    header = {'source_digest': source_digest, 'sections': []}
+    data_digest = hashlib.sha1()
+    offset = 0
+    for name, data in sections:
+        header['sections'].append([name, offset, len(data)])
+        data_digest.update(data)
+        offset += len(data)
+    header['data_digest'] = data_digest.hexdigest()
+    header = json.dumps(header).encode()
+    # Write to a temporary file and rename so that readers never see a partial
+    # snapshot
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as file:
+        file.write(BINARY_SNAPSHOT_MAGIC)
+        file.write(struct.pack('>I', len(header)))
+        file.write(header)
+        for _, data in sections:
+            file.write(data)
+    os.replace(temp_filename, filename)
+
+
+def read_binary_snapshot(filename, source_digest):
+    # Returns the object class, the core state and the lazily loaded sections,
+    # or None if there is no usable snapshot of the source document. A
+    # damaged snapshot is removed.
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as file:
+        data = file.read()
+    try:
+        return _parse_binary_snapshot(data, source_digest)
+    except (ValueError, KeyError, TypeError, IndexError, EOFError, AttributeError, ImportError,
+            struct.error, pickle.UnpicklingError) as e:
+        print('Ignoring damaged binary snapshot %s: %s' % (filename, str(e)))
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        return None
+
+
+def _parse_binary_snapshot(data, source_digest):
+    if not data.startswith(BINARY_SNAPSHOT_MAGIC):
+        raise ValueError('bad magic')
+    position = len(BINARY_SNAPSHOT_MAGIC)
+    header_length, = struct.unpack('>I', data[position:position + 4])
+    position += 4
+    if position + header_length > len(data):
+        raise ValueError('truncated header')
+    header = json.loads(data[position:position + header_length].decode())
+    if header['source_digest'] != source_digest:
+        return None
+    data = memoryview(data)[position + header_length:]
+    # Sections are unpickled lazily, so check now that the data is whole
+    sections = dict((name, (offset, length)) for name, offset, length in header['sections'])
+    if sum(length for _, length in sections.values()) != len(data):
+        raise ValueError('truncated sections')
+    if hashlib.sha1(data).hexdigest() != header['data_digest']:
+        raise ValueError('section data digest mismatch')
+    offset, length = sections.pop('')
+    obj_class, core = pickle.loads(data[offset:offset + length])
+    return obj_class, core, BinarySnapshotSections(data, sections)
+
+
+# Record change logs are kept out of the document, in an append-only log
+# store: a file next to the document, or with CipherShare, a separate logs
+# document.
+#
+# Each line is "<key>\t<timestamp>\t<JSON message>", where key identifies the
+# record, like "Host:<id>". A line with no timestamp and message discards the
+# key's earlier logs. The offsets of each key's lines are indexed on the first
+# read, so tools that never read logs never read the store.
+
+class RecordLogStore(object):
+
+    def __init__(self, filename=None):
+        # Without a filename, the store is the CipherShare logs document,
+        # exported to a temporary file on first use
+        self.filename = filename
+        self.is_document = filename is None
+        self.index = None
+
+    def __get_filename(self):
+        if self.filename is None:
+            with tempfile.NamedTemporaryFile(delete=False) as file:
+                pass
+            try:
+                export_document(file.name, for_logs=True)
+            except Exception as e:
+                # The logs document doesn't exist until logs are first saved.
+                # Otherwise saving logs would replace the stored ones.
+                if 'No matching document found' not in str(e):
+                    raise
+                open(file.name, 'wb').close()
+            atexit.register(os.remove, file.name)
+            self.filename = file.name
+        return self.filename
+
+    def __get_index(self):
+        if self.index is None:
+            index = {}
+            filename = self.__get_filename()
+            if os.path.isfile(filename):
+                offset = 0
+                with open(filename, 'rb') as file:
+                    for line in file:
+                        # A line without a newline is from an interrupted append
+                        if line.endswith(b'\n'):
+                            key, timestamp, _ = line.split(b'\t', 2)
+                            if timestamp:
+                                index.setdefault(key.decode(), []).append(offset)
+                            else:
+                                index.pop(key.decode(), None)
+                        offset += len(line)
+            self.index = index
+        return self.index
+
+    def get(self, key):
+        # Returns the key's logs, as a list of (datetime, message)
+        offsets = self.__get_index().get(key)
+        if not offsets:
+            return []
+        logs = []
+        with open(self.filename, 'rb') as file:
+            for offset in offsets:
+                file.seek(offset)
+                _, timestamp, message = file.readline().decode().rstrip('\n').split('\t', 2)
+                layout = '%Y-%m-%dT%H:%M:%S.%f' if '.' in timestamp else '%Y-%m-%dT%H:%M:%S'
+                logs.append((datetime.datetime.strptime(timestamp, layout), json.loads(message)))
+        return logs
+
+    def append(self, entries):
+        # entries is a list of (key, datetime, message). A None datetime and
+        # message discards the key's earlier logs.
+        if not entries:
+            return
+        filename = self.__get_filename()
+        with open(filename, 'ab'):
+            pass
+        with open(filename, 'r+b') as file:
+            offset = _truncate_partial_line(file)
+            for key, timestamp, message in entries:
+                if timestamp is None:
+                    line = '%s\t\t\n' % (key,)
+                    if self.index is not None:
+                        self.index.pop(key, None)
+                else:
+                    line = '%s\t%s\t%s\n' % (key, timestamp.isoformat(), json.dumps(message))
+                    if self.index is not None:
+                        self.index.setdefault(key, []).append(offset)
+                line = line.encode()
+                file.write(line)
+                offset += len(line)
+            file.flush()
+            os.fsync(file.fileno())
+        if self.is_document:
+            # CipherShare stores whole documents, so the complete store is
+            # imported as a new version of the logs document
+            import_document(filename, for_logs=True)
+
+
+def _truncate_partial_line(file):
+    # Removes any partial line left at the end of the file by an interrupted
+    # append, and returns the new end of the file
+    file.seek(0, os.SEEK_END)
+    end = file.tell()
+    position = end
+    while position > 0:
+        size = min(65536, position)
+        position -= size
+        file.seek(position)
+        data = file.read(size)
+        newline = data.rfind(b'\n')
+        if newline >= 0:
+            end = position + newline + 1
+            break
+    else:
+        end = 0
+    file.seek(end)
+    file.truncate()
+    return end
+
+
 # Adapted from:
 # http://code.activestate.com/recipes/521901-upgradable-pickles/
 
@@ -191,9 +441,58 @@ class PersistentObject(object):
 
     class_version = '0.0'
 
+    # Attributes holding state that is derived from the persistent state,
+    # such as lookup indexes. These are omitted when the object is serialized
+    # and are recreated by initialize_transient_state() after loading.
+    transient_attributes = ()
+
+    # Record collections (dicts or lists of records) whose changes are saved
+    # incrementally, one record at a time, to an append-only journal. All
+    # other attributes are saved as a single unit whenever any of them change.
+    # save() appends to the journal until it grows past the compaction
+    # threshold, then writes a full snapshot and starts a new, empty journal.
+    # These collections are also the lazily loaded binary snapshot sections.
+    journaled_attributes = ()
+    journal_compaction_threshold = 8 * 1024 * 1024
+
     def __init__(self):
         self.version = self.__class__.class_version
         self.is_locked = False
+        self.journal_id = None
+        self._journal = None
+        self._log_store = None
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails, which is how collections that
+        # haven't been unpickled from a binary snapshot are loaded on demand
+        sections = self.__dict__.get('_binary_snapshot_sections')
+        if sections is not None and name in sections:
+            value = sections.load(name)
+            self.__dict__[name] = value
+            return value
+        raise AttributeError(name)
+
+    def __load_binary_snapshot_sections(self):
+        sections = self.__dict__.pop('_binary_snapshot_sections', None)
+        if sections is not None:
+            for name in sections.names():
+                self.__dict__[name] = sections.load(name)
+
+    def __getstate__(self):
+        self.__load_binary_snapshot_sections()
+        state = self.__dict__.copy()
+        for name in self.transient_attributes:
+            state.pop(name, None)
+        state.pop('_journal', None)
+        state.pop('_log_store', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in self.transient_attributes:
+            self.__dict__[name] = None
+        self._journal = None
+        self._log_store = None
 
     def release(self):
         if self.is_locked:
@@ -201,53 +500,259 @@ class PersistentObject(object):
             self.is_locked = False
 
     def save_to_file(self, filename):
+        data = jsonpickle.encode(self)
         with open(filename, 'w') as file:
-            file.write(jsonpickle.encode(self))
+            file.write(data)
+        self.__save_binary_snapshot(filename, hashlib.sha1(data.encode()).hexdigest())
+
+    def __save_binary_snapshot(self, filename, source_digest):
+        # The binary snapshot is only a cache, so failing to write it is
+        # not an error
+        try:
+            write_binary_snapshot(filename + PSI_OPS_BINARY_SNAPSHOT_SUFFIX,
+                                  source_digest,
+                                  self.__class__,
+                                  self.__getstate__(),
+                                  self.journaled_attributes)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            print('Failed to write binary snapshot: %s' % (str(e),))
+
+    def save(self, compact=False):
+        fingerprints = self.__take_fingerprints()
+        journal = self._journal
+        if (not compact and
+                fingerprints is not None and
+                journal is not None and
+                journal['fingerprints'] is not None and
+                getattr(self, 'journal_id', None) is not None and
+                journal['size'] < self.journal_compaction_threshold and
+                self.__journal_is_available()):
+            entry = self.__make_journal_entry(journal['fingerprints'], fingerprints)
+            if entry:
+                self.__append_to_journal(json.dumps(entry) + '\n')
+        else:
+            self.__save_snapshot()
+        self._journal['fingerprints'] = fingerprints
 
-    def save(self):
+    def __save_snapshot(self):
+        self.journal_id = binascii.hexlify(os.urandom(8)).decode()
         if not os.path.isfile('psi_data_config.py'):
             self.save_to_file(PSI_OPS_DB_FILENAME)
+            # Journal entries for the previous snapshot are ignored when
+            # loading, so a failure here cannot corrupt the saved state
+            if os.path.isfile(PSI_OPS_DB_FILENAME + PSI_OPS_JOURNAL_SUFFIX):
+                os.remove(PSI_OPS_DB_FILENAME + PSI_OPS_JOURNAL_SUFFIX)
+        else:
+            # NOTE: avoiding saving the object with the is_locked attribute set
+            is_locked = self.is_locked
+            self.is_locked = None
+            try:
+                with tempfile.NamedTemporaryFile(delete=False) as file:
+                    file.write(jsonpickle.encode(self).encode())
+            finally:
+                self.is_locked = is_locked
+            import_document(file.name)
+            os.remove(file.name)
+            if journal_document_is_configured():
+                with tempfile.NamedTemporaryFile(delete=False) as file:
+                    pass
+                import_document(file.name, for_journal=True)
+                os.remove(file.name)
+        self._journal = {'entries': [], 'size': 0, 'fingerprints': None}
+
+    def __journal_is_available(self):
+        return not os.path.isfile('psi_data_config.py') or journal_document_is_configured()
+
+    def __append_to_journal(self, line):
+        self._journal['entries'].append(line)
+        self._journal['size'] += len(line)
+        if not os.path.isfile('psi_data_config.py'):
+            with open(PSI_OPS_DB_FILENAME + PSI_OPS_JOURNAL_SUFFIX, 'a') as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
             return
-        # NOTE: avoiding saving the object with the is_locked attribute set
-        is_locked = self.is_locked
-        self.is_locked = None
-        try:
-            with tempfile.NamedTemporaryFile(delete=False) as file:
-                file.write(jsonpickle.encode(self).encode())
-        finally:
-            self.is_locked = is_locked
-        import_document(file.name)
+        # CipherShare stores whole documents, so the complete journal is
+        # imported as a new version of the journal document
+        with tempfile.NamedTemporaryFile(delete=False) as file:
+            file.write(''.join(self._journal['entries']).encode())
+        import_document(file.name, for_journal=True)
         os.remove(file.name)
 
+    def __iterate_journaled_records(self, state):
+        for name in self.journaled_attributes:
+            collection = state[name]
+            for key, value in collection.items() if isinstance(collection, dict) else enumerate(collection):
+                yield name, key, value
+
+    def __get_unjournaled_state(self, state):
+        return dict((name, value) for name, value in state.items()
+                    if name not in self.journaled_attributes and name != 'is_locked')
+
+    @staticmethod
+    def __fingerprint(value):
+        return hashlib.sha1(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).digest()
+
+    def __take_fingerprints(self):
+        # Pickling is much faster than jsonpickle, so fingerprinting every
+        # record to find the changed ones costs far less than encoding them all.
+        # Returns None if the state can't be fingerprinted, in which case
+        # a full snapshot is saved.
+        try:
+            state = self.__getstate__()
+            fingerprints = dict(((name, key), self.__fingerprint(value))
+                                for name, key, value in self.__iterate_journaled_records(state))
+            fingerprints[None] = self.__fingerprint(self.__get_unjournaled_state(state))
+            return fingerprints
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+
+    def __make_journal_entry(self, previous_fingerprints, fingerprints):
+        state = self.__getstate__()
+        changes = []
+        for name, key, value in self.__iterate_journaled_records(state):
+            if previous_fingerprints.get((name, key)) != fingerprints[(name, key)]:
+                changes.append(['set', name, key, jsonpickle.encode(value)])
+        # Removed list items are always at the tail of the list, so removing
+        # them in descending index order leaves the list consistent
+        removed = [record for record in previous_fingerprints
+                   if record is not None and record not in fingerprints]
+        removed_from_lists = [record for record in removed if isinstance(record[1], int)]
+        removed_from_dicts = [record for record in removed if not isinstance(record[1], int)]
+        for name, key in removed_from_dicts + sorted(removed_from_lists, key=lambda record: record[1], reverse=True):
+            changes.append(['delete', name, key])
+        entry = {}
+        if changes:
+            entry['changes'] = changes
+        if previous_fingerprints[None] != fingerprints[None]:
+            entry['state'] = jsonpickle.encode(self.__get_unjournaled_state(state))
+        if entry:
+            entry['journal_id'] = self.journal_id
+        return entry
+
+    def __apply_journal_entry(self, entry):
+        for change in entry.get('changes', []):
+            collection = self.__dict__[change[1]]
+            key = change[2]
+            if change[0] == 'set':
+                value = jsonpickle.decode(change[3])
+                if isinstance(collection, list) and key == len(collection):
+                    collection.append(value)
+                else:
+                    collection[key] = value
+            elif change[0] == 'delete':
+                del collection[key]
+        if 'state' in entry:
+            self.__dict__.update(jsonpickle.decode(entry['state']))
+
+    def __replay_journal(self, journal_filename):
+        entries = []
+        if journal_filename is None or not os.path.isfile(journal_filename):
+            return entries
+        with open(journal_filename) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A truncated final line is left by an interrupted append
+                    break
+                if entry['journal_id'] != getattr(self, 'journal_id', None):
+                    continue
+                self.__apply_journal_entry(entry)
+                entries.append(line)
+        return entries
+
     @staticmethod
-    def load_from_file(filename):
-        with open(filename) as file:
-            obj = jsonpickle.decode(file.read())
-            if not hasattr(obj, 'version'):
-                obj.version = '0.0'
-            if obj.version != obj.class_version:
-                obj.upgrade()
-            obj.initialize_plugins()
+    def load_from_file(filename, journal_filename=None, use_binary_snapshot=True):
+        if journal_filename is None:
+            journal_filename = filename + PSI_OPS_JOURNAL_SUFFIX
+        with open(filename, 'rb') as file:
+            data = file.read()
+        entries = []
+        obj = None
+        # A journal must be replayed onto fully loaded collections, so the
+        # binary snapshot is only used when there is nothing to replay
+        if (use_binary_snapshot and
+                not (os.path.isfile(journal_filename) and os.path.getsize(journal_filename) > 0)):
+            source_digest = hashlib.sha1(data).hexdigest()
+            snapshot = read_binary_snapshot(filename + PSI_OPS_BINARY_SNAPSHOT_SUFFIX, source_digest)
+            if snapshot is not None:
+                obj_class, core, sections = snapshot
+                obj = obj_class.__new__(obj_class)
+                obj.__setstate__(core)
+                obj.__dict__['_binary_snapshot_sections'] = sections
+            else:
+                obj = jsonpickle.decode(data.decode())
+                obj.__save_binary_snapshot(filename, source_digest)
+        else:
+            obj = jsonpickle.decode(data.decode())
+            entries = obj.__replay_journal(journal_filename)
+        if not hasattr(obj, 'version'):
+            obj.version = '0.0'
+        upgraded = obj.version != obj.class_version
+        if upgraded:
+            obj.upgrade()
+        obj.initialize_transient_state()
+        obj.initialize_plugins()
         obj.is_locked = False
+        obj._log_store = RecordLogStore(filename + PSI_OPS_LOGS_SUFFIX)
+        # After an upgrade the journal can't be replayed onto the un-upgraded
+        # snapshot, so the next save must write a new snapshot
+        obj._journal = None
+        if not upgraded:
+            obj._journal = {'entries': entries,
+                            'size': sum(len(line) for line in entries),
+                            'fingerprints': None}
         return obj
 
     @staticmethod
     def load(lock=True):
         if not os.path.isfile('psi_data_config.py'):
-            return PersistentObject.load_from_file(PSI_OPS_DB_FILENAME)
-        obj = None
-        file = tempfile.NamedTemporaryFile(delete=False)
-        file.close()
-        if lock:
-            lock_document()
-        export_document(file.name)
-        obj = PersistentObject.load_from_file(file.name)
-        os.remove(file.name)
-        obj.is_locked = lock
+            obj = PersistentObject.load_from_file(PSI_OPS_DB_FILENAME)
+        else:
+            obj = None
+            file = tempfile.NamedTemporaryFile(delete=False)
+            file.close()
+            journal_file = None
+            if lock:
+                lock_document()
+            export_document(file.name)
+            if journal_document_is_configured():
+                journal_file = tempfile.NamedTemporaryFile(delete=False)
+                journal_file.close()
+                try:
+                    export_document(journal_file.name, for_journal=True)
+                except Exception as e:
+                    # The journal document doesn't exist until the first
+                    # snapshot is saved with journaling configured. On Linux
+                    # export_document has already removed the file.
+                    if 'No matching document found' not in str(e):
+                        raise
+                    print('Journal document not found, loading snapshot only')
+                    if os.path.isfile(journal_file.name):
+                        os.remove(journal_file.name)
+                    journal_file = None
+            # The exported document is a temporary file, so there is no
+            # point in caching a binary snapshot of it
+            obj = PersistentObject.load_from_file(file.name,
+                                                  journal_file.name if journal_file else None,
+                                                  use_binary_snapshot=False)
+            os.remove(file.name)
+            if journal_file:
+                os.remove(journal_file.name)
+            obj._log_store = RecordLogStore() if logs_document_is_configured() else None
+            obj.is_locked = lock
+        # Only a locked object is saved, so only then is it worth taking the
+        # baseline fingerprints used to find changed records
+        if lock and obj._journal is not None:
+            obj._journal['fingerprints'] = obj.__take_fingerprints()
         return obj
 
     def upgrade(self):
         pass
 
+    def initialize_transient_state(self):
+        pass
+
     def initialize_plugins(self):
         pass
@@ -20,15 +20,20 @@
 import re
 import tempfile
 import os
+import shutil
 import posixpath
 import sys
 import textwrap
 import json
+import gzip
+import hashlib
 import psi_ssh
 import psi_routes
 import psi_ops_install
+import psi_ops_fleet
 import random
-from multiprocessing.pool import ThreadPool
+import socket
+import time
 from functools import wraps
 from time import sleep
 
@@ -87,6 +92,7 @@ TCS_PSINET_FILE_NAME = '/opt/psiphon/psiphond/data/psinet.json'
 TCS_GEOIP_CITY_DATABASE_FILE_NAME = '/usr/local/share/GeoIP/GeoIP2-City.mmdb'
 TCS_GEOIP_ISP_DATABASE_FILE_NAME = '/usr/local/share/GeoIP/GeoIP2-ISP.mmdb'
 TCS_BLOCKLIST_CSV_FILE_NAME = '/opt/psiphon/psiphond/data/blocklist.csv'
+TCS_DATA_MANIFEST_FILE_NAME = '/opt/psiphon/psiphond/data/data-manifest.json'
 
 TCS_DOCKER_WEB_SERVER_PORT = 1025
 TCS_SSH_DOCKER_PORT = 1026
@@ -114,6 +120,19 @@ TCS_PSIPHOND_START_COMMAND = '/opt/psiphon/psiphond_safe_start.sh'
 TCS_PSIPHOND_SAFE_RESTART_COMMAND = '/opt/psiphon/psiphond_safe_start.sh restart'
 
 
+# Attempts per host for fleet-wide deploy operations
+DEPLOY_ATTEMPTS = 5
+
+# psiphond restarts roll across the fleet in waves of at most this many hosts,
+# with at most this fraction (or one host) of any provider or region down at
+# once. Each wave waits until its hosts' tunnel ports accept connections.
+RESTART_WAVE_SIZE = 30
+RESTART_MAX_DOWN_FRACTION = 0.1
+RESTART_READINESS_TIMEOUT_SECONDS = 180
+RESTART_READINESS_POLL_SECONDS = 2
+RESTART_READINESS_CONNECT_TIMEOUT_SECONDS = 5
+
+
 #==============================================================================
 
 
@@ -121,23 +140,50 @@ def retry_decorator_returning_exception(function):
     @wraps(function)
     def wrapper(*args, **kwds):
         raised_exception = None
-        for i in range(5):
+        for i in range(DEPLOY_ATTEMPTS):
             try:
                 function(*args, **kwds)
                 return None
             except Exception as e:
                 print(str(e))
                 raised_exception = e
+                if i < DEPLOY_ATTEMPTS - 1:
+                    sleep(psi_ops_fleet.backoff_delay(i + 1))
         return raised_exception
     return wrapper
 
 
-def run_in_parallel(thread_pool_size, function, arguments):
-    pool = ThreadPool(thread_pool_size)
-    results = pool.map(function, arguments)
+def run_in_parallel(thread_pool_size, function, arguments, attempts=1, max_pool_size=None, deadline_seconds=None):
+    # thread_pool_size is the initial concurrency, which the fleet executor
+    # adapts up to max_pool_size. Failed calls are retried with backoff, up to
+    # attempts in total. Raises the first failure after all calls finish.
+    results = psi_ops_fleet.run_on_fleet(
+        function,
+        arguments,
+        concurrency=thread_pool_size,
+        max_concurrency=max_pool_size or psi_ops_fleet.FLEET_MAX_CONCURRENCY,
+        attempts=attempts,
+        deadline_seconds=deadline_seconds)
+    raise_failures(function, results)
+    return results
+
+
+def raise_failures(function, results):
+    halted_count = 0
+    for result in results:
+        if isinstance(result.exception, psi_ops_fleet.FleetHalted):
+            halted_count += 1
+        elif not result.succeeded:
+            print('%s failed after %d attempts: %s' % (function.__name__, result.attempts, str(result.exception)))
+    if halted_count:
+        print('%s not run on %d remaining items' % (function.__name__, halted_count))
     for result in results:
-        if result:
-            raise result
+        # Functions wrapped by retry_decorator_returning_exception return
+        # their exception
+        if not result.succeeded:
+            raise result.exception
+        if isinstance(result.value, Exception):
+            raise result.value
 
 
 def deploy_implementation(host, servers, own_encoded_server_entries, server_entry_signature_public_key, discovery_strategy_value_hmac_key, plugins, TCS_psiphond_config_values):
@@ -627,7 +673,6 @@ def tunnel_protocol_supports_passthrough(protocol):
 # hosts_and_servers is a list of tuples: [(host, [server, ...]), ...]
 def deploy_implementation_to_hosts(hosts_and_servers, own_encoded_server_entries_generator, server_entry_signature_public_key, discovery_strategy_value_hmac_key, plugins, TCS_psiphond_config_values):
 
-    @retry_decorator_returning_exception
     def do_deploy_implementation(host_and_servers):
         try:
             host = host_and_servers[0]
@@ -639,9 +684,9 @@ def deploy_implementation_to_hosts(hosts_and_servers, own_encoded_server_entries
             raise
         host.log('deploy implementation')
 
-    run_in_parallel(20, do_deploy_implementation, hosts_and_servers)
-    restart_psiphond_service_on_hosts([host for host in (host_and_servers[0] for host_and_servers in hosts_and_servers)
-                                                        if host.is_TCS and host.TCS_type == 'DOCKER'])
+    run_in_parallel(20, do_deploy_implementation, hosts_and_servers, attempts=DEPLOY_ATTEMPTS)
+    restart_psiphond_service_on_hosts([(host, servers) for (host, servers) in hosts_and_servers
+                                       if host.is_TCS and host.TCS_type == 'DOCKER'])
 
 
 def deploy_data(host, host_data, TCS_traffic_rules_set, TCS_OSL_config, TCS_tactics_config_template, TCS_blocklist_csv):
@@ -702,22 +747,22 @@ def deploy_legacy_data(ssh, host, host_data):
 
 def deploy_TCS_data(ssh, host, host_data, TCS_traffic_rules_set, TCS_OSL_config, TCS_tactics_config_template, TCS_blocklist_csv):
 
-    # Upload psinet file
+    # Upload psinet file and auxillary config files
     # We upload a compartmentalized version of the master file
 
-    put_file_with_content(ssh, host_data, TCS_PSINET_FILE_NAME)
-
-    # Upload auxillary config files
-
-    put_file_with_content(ssh, TCS_traffic_rules_set, TCS_TRAFFIC_RULES_FILE_NAME)
-
-    put_file_with_content(ssh, TCS_OSL_config, TCS_OSL_CONFIG_FILE_NAME)
-
-    put_file_with_content(ssh, TCS_tactics_config_template, TCS_TACTICS_CONFIG_FILE_NAME)
-
-    put_file_with_content(ssh, TCS_blocklist_csv, TCS_BLOCKLIST_CSV_FILE_NAME)
-
-    ssh.exec_command(TCS_PSIPHOND_HOT_RELOAD_SIGNAL_COMMAND)
+    changed = put_files_with_changed_content(
+        ssh,
+        [(host_data, TCS_PSINET_FILE_NAME),
+         (TCS_traffic_rules_set, TCS_TRAFFIC_RULES_FILE_NAME),
+         (TCS_OSL_config, TCS_OSL_CONFIG_FILE_NAME),
+         (TCS_tactics_config_template, TCS_TACTICS_CONFIG_FILE_NAME),
+         (TCS_blocklist_csv, TCS_BLOCKLIST_CSV_FILE_NAME)],
+        TCS_DATA_MANIFEST_FILE_NAME)
+
+    if changed:
+        ssh.exec_command(TCS_PSIPHOND_HOT_RELOAD_SIGNAL_COMMAND)
+    else:
+        print('data unchanged on host %s' % (host.id,))
 
     # Enable and start psiphond service. It's disabled in the base image.
     # This is a one-time operation and otherwise has no effect on
@@ -728,6 +773,62 @@ def deploy_TCS_data(ssh, host, host_data, TCS_traffic_rules_set, TCS_OSL_config,
     ssh.exec_command(TCS_PSIPHOND_START_COMMAND)
 
 
+def put_files_with_changed_content(ssh, contents_and_destination_paths, manifest_path):
+
+    # Only content that differs from the file on the host, or whose file is
+    # missing, is uploaded, gzip compressed. The files on the host are
+    # compared by their SHA-256 digests, so a file edited or removed on the
+    # host is replaced. Each file is decompressed to a temporary file and
+    # renamed into place so that readers never see a partially written file.
+    # The manifest, which records the digest of the content deployed to each
+    # destination path, is written once all of the files are in place.
+    #
+    # Returns True if any file was changed.
+
+    destination_paths = [destination_path for _, destination_path in contents_and_destination_paths]
+    # Missing files are left out of the output
+    output = ssh.exec_command('sha256sum %s 2>/dev/null; true' % (' '.join(destination_paths),), muted=True)
+    remote_digests = {}
+    for line in output.splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2:
+            remote_digests[fields[1]] = fields[0]
+
+    manifest = {}
+    changed = []
+    for content, destination_path in contents_and_destination_paths:
+        content = content.encode()
+        digest = hashlib.sha256(content).hexdigest()
+        manifest[destination_path] = digest
+        if remote_digests.get(destination_path) != digest:
+            changed.append((content, destination_path))
+
+    if not changed:
+        return False
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        uploads = []
+        commands = []
+        for index, (content, destination_path) in enumerate(changed):
+            local_path = os.path.join(temp_dir, '%d.gz' % (index,))
+            with gzip.open(local_path, 'wb') as file:
+                file.write(content)
+            uploads.append((local_path, destination_path + '.gz.tmp'))
+            commands.append('gunzip -c %s.gz.tmp > %s.tmp && mv -f %s.tmp %s && rm -f %s.gz.tmp' % (
+                (destination_path,) * 5))
+        ssh.put_files(uploads)
+        output = ssh.exec_command(' && '.join(commands) + ' && echo OK')
+        if output.strip() != 'OK':
+            raise Exception('failed to install files: %s' % (output,))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    put_file_with_content(ssh, json.dumps(manifest), manifest_path)
+
+    return True
+
+
 def put_file_with_content(ssh, content, destination_path):
 
     # TODO-TCS: more robust to write to remote temp file and
@@ -753,7 +854,6 @@ def deploy_data_to_hosts(hosts, data_generator, TCS_traffic_rules_set, TCS_OSL_c
     if TCS_hosts:
         TCS_data = data_generator(TCS_hosts[0].id, True)
 
-    @retry_decorator_returning_exception
     def do_deploy_data(host_and_data_generator):
         host = host_and_data_generator[0]
         host_data = TCS_data if host.is_TCS and TCS_data else host_and_data_generator[1](host.id, host.is_TCS)
@@ -763,7 +863,7 @@ def deploy_data_to_hosts(hosts, data_generator, TCS_traffic_rules_set, TCS_OSL_c
             print('Error deploying data to host %s' % (host.id,))
             raise
 
-    run_in_parallel(60, do_deploy_data, [(host, data_generator) for host in hosts])
+    run_in_parallel(60, do_deploy_data, [(host, data_generator) for host in hosts], attempts=DEPLOY_ATTEMPTS)
 
 
 def deploy_build(host, build_filename):
@@ -791,7 +891,6 @@ def deploy_build(host, build_filename):
 
 def deploy_build_to_hosts(hosts, build_filename):
 
-    @retry_decorator_returning_exception
     def do_deploy_build(host):
         try:
             deploy_build(host, build_filename)
@@ -799,15 +898,45 @@ def deploy_build_to_hosts(hosts, build_filename):
             print('Error deploying build to host %s' % (host.id,))
             raise
 
-    run_in_parallel(10, do_deploy_build, hosts)
+    run_in_parallel(10, do_deploy_build, hosts, attempts=DEPLOY_ATTEMPTS)
 
 
-def restart_psiphond_service_on_hosts(hosts):
+def get_readiness_probe_addresses(host, servers):
+    # The TCP ports that psiphond accepts tunnels on. QUIC is UDP, and
+    # in-proxy and refraction networking clients don't connect directly.
+    addresses = set()
+    for server in servers:
+        for protocol, port in get_supported_protocol_ports(host, server).items():
+            if ('QUIC' in protocol or protocol.startswith('INPROXY') or
+                    protocol in ('TAPDANCE-OSSH', 'CONJURE-OSSH')):
+                continue
+            addresses.add((server.ip_address, port))
+    return addresses
 
-  @retry_decorator_returning_exception
-  def do_service_restart(host):
-    sleep(30)
 
+def wait_for_tunnel_ports(host, servers, timeout_seconds=RESTART_READINESS_TIMEOUT_SECONDS):
+    remaining_addresses = get_readiness_probe_addresses(host, servers)
+    start_time = time.time()
+    while True:
+        for address in sorted(remaining_addresses):
+            try:
+                socket.create_connection(address, RESTART_READINESS_CONNECT_TIMEOUT_SECONDS).close()
+                remaining_addresses.remove(address)
+            except socket.error:
+                pass
+        if not remaining_addresses:
+            return
+        if time.time() - start_time > timeout_seconds:
+            raise Exception('psiphond on host %s not accepting connections on %s' % (
+                host.id, ', '.join('%s:%d' % address for address in sorted(remaining_addresses))))
+        sleep(RESTART_READINESS_POLL_SECONDS)
+
+
+# hosts_and_servers is a list of tuples: [(host, [server, ...]), ...]
+def restart_psiphond_service_on_hosts(hosts_and_servers):
+
+  def do_service_restart(host_and_servers):
+    host, servers = host_and_servers
     if not host.is_TCS:
       return
 
@@ -819,16 +948,29 @@ def restart_psiphond_service_on_hosts(hosts):
                       host.ssh_username, host.ssh_password,
                       host.ssh_host_key)
       ssh.exec_command("systemctl restart psiphond.service")
+      ssh.close()
+
+      wait_for_tunnel_ports(host, servers)
 
     except Exception as e:
       print("Error restarting 'psiphond.service' on host %s: %r" % (host.id, e))
       raise
     host.log("restarted psiphond.service")
 
-  run_in_parallel(
-      min(len(hosts)/10, 30) if len(hosts) > 10 else 1,
+  # Each wave starts once the previous wave's hosts accept tunnels again, so
+  # restart time grows with the number of waves, not hosts. A failed host
+  # stops the rollout.
+  waves = psi_ops_fleet.plan_waves(
+      hosts_and_servers,
+      RESTART_WAVE_SIZE,
+      group_functions=[lambda host_and_servers: host_and_servers[0].provider,
+                       lambda host_and_servers: host_and_servers[0].region],
+      max_group_fraction=RESTART_MAX_DOWN_FRACTION)
+  if waves:
+    print('restarting psiphond on %d hosts in %d waves' % (len(hosts_and_servers), len(waves)))
+  raise_failures(
       do_service_restart,
-      hosts)
+      psi_ops_fleet.run_in_waves(do_service_restart, waves, attempts=DEPLOY_ATTEMPTS))
 
 
 def deploy_routes(host):
@@ -858,7 +1000,6 @@ def deploy_routes(host):
 
 def deploy_routes_to_hosts(hosts):
 
-    @retry_decorator_returning_exception
     def do_deploy_routes(host):
         try:
             deploy_routes(host)
@@ -866,7 +1007,7 @@ def deploy_routes_to_hosts(hosts):
             print('Error deploying routes to host %s' % (host.id,))
             raise
 
-    run_in_parallel(10, do_deploy_routes, hosts)
+    run_in_parallel(10, do_deploy_routes, hosts, attempts=DEPLOY_ATTEMPTS)
 
 
 def deploy_geoip_database_autoupdates(host):
@@ -919,7 +1060,6 @@ def deploy_geoip_database_autoupdates(host):
 
 def deploy_geoip_database_autoupdates_to_hosts(hosts):
 
-    @retry_decorator_returning_exception
     def do_deploy_geoip_database_autoupdates(host):
         try:
             deploy_geoip_database_autoupdates(host)
@@ -927,4 +1067,4 @@ def deploy_geoip_database_autoupdates_to_hosts(hosts):
             print('Error deploying geoip database autoupdates to host %s' % (host.id,))
             raise
 
-    run_in_parallel(10, do_deploy_geoip_database_autoupdates, hosts)
+    run_in_parallel(10, do_deploy_geoip_database_autoupdates, hosts, attempts=DEPLOY_ATTEMPTS)
@@ -25,6 +25,7 @@ import string
 import random
 import hashlib
 import hmac
+import bisect
 
 # Strategy parameters: change these to keep your strategy unique
 TIME_GRANULARITY = 3600
@@ -41,7 +42,7 @@ def _calculate_bucket_count(length):
 # http://stackoverflow.com/questions/2659900/python-slicing-a-list-into-n-nearly-equal-length-partitions
 def _partition(lst, n):
     division = len(lst) / float(n)
-    return [ lst[int(round(division * i)): int(round(division * (i + 1)))] for i in xrange(n) ]
+    return [ lst[int(round(division * i)): int(round(division * (i + 1)))] for i in range(n) ]
 
 
 def calculate_ip_address_strategy_value(ip_address):
@@ -76,27 +77,88 @@ def select_servers(servers, ip_address_strategy_value, time_in_seconds=None):
     if len(servers) < 1:
         return []
 
-    # Time-of-day is actually current time (epoch) truncated to an hour
-    if not time_in_seconds:
-        time_in_seconds = int(time.time())
-    time_strategy_value = (time_in_seconds/TIME_GRANULARITY)
+    return select_server_from_buckets(partition_servers(servers), ip_address_strategy_value, time_in_seconds)
+
+
+def partition_servers(servers):
 
     # Divide servers into buckets. The bucket count is chosen such that the number
     # of buckets and the number of items in each bucket are close (using sqrt).
     # IP address selects the bucket, time selects the item in the bucket.
 
+    # The buckets only depend on the list of servers, so callers selecting
+    # repeatedly from the same servers may partition once and reuse the buckets.
+
+    return _partition(servers, _calculate_bucket_count(len(servers)))
+
+
+def select_server_from_buckets(buckets, ip_address_strategy_value, time_in_seconds=None):
+
+    if len(buckets) < 1:
+        return []
+
+    # Time-of-day is actually current time (epoch) truncated to an hour
+    if not time_in_seconds:
+        time_in_seconds = int(time.time())
+    time_strategy_value = (time_in_seconds//TIME_GRANULARITY)
+
     # NOTE: this code assumes that range of possible time_values and
     # ip_address_strategy_values is sufficient to index to all bucket items.
-    
-    bucket_count = _calculate_bucket_count(len(servers))
 
-    buckets = _partition(servers, bucket_count)
     bucket = buckets[int(ip_address_strategy_value) % len(buckets)]
     server = bucket[time_strategy_value % len(bucket)]
 
     return [server]
 
 
+class DateRangeIndex(object):
+
+    # Indexes items by their [start, end) date range, for queries by date.
+    # Query results keep the order in which the items were given.
+    #
+    # The set of items whose range contains a date only changes at range
+    # boundaries, so "items in range at date" is answered by locating the
+    # date's segment between consecutive boundaries; each segment's items
+    # and discovery buckets are computed once, on first use.
+
+    def __init__(self, ranged_items):
+        self.__items = [item for _, _, item in ranged_items]
+        self.__ranges = [(start, end) for start, end, _ in ranged_items]
+        ends = sorted((end, position) for position, (_, end) in enumerate(self.__ranges))
+        self.__end_dates = [end for end, _ in ends]
+        self.__end_positions = [position for _, position in ends]
+        self.__boundaries = sorted(set([start for start, _ in self.__ranges] +
+                                       [end for _, end in self.__ranges]))
+        self.__segments = {}
+
+    def __get_segment(self, date):
+        segment = bisect.bisect_right(self.__boundaries, date)
+        if segment not in self.__segments:
+            items = [item for item, (start, end) in zip(self.__items, self.__ranges)
+                     if start <= date < end]
+            self.__segments[segment] = (items, None)
+        return segment
+
+    def in_range(self, date):
+        return list(self.__segments[self.__get_segment(date)][0])
+
+    def in_range_buckets(self, date):
+        segment = self.__get_segment(date)
+        items, buckets = self.__segments[segment]
+        if buckets is None:
+            buckets = partition_servers(items) if items else []
+            self.__segments[segment] = (items, buckets)
+        return buckets
+
+    def ended_before(self, date):
+        count = bisect.bisect_left(self.__end_dates, date)
+        return [self.__items[position] for position in sorted(self.__end_positions[:count])]
+
+    def ending_after(self, date):
+        count = bisect.bisect_right(self.__end_dates, date)
+        return [self.__items[position] for position in sorted(self.__end_positions[count:])]
+
+
 def _test_select_servers():
 
     tests = [
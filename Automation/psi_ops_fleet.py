@@ -0,0 +1,282 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2024, Psiphon Inc.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Runs an operation against many hosts concurrently.
+
+Host operations (SSH, provider APIs) are blocking, so each runs on a worker
+thread, scheduled by an asyncio event loop that enforces per-host deadlines,
+retries failed operations with exponential backoff and jitter, and adapts the
+number of operations in flight:
+
+- The limit grows by one for each fast success, up to max_concurrency.
+- It shrinks by a quarter, at most once per observed latency interval, on a
+  failure or when the moving average latency rises to several times the
+  best average seen so far.
+
+Each item gets a FleetResult recording its value or exception, the number of
+attempts and the elapsed time.
+
+Disruptive operations, like service restarts, can instead run in waves:
+plan_waves splits the fleet so that each wave takes down at most a fraction
+of any group of hosts (e.g. a provider or region), and run_in_waves runs one
+wave at a time, stopping at the first wave with a failure.
+"""
+
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+FLEET_MAX_CONCURRENCY = 256
+FLEET_MIN_CONCURRENCY = 1
+
+# A moving average latency this many times the best average seen is treated
+# as congestion, and the concurrency limit is reduced
+FLEET_LATENCY_TOLERANCE = 3.0
+FLEET_LATENCY_SMOOTHING = 0.2
+
+FLEET_BACKOFF_BASE_SECONDS = 1
+FLEET_BACKOFF_MAX_SECONDS = 30
+
+
+class FleetDeadlineExceeded(Exception):
+    pass
+
+
+class FleetHalted(Exception):
+    pass
+
+
+class FleetResult(object):
+
+    def __init__(self, item):
+        self.item = item
+        self.value = None
+        self.exception = None
+        self.attempts = 0
+        self.elapsed_seconds = 0.0
+
+    @property
+    def succeeded(self):
+        return self.attempts > 0 and self.exception is None
+
+    def __repr__(self):
+        return 'FleetResult(%r, succeeded=%r, attempts=%d, elapsed_seconds=%.1f)' % (
+            self.item, self.succeeded, self.attempts, self.elapsed_seconds)
+
+
+def backoff_delay(attempt, base_seconds=None, max_seconds=None):
+    # Exponential backoff with full jitter, for the wait after failed attempt
+    # number attempt (1-based). The defaults are the module's current
+    # FLEET_BACKOFF_* values.
+    if base_seconds is None:
+        base_seconds = FLEET_BACKOFF_BASE_SECONDS
+    if max_seconds is None:
+        max_seconds = FLEET_BACKOFF_MAX_SECONDS
+    return random.uniform(0, min(max_seconds, base_seconds * (2 ** (attempt - 1))))
+
+
+class _AdaptiveLimit(object):
+
+    def __init__(self, concurrency, max_concurrency):
+        self.max_concurrency = max(FLEET_MIN_CONCURRENCY, max_concurrency)
+        self.limit = float(min(max(FLEET_MIN_CONCURRENCY, concurrency), self.max_concurrency))
+        self.in_flight = 0
+        self.average_latency = None
+        self.best_average_latency = None
+        self.last_decrease = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            while self.in_flight >= int(self.limit):
+                await self.condition.wait()
+            self.in_flight += 1
+
+    async def release(self, latency, succeeded):
+        # latency is None when the slot was released without running an
+        # attempt, which doesn't affect the limit
+        async with self.condition:
+            self.in_flight -= 1
+            if latency is None:
+                self.condition.notify_all()
+                return
+            congested = not succeeded
+            if succeeded:
+                if self.average_latency is None:
+                    self.average_latency = latency
+                else:
+                    self.average_latency += FLEET_LATENCY_SMOOTHING * (latency - self.average_latency)
+                if self.best_average_latency is None or self.average_latency < self.best_average_latency:
+                    self.best_average_latency = self.average_latency
+                congested = self.average_latency > FLEET_LATENCY_TOLERANCE * self.best_average_latency
+            now = time.time()
+            if not congested:
+                self.limit = min(self.max_concurrency, self.limit + 1)
+            elif now - self.last_decrease > (self.average_latency or 0):
+                # Decrease once per latency interval, so one burst of
+                # failures doesn't collapse the limit
+                self.limit = max(FLEET_MIN_CONCURRENCY, self.limit * 0.75)
+                self.last_decrease = now
+            self.condition.notify_all()
+
+
+async def _run_on_fleet(function, items, concurrency, max_concurrency, attempts, deadline_seconds):
+    loop = asyncio.get_running_loop()
+    limit = _AdaptiveLimit(concurrency, max_concurrency)
+    executor = ThreadPoolExecutor(max_workers=limit.max_concurrency)
+
+    async def run_item(result):
+        start = None
+        for attempt in range(1, attempts + 1):
+            await limit.acquire()
+            if start is None:
+                # The deadline starts with the first attempt, not while the
+                # item is queued behind the rest of the fleet
+                start = time.time()
+            remaining = None
+            if deadline_seconds is not None:
+                remaining = deadline_seconds - (time.time() - start)
+                if remaining <= 0:
+                    await limit.release(None, False)
+                    if result.exception is None:
+                        result.exception = FleetDeadlineExceeded('deadline exceeded for %r' % (result.item,))
+                    break
+            attempt_start = time.time()
+            result.attempts = attempt
+            try:
+                # The worker thread can't be interrupted, so on a deadline it
+                # is left to finish in the background
+                result.value = await asyncio.wait_for(
+                    loop.run_in_executor(executor, function, result.item), remaining)
+                result.exception = None
+                succeeded = True
+            except asyncio.TimeoutError:
+                succeeded = False
+                result.exception = FleetDeadlineExceeded('deadline exceeded for %r' % (result.item,))
+            except Exception as e:
+                succeeded = False
+                result.exception = e
+            await limit.release(time.time() - attempt_start, succeeded)
+            if succeeded or isinstance(result.exception, FleetDeadlineExceeded):
+                break
+            if attempt < attempts:
+                delay = backoff_delay(attempt)
+                if deadline_seconds is not None and time.time() - start + delay >= deadline_seconds:
+                    # No time left for another attempt; keep the last error
+                    break
+                await asyncio.sleep(delay)
+        result.elapsed_seconds = time.time() - start
+
+    results = [FleetResult(item) for item in items]
+    try:
+        await asyncio.gather(*[run_item(result) for result in results])
+    finally:
+        executor.shutdown(wait=False)
+    return results
+
+
+def run_on_fleet(function, items,
+                 concurrency=20,
+                 max_concurrency=FLEET_MAX_CONCURRENCY,
+                 attempts=1,
+                 deadline_seconds=None):
+    '''
+    Calls function(item) for each item, returning a FleetResult for each, in
+    order. Exceptions are recorded in the results rather than raised.
+
+    concurrency is the initial limit on operations in flight; pass
+    max_concurrency=concurrency for a fixed limit. deadline_seconds bounds the
+    time spent on each item, across all attempts.
+    '''
+    items = list(items)
+    if not items:
+        return []
+    return asyncio.run(_run_on_fleet(function, items, concurrency, max_concurrency,
+                                     attempts, deadline_seconds))
+
+
+def raise_first_failure(results):
+    for result in results:
+        if not result.succeeded:
+            raise result.exception
+
+
+def plan_waves(items, wave_size, group_functions=(), max_group_fraction=1.0):
+    '''
+    Splits items into waves of at most wave_size items. Each of
+    group_functions maps an item to a group, such as its provider; no wave
+    holds more than max_group_fraction of any group, but always at least one
+    item. Items are placed in the first wave with room, in order.
+    '''
+    items = list(items)
+    group_sizes = [{} for _ in group_functions]
+    for item in items:
+        for sizes, group_function in zip(group_sizes, group_functions):
+            group = group_function(item)
+            sizes[group] = sizes.get(group, 0) + 1
+
+    waves = []
+    # For each wave, like [{group: count}, ...] for each of group_functions
+    wave_group_counts = []
+    for item in items:
+        groups = [group_function(item) for group_function in group_functions]
+        for wave, group_counts in zip(waves, wave_group_counts):
+            if len(wave) < wave_size and all(
+                    counts.get(group, 0) < max(1, int(max_group_fraction * sizes[group]))
+                    for group, counts, sizes in zip(groups, group_counts, group_sizes)):
+                break
+        else:
+            wave = []
+            group_counts = [{} for _ in group_functions]
+            waves.append(wave)
+            wave_group_counts.append(group_counts)
+        wave.append(item)
+        for group, counts in zip(groups, group_counts):
+            counts[group] = counts.get(group, 0) + 1
+    return waves
+
+
+def run_in_waves(function, waves, attempts=1, deadline_seconds=None):
+    '''
+    Calls function(item) for all of the items of each wave at once, one wave
+    at a time. A wave starts only when every item of the previous wave
+    succeeded; the items of the remaining waves then fail with FleetHalted.
+    Returns a FleetResult for each item, in wave order.
+    '''
+    results = []
+    failed_wave_number = None
+    for wave_number, wave in enumerate(waves, 1):
+        if failed_wave_number is not None:
+            for item in wave:
+                result = FleetResult(item)
+                result.exception = FleetHalted('not run, as wave %d failed' % (failed_wave_number,))
+                results.append(result)
+            continue
+        wave_results = run_on_fleet(function, wave,
+                                    concurrency=len(wave),
+                                    max_concurrency=len(wave),
+                                    attempts=attempts,
+                                    deadline_seconds=deadline_seconds)
+        results += wave_results
+        if not all(result.succeeded for result in wave_results):
+            failed_wave_number = wave_number
+    return results
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2024, Psiphon Inc.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Host health probe: one remote command that reports user counts, load,
+memory, swap, disk, process counts and GeoIP database freshness as JSON.
+
+The probe script is sent to the host's python3 or python over stdin, so it
+must run on both Python 2 and 3. The latest psiphond load record is found by
+reading the log backwards from the end, a block at a time, rather than piping
+the whole log through tac.
+
+Hosts without python, like in-proxy hosts, run an equivalent shell script
+instead, built from the commands the load check used before the probe.
+"""
+
+import base64
+import json
+import textwrap
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+PSIPHOND_LOG_FILENAME = '/var/log/psiphond/psiphond.log'
+
+HOST_PROBE_SCRIPT = textwrap.dedent('''
+    import json
+    import os
+    import subprocess
+    import sys
+    import time
+
+    BLOCK_SIZE = 65536
+
+    def lines_containing_backwards(filename, marker):
+        # Reads the file backwards in blocks, yielding complete lines that
+        # contain marker, last line first
+        with open(filename, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b''
+            while position > 0:
+                read_size = min(BLOCK_SIZE, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b'\\n')
+                # The first piece may be a partial line unless at the start
+                remainder = lines.pop(0) if position > 0 else b''
+                for line in reversed(lines):
+                    if marker in line:
+                        yield line
+
+    def psiphond_load(log_filename):
+        for line in lines_containing_backwards(log_filename, b'"establish_tunnels":'):
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # A line still being written
+                continue
+            return {
+                'established_clients': record['ALL']['established_clients'],
+                'establish_tunnels': record['establish_tunnels']}
+        return None
+
+    def shell_count(command):
+        return int(subprocess.Popen(command, shell=True, stdout=subprocess.PIPE).communicate()[0].strip())
+
+    def meminfo():
+        values = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                values[name] = float(value.split()[0])
+        return values
+
+    def process_counts(names):
+        # Same matching as "pgrep -x": the process name, as in /proc/<pid>/comm
+        counts = dict((name, 0) for name in names)
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join('/proc', pid, 'comm')) as f:
+                    comm = f.read().strip()
+            except (IOError, OSError):
+                continue
+            for name in names:
+                if comm == name[:15]:
+                    counts[name] += 1
+        return counts
+
+    def probe(args):
+        result = {}
+        if args['is_TCS']:
+            result['psiphond_load'] = psiphond_load(args['psiphond_log_filename'])
+        else:
+            result['vpn_users'] = shell_count('ifconfig | grep ppp | wc -l')
+            result['ssh_users'] = shell_count('ps ax | grep ssh | grep psiphon | wc -l') // 2
+        if not args['metrics']:
+            return result
+
+        with open('/proc/loadavg') as f:
+            result['load_average'] = float(f.read().split()[0])
+        with open('/proc/cpuinfo') as f:
+            result['cpu_count'] = len([line for line in f if line.startswith('model name')])
+
+        memory = meminfo()
+        if 'MemAvailable' in memory:
+            available = memory['MemAvailable']
+        else:
+            available = memory['MemFree'] + memory.get('Buffers', 0) + memory.get('Cached', 0)
+        result['memory_free_percent'] = available / memory['MemTotal'] * 100.0
+        result['swap_free_percent'] = memory['SwapFree'] / memory['SwapTotal'] * 100.0 if memory['SwapTotal'] else 0.0
+
+        disk = os.statvfs('/')
+        result['disk_used_percent'] = float(disk.f_blocks - disk.f_bfree) / disk.f_blocks * 100.0 if disk.f_blocks else 0.0
+
+        result['process_counts'] = process_counts(args['processes'])
+
+        geoip_filename = args['geoip_filename']
+        if geoip_filename:
+            fresh = os.path.exists(geoip_filename)
+            if fresh and args['geoip_max_age_days'] is not None:
+                fresh = time.time() - os.path.getmtime(geoip_filename) < args['geoip_max_age_days'] * 86400
+            result['geoip_fresh'] = fresh
+
+        return result
+
+    sys.stdout.write(json.dumps(probe(json.loads(sys.argv[1]))))
+    ''')
+
+
+def make_host_probe_shell_script(args):
+    # Prints the same JSON as HOST_PROBE_SCRIPT, except that the latest
+    # psiphond load record is printed whole, as psiphond_load_record
+    lines = []
+    if args['is_TCS']:
+        # tac joins a last line still being written to the start of the line
+        # before it, so that part is cut off
+        log_filename = quote(args['psiphond_log_filename'])
+        lines.append('partial=0; [ -z "$(tail -c 1 %s)" ] || partial=$(tail -n 1 %s | wc -c)' % (
+            log_filename, log_filename))
+        lines.append("record=$(tac %s | LC_ALL=C awk -v partial=$partial " % (log_filename,) +
+                     "'NR == 1 {$0 = substr($0, partial + 1)} /\"establish_tunnels\":/ {print; exit}')")
+        lines.append('printf \'{"psiphond_load_record": %s\' "${record:-null}"')
+    else:
+        lines.append('printf \'{"vpn_users": %d, "ssh_users": %d\' "$(ifconfig | grep ppp | wc -l)" ' +
+                     '"$(($(ps ax | grep ssh | grep psiphon | wc -l) / 2))"')
+    if args['metrics']:
+        lines.append('printf \', "load_average": %s, "cpu_count": %d\' ' +
+                     '"$(cut -d \' \' -f 1 /proc/loadavg)" "$(grep -c \'model name\' /proc/cpuinfo)"')
+        lines.append("awk '/^MemTotal:/ {total = $2} /^MemAvailable:/ {available = $2} " +
+                     "/^MemFree:/ {free = $2} /^Buffers:/ {buffers = $2} /^Cached:/ {cached = $2} " +
+                     "/^SwapTotal:/ {swap_total = $2} /^SwapFree:/ {swap_free = $2} " +
+                     "END {if (available == \"\") available = free + buffers + cached; " +
+                     "printf \", \\\"memory_free_percent\\\": %f, \\\"swap_free_percent\\\": %f\", " +
+                     "available / total * 100.0, (swap_total ? swap_free / swap_total * 100.0 : 0)}' /proc/meminfo")
+        lines.append("df -P / | awk 'NR == 2 {printf \", \\\"disk_used_percent\\\": %f\", ($2 ? $3 / $2 * 100.0 : 0)}'")
+        counts = ['%s: %%d' % (json.dumps(name),) for name in args['processes']]
+        lines.append('printf %s %s' % (
+            quote(', "process_counts": {' + ', '.join(counts) + '}'),
+            ' '.join('"$(pgrep -xc %s)"' % (quote(name),) for name in args['processes'])))
+        if args['geoip_filename']:
+            if args['geoip_max_age_days'] is not None:
+                check = '[ -n "$(find %s -mtime -%d 2>/dev/null)" ]' % (
+                    quote(args['geoip_filename']), args['geoip_max_age_days'])
+            else:
+                check = '[ -e %s ]' % (quote(args['geoip_filename']),)
+            lines.append('if %s; then fresh=true; else fresh=false; fi' % (check,))
+            lines.append('printf \', "geoip_fresh": %s\' "$fresh"')
+    lines.append("printf '}'")
+    return '\n'.join(lines) + '\n'
+
+
+def make_host_probe_command(is_TCS, metrics=False, processes=(), geoip_filename=None, geoip_max_age_days=None):
+    args = {
+        'is_TCS': is_TCS,
+        'psiphond_log_filename': PSIPHOND_LOG_FILENAME,
+        'metrics': metrics,
+        'processes': list(processes),
+        'geoip_filename': geoip_filename,
+        'geoip_max_age_days': geoip_max_age_days}
+    return ('python=$(command -v python3 || command -v python); ' +
+            'if [ -n "$python" ]; then echo %s | base64 -d | "$python" - %s; ' +
+            'else echo %s | base64 -d | sh; fi') % (
+        base64.b64encode(HOST_PROBE_SCRIPT.encode()).decode(),
+        quote(json.dumps(args)),
+        base64.b64encode(make_host_probe_shell_script(args).encode()).decode())
+
+
+def parse_host_probe_output(output):
+    result = json.loads(output)
+    if 'psiphond_load_record' in result:
+        record = result.pop('psiphond_load_record')
+        result['psiphond_load'] = None
+        if record:
+            result['psiphond_load'] = {
+                'established_clients': record['ALL']['established_clients'],
+                'establish_tunnels': record['establish_tunnels']}
+    return result
@@ -27,9 +27,12 @@ import base64
 import json
 import urllib.parse
 import io
+import threading
+from multiprocessing.pool import ThreadPool
 
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
 
 try:
     # pip install qrcode[pil]
@@ -93,6 +96,21 @@ ROUTES_KEY_PREFIX = 'routes'
 
 _IGNORE_FILENAMES = ('Thumbs.db',)
 
+# Number of concurrent S3 requests made by an S3SyncPlan, across all buckets
+S3_SYNC_POOL_SIZE = 32
+
+# An S3SyncPlan lists a bucket prefix to find the existing objects when it
+# touches more than this many keys under the prefix, and otherwise checks
+# each key individually
+S3_SYNC_LIST_THRESHOLD = 8
+
+# Files at least this large are streamed from disk as parallel multipart
+# uploads, and an S3SyncPlan sends them to further buckets as server-side
+# copies instead of uploading them again
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+S3_MULTIPART_CONCURRENCY = 8
+
 #==============================================================================
 
 # Note about bucket names: Once upon a time, each `SponsorCampaign` website (or
@@ -116,9 +134,13 @@ def _get_s3_bucket_and_prefix(aws_account, bucket_id: str) -> tuple['boto3.S3.Bu
             string.
     """
 
-    s3 = boto3.resource('s3',
+    # A session per call, since the default session is not safe to share
+    # between the threads that update campaign buckets concurrently
+    s3 = boto3.session.Session().resource('s3',
             aws_access_key_id=aws_account.access_id,
-            aws_secret_access_key=aws_account.secret_key)
+            aws_secret_access_key=aws_account.secret_key,
+            # Optional, for an S3 stand-in
+            endpoint_url=getattr(aws_account, 'endpoint_url', None))
 
     # TODO: In order to use our subdomain buckets do we need this?
     # config = Config(s3={'addressing_style': 'path'})
@@ -320,9 +342,11 @@ def create_s3_website_bucket_name() -> str:
 
 
 def update_s3_download_in_buckets(aws_account, builds: list[tuple[str, str, str]], remote_server_list: str, remote_server_list_compressed: str, bucket_ids: list[str]) -> None:
+    plan = S3SyncPlan()
     for bucket_id in bucket_ids:
         if bucket_id:
-            update_s3_download(aws_account, builds, remote_server_list, remote_server_list_compressed, bucket_id)
+            _plan_s3_download(plan, builds, remote_server_list, remote_server_list_compressed, bucket_id)
+    plan.execute(aws_account)
 
 
 def update_s3_download(aws_account, builds: list[tuple[str, str, str]], remote_server_list: str, remote_server_list_compressed: str, bucket_id: str) -> None:
@@ -339,175 +363,352 @@ def update_s3_download(aws_account, builds: list[tuple[str, str, str]], remote_s
         None
     """
 
-    bucket, key_prefix = _get_s3_bucket_and_prefix(aws_account, bucket_id)
+    update_s3_download_in_buckets(aws_account, builds, remote_server_list, remote_server_list_compressed, [bucket_id])
+
 
+def _plan_s3_download(plan: 'S3SyncPlan', builds: list[tuple[str, str, str]], remote_server_list: str, remote_server_list_compressed: str, bucket_id: str) -> None:
     if builds:
         for (source_filename, version, target_filename) in builds:
-            target_filename = join_key_name(key_prefix, target_filename)
-            put_file_to_key(bucket,
-                            target_filename,
-                            {DOWNLOAD_SITE_CLIENT_VERSION_METADATA_NAME : str(version)},
-                            str(source_filename),
-                            True)
-
+            plan.put_file(bucket_id,
+                          target_filename,
+                          str(source_filename),
+                          {DOWNLOAD_SITE_CLIENT_VERSION_METADATA_NAME : str(version)})
 
     if remote_server_list:
-        target_filename = join_key_name(key_prefix,
-                                              DOWNLOAD_SITE_REMOTE_SERVER_LIST_FILENAME)
-        put_string_to_key(bucket,
-                          target_filename,
-                          None,
-                          remote_server_list,
-                          True)
+        plan.put(bucket_id,
+                 DOWNLOAD_SITE_REMOTE_SERVER_LIST_FILENAME,
+                 remote_server_list)
 
     if remote_server_list_compressed:
-        target_filename = join_key_name(key_prefix,
-                                              DOWNLOAD_SITE_REMOTE_SERVER_LIST_FILENAME_COMPRESSED)
-        put_string_to_key(bucket,
-                          target_filename,
-                          None,
-                          remote_server_list_compressed,
-                          True)
+        plan.put(bucket_id,
+                 DOWNLOAD_SITE_REMOTE_SERVER_LIST_FILENAME_COMPRESSED,
+                 remote_server_list_compressed)
+
+
+def update_s3_osls(aws_account, bucket_osl_filenames: dict[str, list[str]], bucket_osl_keys: dict[str, dict[str, bytes]]) -> None:
+    """Write OSL files and keys to many buckets at once, uploading only those
+    that changed.
+    Params:
+        aws_account (object): Must have attributes access_id and secret_key.
+        bucket_osl_filenames (dict): OSL files to write, by bucket_id.
+        bucket_osl_keys (dict): Like { bucket_id: { key_name: data } }.
+    """
+    plan = S3SyncPlan()
+    for bucket_id, osl_filenames in bucket_osl_filenames.items():
+        for osl_filename in osl_filenames:
+            plan.put_file(bucket_id,
+                          join_key_name(DOWNLOAD_SITE_OSL_ROOT_PATH, os.path.basename(osl_filename)),
+                          str(osl_filename))
+    for bucket_id, osl_keys in bucket_osl_keys.items():
+        for key_name, data in osl_keys.items():
+            plan.put(bucket_id, join_key_name(DOWNLOAD_SITE_OSL_ROOT_PATH, key_name), data)
+    plan.execute(aws_account)
 
 
 def update_s3_osl_with_files_in_buckets(aws_account, bucket_ids: list[str], osl_filenames: list[str]) -> None:
-    for bucket_id in bucket_ids:
-        if bucket_id:
-            update_s3_osl_with_files(aws_account, bucket_id, osl_filenames)
+    update_s3_osls(aws_account,
+                   dict((bucket_id, osl_filenames) for bucket_id in bucket_ids if bucket_id),
+                   {})
 
 
 def update_s3_osl_with_files(aws_account, bucket_id: str, osl_filenames: list[str]) -> None:
-    bucket, key_prefix = _get_s3_bucket_and_prefix(aws_account, bucket_id)
+    update_s3_osl_with_files_in_buckets(aws_account, [bucket_id], osl_filenames)
 
-    for osl_filename in osl_filenames:
-        target_key = join_key_name(key_prefix, DOWNLOAD_SITE_OSL_ROOT_PATH)
-        target_key = join_key_name(target_key, os.path.basename(osl_filename))
-        put_file_to_key(bucket,
-                        target_key,
-                        None,
-                        str(osl_filename),
-                        True)
 
 def update_s3_osl_key_in_buckets(aws_account, bucket_ids: list[str], key_name: str, data: str) -> None:
-    for bucket_id in bucket_ids:
-        if bucket_id:
-            update_s3_osl_key(aws_account, bucket_id, key_name, data)
+    update_s3_osls(aws_account,
+                   {},
+                   dict((bucket_id, {key_name: data}) for bucket_id in bucket_ids if bucket_id))
 
 
 def update_s3_osl_key(aws_account, bucket_id: str, key_name: str, data: str) -> None:
-    bucket, key_prefix = _get_s3_bucket_and_prefix(aws_account, bucket_id)
-
-    target_key = join_key_name(key_prefix, DOWNLOAD_SITE_OSL_ROOT_PATH)
-    target_key = join_key_name(target_key, key_name)
-    put_string_to_key(bucket,
-                      target_key,
-                      None,
-                      data,
-                      True)
+    update_s3_osl_key_in_buckets(aws_account, [bucket_id], key_name, data)
 
 
 def update_website_in_buckets(aws_account, bucket_ids: list[str], custom_site: any, website_dir: str,
                               website_banner_base64: str, website_banner_link: str,
                               website_email_address: str) -> None:
-    for bucket_id in bucket_ids:
-        if bucket_id:
-            update_website(aws_account, bucket_id, custom_site, website_dir,
-                   website_banner_base64, website_banner_link,
-                   website_email_address)
+    update_websites(aws_account, website_dir,
+                    [(bucket_ids, custom_site, website_banner_base64,
+                      website_banner_link, website_email_address)])
 
 
 def update_website(aws_account, bucket_id: str, custom_site: any, website_dir: str,
                    website_banner_base64: str, website_banner_link: str,
                    website_email_address: str) -> None:
-    if custom_site:
-        print('not updating website due to custom site in bucket: https://s3.amazonaws.com/%s/' % bucket_id)
-        return
+    update_website_in_buckets(aws_account, [bucket_id], custom_site, website_dir,
+                              website_banner_base64, website_banner_link,
+                              website_email_address)
 
-    bucket, key_prefix = _get_s3_bucket_and_prefix(aws_account, bucket_id)
 
-    try:
-        for root, dirs, files in os.walk(website_dir):
-            for name in files:
-                if name in _IGNORE_FILENAMES:
-                    continue
-                file_path = os.path.abspath(os.path.join(root, name))
+def update_websites(aws_account, website_dir: str,
+                    sites: list[tuple[list[str], any, str, str, str]]) -> None:
+    """Publish the website to many buckets at once.
+    Params:
+        aws_account (object): Must have attributes access_id and secret_key.
+        website_dir (str): The generated website to publish.
+        sites (list): Tuples of (bucket_ids, custom_site, website_banner_base64,
+            website_banner_link, website_email_address), one per campaign.
+    """
+    plan = S3SyncPlan()
+    updated_bucket_ids = []
+    for bucket_ids, custom_site, website_banner_base64, website_banner_link, website_email_address in sites:
+        for bucket_id in bucket_ids:
+            if not bucket_id:
+                continue
+            if custom_site:
+                print('not updating website due to custom site in bucket: https://s3.amazonaws.com/%s/' % bucket_id)
+                continue
+            _plan_website(plan, bucket_id, website_dir,
+                          website_banner_base64, website_banner_link,
+                          website_email_address)
+            updated_bucket_ids.append(bucket_id)
+
+    plan.execute(aws_account)
+
+    for bucket_id in updated_bucket_ids:
+        print('updated website in bucket: %s' % bucket_id)
+
+
+def _plan_website(plan: 'S3SyncPlan', bucket_id: str, website_dir: str,
+                  website_banner_base64: str, website_banner_link: str,
+                  website_email_address: str) -> None:
+    for root, dirs, files in os.walk(website_dir):
+        for name in files:
+            if name in _IGNORE_FILENAMES:
+                continue
+            file_path = os.path.abspath(os.path.join(root, name))
+
+            # Get key name without prefix
+            key_name = os.path.relpath(os.path.join(root, name), website_dir)\
+                              .replace('\\', '/')
+
+            plan.put_file(bucket_id, key_name, file_path)
+
+    # Sponsors have optional custom banner images
+    if website_banner_base64:
+        plan.put(bucket_id,
+                 DOWNLOAD_SITE_SPONSOR_BANNER_KEY_NAME,
+                 base64.b64decode(website_banner_base64))
+    else:
+        # We need to make sure there's no old sponsor banner in the bucket.
+        plan.delete(bucket_id, DOWNLOAD_SITE_SPONSOR_BANNER_KEY_NAME)
+
+    # Sponsor banner can optionally link to somewhere.
+    if website_banner_link:
+        plan.put(bucket_id,
+                 DOWNLOAD_SITE_SPONSOR_BANNER_LINK_KEY_NAME,
+                 json.dumps(website_banner_link))
+    else:
+        # We need to make sure there's no old sponsor banner link in the bucket.
+        plan.delete(bucket_id, DOWNLOAD_SITE_SPONSOR_BANNER_LINK_KEY_NAME)
+
+    # If sponsor/campaign has a specific email request address, we'll store
+    # that in the bucket for the site to use.
+    if website_email_address:
+        plan.put(bucket_id,
+                 DOWNLOAD_SITE_EMAIL_ADDRESS_KEY_NAME,
+                 json.dumps(website_email_address))
+    else:
+        # We need to make sure there's no old campaign email address in the bucket.
+        plan.delete(bucket_id, DOWNLOAD_SITE_EMAIL_ADDRESS_KEY_NAME)
 
-                # Get key name without prefix
-                key_name = os.path.relpath(os.path.join(root, name), website_dir)\
-                                  .replace('\\', '/')
-                # Add prefix
-                key_name = join_key_name(key_prefix, key_name)
+    # The website includes a QR code image, but it doesn't point to the
+    # Android APK in this bucket. So generate a new one, which replaces it.
 
-                put_file_to_key(bucket, key_name, None, file_path, True)
+    bucket_name, key_prefix = split_bucket_id(bucket_id)
+    android_build_key_name = join_key_name(key_prefix,
+                                           DOWNLOAD_SITE_ANDROID_BUILD_FILENAME)
+    qr_code_url_split = get_s3_bucket_resource_url_split(bucket_name,
+                                                         android_build_key_name)
+    qr_code_url = urllib.parse.urlunsplit(qr_code_url_split)
+    plan.put(bucket_id,
+             DOWNLOAD_SITE_QR_CODE_KEY_NAME,
+             make_qr_code(qr_code_url))
+
+
+class _LocalManifest(object):
+    """ETags of local files, and the content of those small enough to hold in
+    memory, computed once however many buckets the files are published to.
+    Entries are invalidated by size or mtime changes.
+    """
 
-        # Sponsors have optional custom banner images
-        banner_key_name = join_key_name(key_prefix,
-                                              DOWNLOAD_SITE_SPONSOR_BANNER_KEY_NAME)
-        if website_banner_base64:
-            put_string_to_key(bucket,
-                              banner_key_name,
-                              None,
-                              base64.b64decode(website_banner_base64),
-                              True)
-        else:
-            # We need to make sure there's no old sponsor banner in the bucket.
-            # Fails silently if there's no such key.
-            _delete_key(bucket, banner_key_name)
-
-        # Sponsor banner can optionally link to somewhere.
-        banner_link_key_name = join_key_name(key_prefix,
-                                                   DOWNLOAD_SITE_SPONSOR_BANNER_LINK_KEY_NAME)
-        if website_banner_link:
-            put_string_to_key(bucket,
-                              banner_link_key_name,
-                              None,
-                              json.dumps(website_banner_link),
-                              True)
-        else:
-            # We need to make sure there's no old sponsor banner link in the bucket.
-            # Fails silently if there's no such key.
-            _delete_key(bucket, banner_link_key_name)
-
-        # If sponsor/campaign has a specific email request address, we'll store
-        # that in the bucket for the site to use.
-        website_email_address_key_name = join_key_name(key_prefix,
-                                                             DOWNLOAD_SITE_EMAIL_ADDRESS_KEY_NAME)
-        if website_email_address:
-            put_string_to_key(bucket,
-                              website_email_address_key_name,
-                              None,
-                              json.dumps(website_email_address),
-                              True)
-        else:
-            # We need to make sure there's no old campaign email address in the bucket.
-            # Fails silently if there's no such key.
-            _delete_key(bucket, website_email_address_key_name)
-
-        # We wrote a QR code image in the above upload, but it doesn't
-        # point to the Android APK in this bucket. So generate a new one
-        # and overwrite.
-
-        android_build_key_name = join_key_name(key_prefix,
-                                                     DOWNLOAD_SITE_ANDROID_BUILD_FILENAME)
-        qr_code_url_split = get_s3_bucket_resource_url_split(bucket.name,
-                                                             android_build_key_name)
-        qr_code_url = urllib.parse.urlunsplit(qr_code_url_split)
-        qr_data = make_qr_code(qr_code_url)
-        qr_code_key_name = join_key_name(key_prefix,
-                                               DOWNLOAD_SITE_QR_CODE_KEY_NAME)
-        put_string_to_key(bucket,
-                          qr_code_key_name,
-                          None,
-                          qr_data,
-                          True)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file_locks = {}
+        self.entries = {}
+
+    def get(self, filename: str) -> tuple[Optional[bytes], str, set[str]]:
+        """Returns (content, upload_etag, etags) as for get_file_etags. content
+        is None for files that are uploaded in multiple parts.
+        """
+        with self.lock:
+            file_lock = self.file_locks.setdefault(filename, threading.Lock())
+        # Concurrent requests for the same file wait for one read
+        with file_lock:
+            stat = os.stat(filename)
+            signature = (stat.st_size, stat.st_mtime)
+            entry = self.entries.get(filename)
+            if entry and entry[0] == signature:
+                return entry[1]
+            with open(filename, 'rb') as f:
+                if stat.st_size < S3_MULTIPART_THRESHOLD:
+                    content = f.read()
+                    upload_etag = hashlib.md5(content).hexdigest().lower()
+                    value = (content, upload_etag, {upload_etag})
+                else:
+                    upload_etag, etags = get_file_etags(f)
+                    value = (None, upload_etag, etags)
+            self.entries[filename] = (signature, value)
+            return value
+
+
+class S3SyncPlan(object):
+    """A set of objects to write and delete across any number of buckets.
+
+    execute() finds the existing objects' ETags, listing each bucket prefix
+    once when it touches many keys, then writes only the objects whose content
+    changed and deletes only objects that exist, with up to pool_size
+    requests in flight across all buckets.
+
+    Files of at least S3_MULTIPART_THRESHOLD bytes are never held in memory.
+    Each one is uploaded once, as a streamed multipart upload, and copied
+    server-side to the other keys it is written to. If one of those keys is
+    already up to date, it's copied from there and not uploaded at all.
+
+    Key names are relative to the bucket_id's key prefix. As with
+    put_string_to_key, metadata is only set when the content changes.
+    """
 
-    except:
-        # TODO: delete all keys
-        #print 'upload failed, deleting bucket'
-        #bucket.delete()
-        raise
+    def __init__(self):
+        # Like { (bucket_id, key_name): (content, filename, metadata, is_public) }
+        self.puts = {}
+        self.deletes = set()
+        self.manifest = _LocalManifest()
+
+    def put(self, bucket_id: str, key_name: str, content: Union[str, bytes],
+            metadata: Optional[dict[str, str]] = None, is_public: bool = True) -> None:
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.deletes.discard((bucket_id, key_name))
+        self.puts[(bucket_id, key_name)] = (content, None, metadata, is_public)
+
+    def put_file(self, bucket_id: str, key_name: str, filename: str,
+                 metadata: Optional[dict[str, str]] = None, is_public: bool = True) -> None:
+        self.deletes.discard((bucket_id, key_name))
+        self.puts[(bucket_id, key_name)] = (None, filename, metadata, is_public)
+
+    def delete(self, bucket_id: str, key_name: str) -> None:
+        self.puts.pop((bucket_id, key_name), None)
+        self.deletes.add((bucket_id, key_name))
+
+    def execute(self, aws_account, pool_size: int = S3_SYNC_POOL_SIZE) -> None:
+        if not self.puts and not self.deletes:
+            return
 
-    print('updated website in bucket: %s' % bucket_id)
+        thread_buckets = threading.local()
+
+        def get_bucket(bucket_name):
+            # boto3 resources are not thread safe, so each worker has its own
+            if not hasattr(thread_buckets, 'buckets'):
+                thread_buckets.buckets = {}
+            if bucket_name not in thread_buckets.buckets:
+                thread_buckets.buckets[bucket_name] = _get_s3_bucket_and_prefix(aws_account, bucket_name)[0]
+            return thread_buckets.buckets[bucket_name]
+
+        # Object keys by bucket and prefix
+        prefix_keys = {}
+        for bucket_id, key_name in list(self.puts.keys()) + list(self.deletes):
+            bucket_name, key_prefix = split_bucket_id(bucket_id)
+            prefix_keys.setdefault((bucket_name, key_prefix), set()).add(join_key_name(key_prefix, key_name))
+
+        def find_existing_etags(bucket_prefix_and_keys):
+            # Returns { key: etag } for the existing objects among the keys
+            (bucket_name, key_prefix), keys = bucket_prefix_and_keys
+            bucket = get_bucket(bucket_name)
+            etags = {}
+            if len(keys) > S3_SYNC_LIST_THRESHOLD:
+                list_prefix = key_prefix + '/' if key_prefix else ''
+                for object_summary in bucket.objects.filter(Prefix=list_prefix):
+                    if object_summary.key in keys:
+                        etags[object_summary.key] = object_summary.e_tag.strip('"').lower()
+            else:
+                for key in keys:
+                    obj = bucket.Object(key)
+                    if s3_object_exists(obj):
+                        etags[key] = obj.e_tag.strip('"').lower()
+            return bucket_name, etags
+
+        pool = ThreadPool(pool_size)
+        try:
+            existing_etags = {}
+            for bucket_name, etags in pool.map(find_existing_etags, list(prefix_keys.items())):
+                existing_etags.setdefault(bucket_name, {}).update(etags)
+
+            def check_object(put):
+                # Returns the write with the content and ETags to write, and
+                # whether the existing object already has that content
+                (bucket_id, key_name), (content, filename, metadata, is_public) = put
+                bucket_name, key_prefix = split_bucket_id(bucket_id)
+                key = join_key_name(key_prefix, key_name)
+                if filename is not None:
+                    content, upload_etag, etags = self.manifest.get(filename)
+                else:
+                    upload_etag = hashlib.md5(content).hexdigest().lower()
+                    etags = {upload_etag}
+                is_current = existing_etags[bucket_name].get(key) in etags
+                return (bucket_name, key, metadata, is_public, content, filename, upload_etag), is_current
+
+            writes = []
+            # Like { filename: [source (bucket_name, key) or None, [writes]] }
+            multipart_files = {}
+            for write, is_current in pool.map(check_object, list(self.puts.items())):
+                bucket_name, key, _, _, content, filename, _ = write
+                if content is not None:
+                    if not is_current:
+                        writes.append(write)
+                    continue
+                multipart_file = multipart_files.setdefault(filename, [None, []])
+                if is_current:
+                    multipart_file[0] = (bucket_name, key)
+                else:
+                    multipart_file[1].append(write)
+
+            def put_object(write):
+                bucket_name, key, metadata, is_public, content, _, upload_etag = write
+                _put_content_to_key(get_bucket(bucket_name), key, metadata, content, upload_etag, is_public)
+
+            def upload_multipart_file(multipart_file):
+                # Returns the key to copy the file from
+                source, file_writes = multipart_file
+                if source is None:
+                    bucket_name, key, metadata, is_public, _, filename, upload_etag = file_writes.pop(0)
+                    _upload_file_to_key(get_bucket(bucket_name), key, metadata, filename, upload_etag, is_public)
+                    source = (bucket_name, key)
+                return source
+
+            def copy_object(source_and_write):
+                (source_bucket_name, source_key), write = source_and_write
+                bucket_name, key, metadata, is_public, _, filename, upload_etag = write
+                _copy_to_key(source_bucket_name, source_key, get_bucket(bucket_name), key,
+                             metadata, self.manifest.get(filename)[2], is_public)
+
+            def delete_object(bucket_id_and_key_name):
+                bucket_id, key_name = bucket_id_and_key_name
+                bucket_name, key_prefix = split_bucket_id(bucket_id)
+                key = join_key_name(key_prefix, key_name)
+                if key in existing_etags[bucket_name]:
+                    _delete_key(get_bucket(bucket_name), key)
+
+            multipart_files = [multipart_file for multipart_file in multipart_files.values() if multipart_file[1]]
+            pool.map(put_object, writes)
+            sources = pool.map(upload_multipart_file, multipart_files)
+            pool.map(copy_object, [(source, write)
+                                   for source, (_, file_writes) in zip(sources, multipart_files)
+                                   for write in file_writes])
+            pool.map(delete_object, list(self.deletes))
+        finally:
+            pool.close()
 
 
 def s3_object_exists(s3_object: 'boto3.S3.Object') -> bool:
@@ -553,23 +754,100 @@ def put_string_to_key(bucket: 'boto3.S3.Bucket', key_name: str, metadata: Option
             # key contents haven't changed
             return
 
-    metadata = metadata or {}
-    mimetype = mimetypes.guess_type(key_name)[0]
-    acl = 'public-read' if is_public else 'private'
+    _put_content_to_key(bucket, key_name, metadata, content, local_etag, is_public)
 
+
+def _get_put_args(key_name: str, metadata: Optional[dict[str, str]], is_public: bool) -> dict[str, any]:
+    put_args = {'ACL': 'public-read' if is_public else 'private',
+                'Metadata': metadata or {}}
+    mimetype = mimetypes.guess_type(key_name)[0]
     if mimetype:
-        res = obj.put(Body=content, ACL=acl, Metadata=metadata, ContentType=mimetype)
-    else:
-        res = obj.put(Body=content, ACL=acl, Metadata=metadata)
+        put_args['ContentType'] = mimetype
+    return put_args
+
+
+def _get_transfer_config() -> TransferConfig:
+    return TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                          multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+                          max_concurrency=S3_MULTIPART_CONCURRENCY)
+
+
+def _put_content_to_key(bucket: 'boto3.S3.Bucket', key_name: str, metadata: Optional[dict[str, str]], content: bytes, local_etag: str, is_public: bool) -> None:
+    obj = bucket.Object(key_name)
+    res = obj.put(Body=content, **_get_put_args(key_name, metadata, is_public))
 
     if res['ETag'].strip('"').lower() != local_etag:
         # our data was corrupted in transit
         raise Exception('S3 object corruption detected')
 
 
+def _upload_file_to_key(bucket: 'boto3.S3.Bucket', key_name: str, metadata: Optional[dict[str, str]], content_file: Union[str,BinaryIO], upload_etag: str, is_public: bool) -> None:
+    # Streams the file, in parallel parts when it's large
+    obj = bucket.Object(key_name)
+    if isinstance(content_file, str):
+        obj.upload_file(content_file,
+                        ExtraArgs=_get_put_args(key_name, metadata, is_public),
+                        Config=_get_transfer_config())
+    else:
+        obj.upload_fileobj(content_file,
+                           ExtraArgs=_get_put_args(key_name, metadata, is_public),
+                           Config=_get_transfer_config())
+
+    obj.reload()
+    if obj.e_tag.strip('"').lower() != upload_etag:
+        # our data was corrupted in transit
+        raise Exception('S3 object corruption detected')
+
+
+def _copy_to_key(source_bucket_name: str, source_key_name: str, bucket: 'boto3.S3.Bucket', key_name: str, metadata: Optional[dict[str, str]], etags: set[str], is_public: bool) -> None:
+    # A server-side copy, replacing the source's metadata. Large objects are
+    # copied in parts of the same size as uploads, so the copy's ETag is the
+    # same as an upload's.
+    obj = bucket.Object(key_name)
+    copy_args = _get_put_args(key_name, metadata, is_public)
+    copy_args['MetadataDirective'] = 'REPLACE'
+    obj.copy({'Bucket': source_bucket_name, 'Key': source_key_name},
+             ExtraArgs=copy_args,
+             Config=_get_transfer_config())
+
+    obj.reload()
+    if obj.e_tag.strip('"').lower() not in etags:
+        # the source changed, or the copy was corrupted
+        raise Exception('S3 object corruption detected')
+
+
+def get_file_etags(content_file: BinaryIO) -> tuple[str, set[str]]:
+    """Computes S3 ETags for the rest of the file, reading it a chunk at a
+    time.
+    Returns:
+        (upload_etag, etags): The ETag an upload with _get_transfer_config will
+        have, and the set of ETags (a single part upload's and a multipart
+        upload's) that mean an existing object has the same content.
+    """
+    whole_md5 = hashlib.md5()
+    part_digests = []
+    size = 0
+    while True:
+        chunk = content_file.read(S3_MULTIPART_CHUNK_SIZE)
+        if not chunk:
+            break
+        whole_md5.update(chunk)
+        part_digests.append(hashlib.md5(chunk).digest())
+        size += len(chunk)
+
+    single_part_etag = whole_md5.hexdigest().lower()
+    if size < S3_MULTIPART_THRESHOLD:
+        return single_part_etag, {single_part_etag}
+    multipart_etag = '%s-%d' % (hashlib.md5(b''.join(part_digests)).hexdigest().lower(),
+                                len(part_digests))
+    return multipart_etag, {single_part_etag, multipart_etag}
+
+
 def put_file_to_key(bucket: 'boto3.S3.Bucket', key_name: str, metadata: dict[str, str], content_file: Union[str,BinaryIO], is_public: bool) -> None:
-    """Write file contents to key in S3 bucket.
-    Note that file will be read into memory before writing.
+    """Write file contents to key in S3 bucket. If contents of existing key are
+    unchanged, there will be no modification.
+    The file is streamed from disk, in parallel multipart chunks when it's at
+    least S3_MULTIPART_THRESHOLD bytes.
     Params:
         bucket (boto.s3 object): The bucket to write to.
         key_name (str): The key to write to (must include any applicable prefix).
@@ -578,15 +856,28 @@ def put_file_to_key(bucket: 'boto3.S3.Bucket', key_name: str, metadata: dict[str
             or a file object.
         is_public (bool): Whether the new object should be publicly readable.
     """
+    if isinstance(content_file, io.TextIOBase):
+        # We got a text file object, which can't be streamed as bytes
+        put_string_to_key(bucket, key_name, metadata, content_file.read(), is_public)
+        return
+
     if isinstance(content_file, str):
         # We got a filename
         with open(content_file, 'rb') as f:
-          content = f.read()
+            upload_etag, etags = get_file_etags(f)
     else:
         # We got a file object
-        content = content_file.read()
+        start = content_file.tell()
+        upload_etag, etags = get_file_etags(content_file)
+        content_file.seek(start)
+
+    obj = bucket.Object(key_name)
+    if s3_object_exists(obj):
+        if obj.e_tag.strip('"').lower() in etags:
+            # key contents haven't changed
+            return
 
-    put_string_to_key(bucket, key_name, metadata, content, is_public)
+    _upload_file_to_key(bucket, key_name, metadata, content_file, upload_etag, is_public)
 
 
 def get_string_from_key(bucket: 'boto3.S3.Bucket', key_name: str) -> str:
@@ -27,9 +27,14 @@ import json
 import shlex
 import signal
 import ipaddress
+import shutil
+import tempfile
+import threading
 
 from functools import wraps
 
+import psi_ops_fleet
+
 # Local service should be in same GeoIP region; local split tunnel will be in effect (not proxied)
 # Remote service should be in different GeoIP region; remote split tunnel will be in effect (proxied)
 CHECK_IP_ADDRESS_URL_LOCAL = ['http://automation.whatismyip.com/n09230945.asp']
@@ -39,6 +44,17 @@ SOURCE_ROOT = os.path.join(os.path.abspath('.'), 'network-health', 'bin')
 TUNNEL_CORE = os.path.join(SOURCE_ROOT, 'psiphon-tunnel-core')
 CONFIG_FILE_NAME = os.path.join(SOURCE_ROOT, 'tunnel-core-config.config')
 
+# Optional; a large file downloaded through each tunnel to measure throughput
+THROUGHPUT_TEST_URL = None
+
+TUNNEL_CORE_CONNECT_TIMEOUT_SECONDS = 25
+
+# test_servers runs this many tunnel-core clients at once. Each test case
+# gets this long per attempt, after which its client is killed.
+TUNNEL_CORE_TEST_CONCURRENCY = 16
+TUNNEL_CORE_TEST_TIMEOUT_SECONDS = 120
+TUNNEL_CORE_TEST_ATTEMPTS = 2
+
 
 
 def load_default_tunnel_core():
@@ -64,6 +80,7 @@ if os.path.isfile('psi_data_config.py'):
     CHECK_IP_ADDRESS_URL_LOCAL = psi_data_config.CHECK_IP_ADDRESS_URL_LOCAL
     CHECK_IP_ADDRESS_URL_REMOTE = psi_data_config.CHECK_IP_ADDRESS_URL_REMOTE
     USER_AGENT = psi_data_config.USER_AGENT
+    THROUGHPUT_TEST_URL = getattr(psi_data_config, 'THROUGHPUT_TEST_URL', None)
 
 
 def retry_on_exception_decorator(function):
@@ -88,13 +105,25 @@ class TunnelCoreCouldNotConnectException(Exception):
         Exception.__init__(self, *args)
 
 
+class TunnelCoreTestFailedException(Exception):
+    # Raised for a test case with failed checks, so that it's retried; result
+    # is the test case result
+    def __init__(self, result):
+        Exception.__init__(self, 'Test case failed: {0}'.format(result))
+        self.result = result
+
+
 class TunnelCoreConsoleRunner:
     def __init__(self, encoded_server_entry, propagation_channel_id='00', 
                  sponsor_id='0000000000000000', client_platform='', client_version='0', 
                  use_indistinguishable_tls=True, split_tunnel_url_format='', 
                  split_tunnel_signature_public_key='', split_tunnel_dns_server='', 
-                 tunnel_core_binary=None, tunnel_core_config=None, packet_tunnel_params=dict()):
+                 tunnel_core_binary=None, tunnel_core_config=None, packet_tunnel_params=dict(),
+                 timeout_seconds=None):
         self.proc = None
+        self.watchdog = None
+        self.timeout_seconds = timeout_seconds
+        self.connect_seconds = None
         self.http_proxy_port = 0
         self.socks_proxy_port = 0
         self.encoded_server_entry = encoded_server_entry
@@ -161,19 +190,30 @@ class TunnelCoreConsoleRunner:
             self.split_tunnel_signature_public_key = ""
             self.split_tunnel_dns_server = ""
 
+        # With port 0, tunnel-core listens on a free port and reports it in
+        # a notice, so concurrent clients don't collide
+        self.http_proxy_port = 0
+        self.socks_proxy_port = 0
+
         self._setup_tunnel_config(transport)
 
         cmd = [self.tunnel_core_binary, '-config', self.tunnel_core_config] + self.cmdline_opts
 
         self.proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
 
-    def wait_for_connection(self):
+        if self.timeout_seconds:
+            # Killing the client ends any blocked read or proxied request
+            self.watchdog = threading.Timer(self.timeout_seconds, self.proc.kill)
+            self.watchdog.daemon = True
+            self.watchdog.start()
+
+    def wait_for_connection(self, timeout_seconds=TUNNEL_CORE_CONNECT_TIMEOUT_SECONDS):
         # If using tunnel-core
         # Read tunnel-core log file for connection message instead of sleep 25 second
 
+        start_time = time.time()
         time.sleep(1)
         print('[Testing] Tunnel Core is connecting...')
-        start_time = time.time()
 
         # Breaking this loop means the process sent EOF to stderr, or 'tunnels' tunnels were established
         while True:
@@ -191,10 +231,11 @@ class TunnelCoreConsoleRunner:
                 if line["noticeType"] == "Tunnels" and line["data"]["count"] == 1:
                     break
 
-            if time.time() >= start_time + 25:
-                # if the sleep time is 25 second, get out while loop and keep going
-                print('[FAILED] Not successfully connected after 25 second.')
-                raise TunnelCoreCouldNotConnectException('Could not connect after 25 seconds')
+            if time.time() >= start_time + timeout_seconds:
+                print('[FAILED] Not successfully connected after %d seconds.' % (timeout_seconds,))
+                raise TunnelCoreCouldNotConnectException('Could not connect after %d seconds' % (timeout_seconds,))
+
+        self.connect_seconds = time.time() - start_time
 
 
     def setup_proxy(self):
@@ -265,6 +306,8 @@ class TunnelCoreConsoleRunner:
         return output
 
     def stop_psiphon(self):
+        if self.watchdog:
+            self.watchdog.cancel()
         try:
             self.proc.send_signal(signal.SIGINT)
             (stdin, stderr) = self.proc.communicate(timeout=5)
@@ -278,8 +321,32 @@ class TunnelCoreConsoleRunner:
             print("Remove Config/Log File Failed" + str(e))
 
 
+def measure_throughput(http_proxy, url, user_agent):
+    # Returns bytes per second downloading url through the tunnel
+    start_time = time.time()
+    response = http_proxy.request('GET', url, headers={"User-Agent": user_agent}, preload_content=False)
+    size = 0
+    for chunk in response.stream(65536):
+        size += len(chunk)
+    response.release_conn()
+    return int(size / max(time.time() - start_time, 0.001))
+
+
+def is_test_result_failure(test_result):
+    # A test case result is either a failure message or a dict of check
+    # results and metrics
+    if isinstance(test_result, dict):
+        return any(isinstance(value, str) and value.startswith('FAIL') for value in test_result.values())
+    return 'FAIL' in test_result
+
+
 @retry_on_exception_decorator
-def __test_server(runner, transport, expected_egress_ip_addresses, test_sites, additional_test_sites, user_agent, split_tunnel_mode):
+def __test_server(*args, **kwargs):
+    return __run_test(*args, **kwargs)
+
+
+def __run_test(runner, transport, expected_egress_ip_addresses, test_sites, additional_test_sites, user_agent, split_tunnel_mode,
+               throughput_test_url=None):
     # test:
     # - spawn client process, which starts the VPN
     # - sleep 5 seconds, which allows time to establish connection
@@ -316,6 +383,7 @@ def __test_server(runner, transport, expected_egress_ip_addresses, test_sites, a
         runner.connect_to_server(transport, split_tunnel_mode)
         
         runner.wait_for_connection()
+        output['connect_seconds'] = round(runner.connect_seconds, 3)
         
         if runner.packet_tunnel_tests:
             output.update(runner.run_packet_tunnel_tests(
@@ -340,12 +408,14 @@ def __test_server(runner, transport, expected_egress_ip_addresses, test_sites, a
                     urllib3.disable_warnings()
                 
                 try:
+                    request_start_time = time.time()
                     response = http_proxy.request(
                         'GET', 
                         url, 
                         headers={
                             "User-Agent":   user_agent
                         })
+                    output.setdefault('latency_seconds', round(time.time() - request_start_time, 3))
                     
                     try:
                         egress_ip_address = json.loads(response.data.strip().decode('UTF-8'))['remoteIP']
@@ -375,6 +445,12 @@ def __test_server(runner, transport, expected_egress_ip_addresses, test_sites, a
                         output['HTTP'] = 'FAIL MaxRetryError: {0}'.format(err)
                     continue
             
+            if throughput_test_url:
+                try:
+                    output['throughput_bytes_per_second'] = measure_throughput(http_proxy, throughput_test_url, user_agent)
+                except Exception as err:
+                    output['Throughput'] = 'FAIL : {0}'.format(err)
+            
             if len(additional_test_sites) > 0:
                 output['AdditionalSites'] = list()
                 for url in additional_test_sites:
@@ -500,3 +576,77 @@ def test_server(server, host, encoded_server_entry, split_tunnel_url_format,
     return results
 
 
+def test_servers(server_tests, split_tunnel_url_format,
+                 split_tunnel_signature_public_key, split_tunnel_dns_server,
+                 test_propagation_channel_id='00',
+                 test_sponsor_id='0000000000000000', client_platform='', client_version='',
+                 use_indistinguishable_tls=True, test_cases=None,
+                 ip_test_sites=[], additional_test_sites=[], user_agent=USER_AGENT,
+                 executable_path=None, throughput_test_url=THROUGHPUT_TEST_URL,
+                 concurrency=TUNNEL_CORE_TEST_CONCURRENCY,
+                 timeout_seconds=TUNNEL_CORE_TEST_TIMEOUT_SECONDS,
+                 attempts=TUNNEL_CORE_TEST_ATTEMPTS):
+    '''
+    Tests many servers at once. server_tests is a list of tuples of
+    (server, host, encoded_server_entry, expected_egress_ip_addresses).
+
+    Every test case of every server runs its own tunnel-core client, with its
+    own data directory and local proxy ports, up to concurrency at a time.
+    Test cases that raise or have failed checks are retried, with backoff, up
+    to attempts in total.
+
+    Returns like { server.id: { test_case: result } }, where a result is a
+    dict of check results ('HTTP', 'HTTPS', ...) and metrics
+    ('connect_seconds', 'latency_seconds', 'throughput_bytes_per_second'),
+    or a failure message.
+    '''
+    if len(ip_test_sites) == 0:
+        ip_test_sites = CHECK_IP_ADDRESS_URL_LOCAL
+        if isinstance(ip_test_sites, str):
+            ip_test_sites = [ip_test_sites]
+
+    if executable_path is None:
+        executable_path = load_default_tunnel_core()
+
+    tests = []
+    for server_test in server_tests:
+        server, host = server_test[0], server_test[1]
+        for test_case in get_server_test_cases(server, host, test_cases):
+            tests.append((server_test, test_case))
+
+    def run_test(test):
+        (server, host, encoded_server_entry, expected_egress_ip_addresses), test_case = test
+        data_root_directory = tempfile.mkdtemp(prefix='tunnel-core-test-')
+        try:
+            runner = TunnelCoreConsoleRunner(
+                encoded_server_entry, test_propagation_channel_id, test_sponsor_id,
+                client_platform, client_version, use_indistinguishable_tls,
+                split_tunnel_url_format, split_tunnel_signature_public_key,
+                split_tunnel_dns_server, executable_path,
+                os.path.join(data_root_directory, 'tunnel-core.config'),
+                timeout_seconds=timeout_seconds)
+            print('[Testing] Testing Host: %s - Server: %s - %s ...' % (host.id, server.id, test_case))
+            result = __run_test(runner, test_case,
+                                expected_egress_ip_addresses,
+                                ip_test_sites, additional_test_sites, user_agent, False,
+                                throughput_test_url=throughput_test_url)
+            if is_test_result_failure(result):
+                raise TunnelCoreTestFailedException(result)
+            return result
+        finally:
+            shutil.rmtree(data_root_directory, ignore_errors=True)
+
+    results = dict((server_test[0].id, {}) for server_test in server_tests)
+    for fleet_result in psi_ops_fleet.run_on_fleet(run_test, tests,
+                                                   concurrency=concurrency,
+                                                   max_concurrency=concurrency,
+                                                   attempts=attempts):
+        (server, _, _, _), test_case = fleet_result.item
+        if fleet_result.succeeded:
+            results[server.id][test_case] = fleet_result.value
+        elif isinstance(fleet_result.exception, TunnelCoreTestFailedException):
+            results[server.id][test_case] = fleet_result.exception.result
+        else:
+            results[server.id][test_case] = 'FAIL : Exception: {0}'.format(str(fleet_result.exception))
+
+    return results
@@ -31,6 +31,10 @@ import sys
 import multiprocessing
 import argparse
 import iso8601
+import cStringIO
+import hashlib
+import random
+import timeit
 
 import psi_ssh
 import psi_ops
@@ -43,6 +47,18 @@ PSI_OPS_DB_FILENAME = os.path.join(os.path.abspath('.'), 'psi_ops_stats.dat')
 
 TESTING_PROPAGATION_CHANNEL_NAME = 'Testing'
 
+# Rows are loaded with COPY in batches of up to this many rows per event type
+COPY_BATCH_SIZE = 50000
+
+# Log files are read in chunks of this many bytes, and parsed log entries are
+# passed from the parse worker processes to the database threads in batches
+PARSE_READ_SIZE = 1024*1024
+PARSE_BATCH_SIZE = 5000
+# Batches queued per host before its parse worker waits for the database
+PARSE_QUEUE_SIZE = 8
+
+ROTATED_LOG_FILENAME_RE = re.compile('psiphonv\.log(?:\.(\d+))?(?:\.gz)?$')
+
 
 # Stats database schema consists of one table per event type. The tables
 # have a column per log line field.
@@ -53,6 +69,11 @@ TESTING_PROPAGATION_CHANNEL_NAME = 'Testing'
 # log rotation, in which case we may pull the same log entries down twice in
 # two different file names.
 #
+# Rows are loaded in bulk: each batch is COPYed into a temporary staging table
+# and then merged into the event table with a single insert that skips rows
+# already present, matching on every column, as in the table's unique
+# constraint.
+#
 # The uniqueness assumption depends on a high resolution timestamp as it's
 # likely that there will be multiple handshake events in the same second on
 # the same server from the same region and client build.
@@ -395,33 +416,377 @@ LOG_EVENT_TYPE_SCHEMA = {
     }
 
 
+def format_utc(value):
+    # Like strftime('%Y-%m-%dT%H:%M:%S'), which rejects years before 1900
+    return '%04d-%02d-%02dT%02d:%02d:%02d' % (
+        value.year, value.month, value.day, value.hour, value.minute, value.second)
+
+# The UTC seconds prefix of the last timestamp converted, as
+# (seconds prefix and offset, UTC seconds prefix). Consecutive log lines
+# usually share it.
+_utc_seconds_cache = (None, None)
+
 def iso8601_to_utc(timestamp):
-    localized_datetime = datetime.datetime.strptime(timestamp[:26], '%Y-%m-%dT%H:%M:%S.%f')
-    # NOTE: strptime slow! Consider replacing with robust version of following.
-    #year = int(timestamp[0:4])
-    #month = int(timestamp[5:7])
-    #day = int(timestamp[8:10])
-    #hour = int(timestamp[11:13])
-    #minute = int(timestamp[14:16])
-    #second = int(timestamp[17:19])
-    #microsecond = int(timestamp[20:26])
-    localized_datetime = datetime.datetime(year, month, day, hour, minute, second, microsecond)
-    timezone_delta = datetime.timedelta(
-                                hours = int(timestamp[-6:-3]),
-                                minutes = int(timestamp[-2:]))
-    return (localized_datetime - timezone_delta).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    '''
+    Converts an RFC 3339 timestamp in the fixed layout psiphond and syslog
+    write, like 2011-06-28T13:14:04.000000-07:00, to a UTC timestamp like
+    2011-06-28T20:14:04.000000Z, by slicing out its fields. Fractional
+    seconds are optional and kept to microseconds. Returns None for any
+    other layout.
+    '''
+    global _utc_seconds_cache
+
+    if (len(timestamp) < 20 or timestamp[4] != '-' or timestamp[7] != '-' or timestamp[10] != 'T' or
+            timestamp[13] != ':' or timestamp[16] != ':'):
+        return None
+
+    if timestamp[19] != '.':
+        index = 19
+        fraction = '000000'
+    elif timestamp[20:26].isdigit() and not timestamp[26:27].isdigit():
+        # The usual microseconds
+        index = 26
+        fraction = timestamp[20:26]
+    else:
+        index = 20
+        while index < len(timestamp) and timestamp[index].isdigit():
+            index += 1
+        if index == 20:
+            return None
+        fraction = (timestamp[20:index] + '00000')[:6]
+    offset = timestamp[index:]
+
+    key = (timestamp[:19], offset)
+    if _utc_seconds_cache[0] == key:
+        return _utc_seconds_cache[1] + '.' + fraction + 'Z'
+
+    if offset == 'Z':
+        offset_minutes = 0
+    elif (len(offset) == 6 and offset[0] in '+-' and offset[3] == ':' and
+            (offset[1:3] + offset[4:6]).isdigit()):
+        offset_minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+        if offset[0] == '-':
+            offset_minutes = -offset_minutes
+    else:
+        return None
 
-def fix_timestamp(timestamp):
+    digits = timestamp[0:4] + timestamp[5:7] + timestamp[8:10] + timestamp[11:13] + timestamp[14:16] + timestamp[17:19]
+    if not digits.isdigit():
+        return None
     try:
-        iso8601.parse_date(timestamp.strip())
-    except:
+        localized_datetime = datetime.datetime(
+            int(digits[0:4]), int(digits[4:6]), int(digits[6:8]),
+            int(digits[8:10]), int(digits[10:12]), int(digits[12:14]))
+        utc_seconds = format_utc(localized_datetime - datetime.timedelta(minutes=offset_minutes))
+    except (ValueError, OverflowError):
+        return None
+
+    _utc_seconds_cache = (key, utc_seconds)
+    return utc_seconds + '.' + fraction + 'Z'
+
+def fix_timestamp(timestamp):
+    # Returns timestamp converted to UTC, in the format iso8601_to_utc
+    # returns. Timestamps in other layouts go through the general ISO 8601
+    # parser; if that can't parse it either, zero out the time and try again.
+    # If this fails too, the timestamp is returned unchanged.
+    utc_timestamp = iso8601_to_utc(timestamp)
+    if utc_timestamp:
+        return utc_timestamp
+    for value in (timestamp.strip(), timestamp.strip()[:10]):
         try:
-            timestamp = iso8601.parse_date(timestamp.strip()[:10]).isoformat()
+            parsed = iso8601.parse_date(value)
+            offset = parsed.utcoffset()
+            if offset:
+                parsed -= offset
+            return format_utc(parsed) + '.%06dZ' % (parsed.microsecond,)
         except:
             pass
     return timestamp
 
-def process_stats(host, servers, db_cur, psinet, minimal, error_file=None):
+def benchmark_timestamps(count=200000):
+    # Checks iso8601_to_utc against iso8601.parse_date on random timestamps,
+    # then times fix_timestamp against the iso8601 parser on count
+    # consecutive log timestamps
+    random.seed(1)
+    mismatches = 0
+    for _ in range(20000):
+        value = datetime.datetime(2000, 1, 1) + datetime.timedelta(
+            seconds=random.randint(0, 10**9), microseconds=random.choice([0, random.randint(0, 999999)]))
+        timestamp = value.strftime('%Y-%m-%dT%H:%M:%S') + random.choice(['', value.strftime('.%f')])
+        timestamp += random.choice(['Z', '+00:00', '-07:00', '+05:45', '-12:00', '+09:30'])
+        parsed = iso8601.parse_date(timestamp)
+        parsed -= parsed.utcoffset()
+        expected = format_utc(parsed) + '.%06dZ' % (parsed.microsecond,)
+        if iso8601_to_utc(timestamp) != expected:
+            mismatches += 1
+            print 'Mismatch: %s -> %s, expected %s' % (timestamp, iso8601_to_utc(timestamp), expected)
+    print 'iso8601_to_utc mismatches: %d of 20000' % (mismatches,)
+
+    start = datetime.datetime(2016, 3, 27, 0, 59, 0)
+    timestamps = [(start + datetime.timedelta(microseconds=i * 3000)).strftime('%Y-%m-%dT%H:%M:%S.%f+01:00')
+                  for i in range(count)]
+    for name, function in [('iso8601.parse_date', iso8601.parse_date), ('fix_timestamp', fix_timestamp)]:
+        elapsed = min(timeit.repeat(lambda: [function(timestamp) for timestamp in timestamps], number=1, repeat=3))
+        print '%s: %.0f ns per timestamp' % (name, elapsed / count * 1e9)
+    return mismatches == 0
+
+def copy_value(value):
+    # Formats a value for PostgreSQL COPY text format
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def make_event_sql(event_type, table_name, columns):
+    # Returns (staging table name, create, copy, merge, truncate) statements
+    # for loading rows of event_type. A versioned event type only has some of
+    # the table's columns, so each event type gets its own staging table.
+    staging_table_name = 'staging_' + event_type.replace('.', '_')
+    quoted_columns = ', '.join(['"%s"' % column for column in columns])
+    create = 'create temporary table %s as select %s from %s with no data' % (
+                staging_table_name, quoted_columns, table_name)
+    copy = 'copy %s (%s) from stdin' % (staging_table_name, quoted_columns)
+    # last_connected may be NULL, which "=" never matches
+    merge = 'insert into %s (%s) select distinct %s from %s s where not exists (select 1 from %s t where %s)' % (
+                table_name,
+                quoted_columns,
+                ', '.join(['s."%s"' % column for column in columns]),
+                staging_table_name,
+                table_name,
+                ' and '.join([('t."%s" is not distinct from s."%s"' if column == 'last_connected' else 't."%s" = s."%s"') % (column, column)
+                              for column in columns]))
+    truncate = 'truncate %s' % (staging_table_name,)
+    return (staging_table_name, create, copy, merge, truncate)
+
+def copy_event_rows(cursor, event_sql, rows, staging_tables, error_prefix=''):
+    # Loads rows into the staging table with COPY and merges them into the
+    # event table. Returns the number of rows inserted. A value the database
+    # rejects fails the whole batch, so on a DataError the batch is split
+    # until the bad rows are isolated and skipped.
+    staging_table_name, create, copy, merge, truncate = event_sql
+    if staging_table_name not in staging_tables:
+        cursor.execute(create)
+        staging_tables.add(staging_table_name)
+    data = cStringIO.StringIO(''.join(
+        ['\t'.join([copy_value(value) for value in row]) + '\n' for row in rows]))
+    cursor.execute('savepoint copy_event_rows')
+    try:
+        cursor.copy_expert(copy, data)
+        # Staging tables have no statistics otherwise, and the planner
+        # needs them to probe the event table's unique index
+        cursor.execute('analyze %s' % (staging_table_name,))
+        cursor.execute(merge)
+        inserted = cursor.rowcount
+        cursor.execute(truncate)
+        cursor.execute('release savepoint copy_event_rows')
+        return inserted
+    except psycopg2.DataError as data_error:
+        cursor.execute('rollback to savepoint copy_event_rows')
+        if len(rows) == 1:
+            print error_prefix + str(data_error)
+            return 0
+        middle = len(rows) // 2
+        return (copy_event_rows(cursor, event_sql, rows[:middle], staging_tables, error_prefix) +
+                copy_event_rows(cursor, event_sql, rows[middle:], staging_tables, error_prefix))
+
+def read_lines(file):
+    # Yields the lines of file, without newlines, reading it in chunks rather
+    # than all at once. A last line with no newline may still be being
+    # written, so it's left for the next run.
+    remainder = ''
+    while True:
+        chunk = file.read(PARSE_READ_SIZE)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+
+def get_log_file_rotation(filename):
+    # psiphonv.log is 0, psiphonv.log.1 is 1, psiphonv.log.2.gz is 2, etc.
+    # None for other file names
+    match = ROTATED_LOG_FILENAME_RE.match(filename)
+    if not match:
+        return None
+    return int(match.group(1) or 0)
+
+def parse_log_file(args):
+    '''
+    Runs in a parse worker process. Streams the log file at path, in file
+    order, and puts messages on queue:
+
+    ('start', head_digest, offset): head_digest identifies the file by its
+    first line, and offset is where parsing starts: the offset of the
+    checkpoint in checkpoints (a dict of head_digest to offset) for the file,
+    or 0.
+    ('rows', rows, errors, offset, last_timestamp): rows is a list of
+    (event_type, field_values) ready to be loaded, from the lines before
+    offset.
+    ('done', reached_watermark, offset, last_timestamp): reached_watermark is
+    True when the file has no checkpoint and has lines from before the
+    last_timestamp watermark.
+
+    On an exception, puts ('error', traceback) instead.
+    '''
+    (queue, path, host_id, checkpoints, last_timestamp, server_ip_address_to_id,
+     excluded_propagation_channel_ids, minimal) = args
+
+    try:
+        line_re = re.compile(LOG_LINE_PATTERN)
+
+        reached_watermark = False
+        next_last_timestamp = None
+        rows = []
+        errors = []
+
+        if path.endswith('.gz'):
+            # Older log file archives are in gzip format
+            file = gzip.open(path)
+        else:
+            file = open(path)
+        try:
+            head = file.readline()
+            head_digest = hashlib.sha1(head).hexdigest() if head.endswith('\n') else None
+            offset = checkpoints.get(head_digest, 0)
+            if not path.endswith('.gz') and offset > os.fstat(file.fileno()).st_size:
+                # Truncated and rewritten in place
+                offset = 0
+            if offset > 0:
+                # Only the lines after the checkpoint are new. The offset is
+                # into the uncompressed contents; a gzip archive seeks by
+                # decompressing up to it, which is still much cheaper than
+                # parsing.
+                last_timestamp = None
+            file.seek(offset)
+            queue.put(('start', head_digest, offset))
+
+            for line in read_lines(file):
+                offset += len(line) + 1
+                match = line_re.match(line)
+                if (not match or
+                    not LOG_EVENT_TYPE_SCHEMA.has_key(match.group(3))):
+                    errors.append('unexpected log line pattern: %s' % (line,))
+                    continue
+
+                # Note: We convert timestamps here to UTC so that they can all be rationally compared without
+                #       taking the timezone into consideration. This eases matching of outbound statistics
+                #       (and any other records that may not have consistent timezone info) to sessions.
+
+                timestamp = match.group(1)
+
+                # If we cannot parse the matched string as an ISO8601 timestamp, zero out the time and
+                # try to produce a valid timestamp. If this fails too, don't change the matched timestamp
+                timestamp = fix_timestamp(timestamp)
+
+                # Last timestamp check
+                # Note: - assuming lexicographical order (UTC, in the fixed format fix_timestamp returns)
+                #       - currently broken for a backwards moving server clock
+                #       - Strict < check to not skip new logs in same time... but this will
+                #         also guarantee reprocessing of the last line for each host
+
+                if last_timestamp and timestamp < last_timestamp:
+                    # Lines are in chronological order, so only the lines
+                    # after this one can be new
+                    reached_watermark = True
+                    continue
+
+                event_type = match.group(3)
+
+                if minimal:
+                    if event_type not in ['connected', 'page_views']:
+                        continue
+
+                if not next_last_timestamp or timestamp > next_last_timestamp:
+                    next_last_timestamp = timestamp
+
+                event_values = [event_value.decode('utf-8', 'replace') for event_value in match.group(4).split()]
+                event_fields = LOG_EVENT_TYPE_SCHEMA[event_type]
+
+                if len(event_values) != len(event_fields):
+                    # Backwards compatibility case
+                    event_type = '%s.%d' % (event_type, len(event_values))
+                    if event_type not in LOG_EVENT_TYPE_SCHEMA:
+                        errors.append('invalid log line fields %s' % (line,))
+                        continue
+                    event_fields = LOG_EVENT_TYPE_SCHEMA[event_type]
+
+                if len(event_values) != len(event_fields):
+                    errors.append('invalid log line fields %s' % (line,))
+                    continue
+
+                field_names = LOG_ENTRY_COMMON_FIELDS + event_fields
+
+                field_values = [timestamp, host_id] + event_values
+                assert(len(field_names) == len(field_values))
+
+                # Check for invalid bytes value for bytes_transferred
+
+                if event_type == 'bytes_transferred.8':
+                    assert(field_names[9] == 'bytes')
+                    # Client version 24 had a bug which resulted in
+                    # corrupt byte transferred values, so discard them
+                    assert(field_names[6] == 'client_version')
+                    if int(field_values[6]) == 24:
+                        continue
+
+                invalid_byte_field = False
+                for index, field_name in enumerate(field_names):
+                    if field_name == 'bytes':
+                        # This is an integer field
+                        if not (0 <= int(field_values[index]) < 2147483647):
+                            err = 'invalid byte fields %s' % (line,)
+                            print err
+                            errors.append(err)
+                            invalid_byte_field = True
+                            break
+                if invalid_byte_field:
+                    continue
+
+                # Don't record entries for testing or deployment-validation logs
+                try:
+                    if field_values[field_names.index('propagation_channel_id')] in excluded_propagation_channel_ids:
+                        continue
+                except:
+                    # propagation_channel_id is not present
+                    pass
+
+                # Replace server IP addresses with server IDs in
+                # stats to keep IP addresses confidental in reporting.
+
+                for index, field_name in enumerate(field_names):
+                    if field_name == 'server_id' or field_name == 'discovery_server_id':
+                        field_values[index] = server_ip_address_to_id.get(field_values[index], 'Unknown')
+
+                # Fixup for last_connected: this field (in the log) contains either a timestamp,
+                # 'None' (meaning a first time connection), or 'Unknown' (meaning an old client that
+                # doesn't send this info connected)
+                if event_type.find('connected') == 0:
+                    for index, field_name in enumerate(field_names):
+                        if field_name == 'last_connected':
+                            if field_values[index] == 'Unknown':
+                                field_values[index] = None
+                            elif field_values[index] == 'None':
+                                field_values[index] = '1900-01-01T00:00:00Z'
+                            else:
+                                field_values[index] = fix_timestamp(field_values[index])
+
+                rows.append((event_type, field_values))
+                if len(rows) >= PARSE_BATCH_SIZE:
+                    queue.put(('rows', rows, errors, offset, next_last_timestamp))
+                    rows = []
+                    errors = []
+        finally:
+            file.close()
+
+        if rows or errors:
+            queue.put(('rows', rows, errors, offset, next_last_timestamp))
+        queue.put(('done', reached_watermark, offset, next_last_timestamp))
+    except Exception:
+        queue.put(('error', traceback.format_exc()))
+
+def process_stats(host, servers, db_cur, psinet, minimal, parse_pool, manager, error_file=None):
 
     print 'process stats from host %s...' % (host.id,)
 
@@ -429,57 +794,118 @@ def process_stats(host, servers, db_cur, psinet, minimal, error_file=None):
     for server in servers:
         server_ip_address_to_id[server.internal_ip_address] = server.id
 
-    line_re = re.compile(LOG_LINE_PATTERN)
-
-    # Download each log file from the host, parse each line and insert
-    # log entries into database.
+    # Each log file is parsed in a parse_pool worker process, which streams
+    # batches of parsed log entries through a bounded queue to this thread,
+    # which inserts them into the database.
 
     directory = os.path.join(LOCAL_LOG_ROOT, host.id)
     if not os.path.exists(directory):
         return
 
-    # Only process logs lines after last timestamp processed. This gives a
-    # significant performance boost.
+    # Each log file has a checkpoint, recording how much of it has been
+    # processed. Unchanged files are skipped, and changed files are parsed
+    # from their checkpoint on. A file is matched to its checkpoint by a
+    # digest of its first line, so a checkpoint follows the file's contents
+    # through log rotation, when psiphonv.log becomes psiphonv.log.1 and then
+    # psiphonv.log.2.gz. An unchanged file is recognized by the inode and size
+    # recorded with its checkpoint, whatever its name, so a file that rotation
+    # only renamed isn't opened again.
+
+    db_cur[None].execute(
+        'select head_digest, filename, inode, size, "offset" from processed_log_files where host_id = %s',
+        [host.id])
+    # Like { (inode, size): (head_digest, filename) }
+    unchanged_files = {}
+    checkpoint_offsets = {}
+    for head_digest, filename, inode, size, offset in db_cur[None].fetchall():
+        if inode is not None:
+            unchanged_files[(inode, size)] = (head_digest, filename)
+        checkpoint_offsets[head_digest] = offset
+
+    # Files without a checkpoint, as on the first run with checkpoints, are
+    # only processed from the lines after the last timestamp processed.
 
     db_cur[None].execute(
         'select last_timestamp from processed_logs where host_id = %s',
         [host.id])
     last_timestamp = db_cur[None].fetchone()
     if last_timestamp:
-        last_timestamp = last_timestamp[0]
-    next_last_timestamp = None
+        # Older runs stored the timestamp with its original offset
+        last_timestamp = fix_timestamp(last_timestamp[0])
+    next_last_timestamp = [last_timestamp]
 
     # Prepare some loop invariant formatted strings. Gives a significant
     # performance boots vs. formatting per log line.
 
-    event_columns = {}
     event_sql = {}
 
     for event_type, event_fields in LOG_EVENT_TYPE_SCHEMA.iteritems():
-        event_columns[event_type] = LOG_ENTRY_COMMON_FIELDS + event_fields
         assert(event_fields[0] == 'server_id' or 'server_id' not in event_fields)
         assert(len(LOG_ENTRY_COMMON_FIELDS) == 2)
         table_name = event_type
         if event_type.find('.') != -1:
             table_name = event_type.split('.')[0]
-        command = 'insert into %s (%s) select %s where not exists (select 1 from %s where %s)' % (
-                        table_name,
-                        ', '.join(event_columns[event_type]),
-                        ', '.join(['%s']*len(event_columns[event_type])),
-                        table_name,
-                        ' and '.join(['%s = %%s' % x for x in event_columns[event_type]]))
-        event_sql[event_type] = command
-
-        # Add special case statement to use when last_connected is NULL
-        if 'last_connected' in event_columns[event_type]:
-            command = 'insert into %s (%s) select %s where not exists (select 1 from %s where %s)' % (
-                            table_name,
-                            ', '.join(event_columns[event_type]),
-                            ', '.join(['%s']*len(event_columns[event_type])),
-                            table_name,
-                            ' and '.join([('%s is %%s' % x) if x == 'last_connected' else ('%s = %%s' % x)
-                                        for x in event_columns[event_type]]))
-            event_sql[event_type + '.last_connected_NULL'] = command
+        event_sql[event_type] = make_event_sql(event_type, table_name, LOG_ENTRY_COMMON_FIELDS + event_fields)
+
+    # Parsed rows are buffered per event type and loaded in batches
+    event_rows = collections.defaultdict(list)
+    staging_tables = set()
+
+    def flush_event_rows(event_type, filename):
+        # SQL injection note: the table name isn't parameterized
+        # and comes from log file data, but it's implicitly
+        # validated by hash table lookups
+        table = event_type
+        if table.find('.') != -1:
+            table = table.split('.')[0]
+        if table in db_cur:
+            cursor = db_cur[table]
+        else:
+            cursor = db_cur[None]
+        rows = event_rows.pop(event_type, [])
+        if not rows:
+            return 0
+        return copy_event_rows(cursor, event_sql[event_type], rows, staging_tables,
+                               host.id + ': ' + filename + ': ')
+
+    def checkpoint(filename, stat, head_digest, offset, file_last_timestamp):
+        # Loads all buffered rows and commits them with the file's
+        # checkpoint. stat is None before the whole file is processed, so that
+        # an interrupted file isn't taken as unchanged. A file without a whole
+        # first line has no head_digest and no checkpoint. Returns the number
+        # of rows inserted.
+        # With a DB_MAP, some rows are in other databases and are committed
+        # first: if the checkpoint then fails to commit, those rows are
+        # processed again and discarded as duplicates.
+        inserted = 0
+        for event_type in event_rows.keys():
+            inserted += flush_event_rows(event_type, filename)
+        for table, cursor in db_cur.iteritems():
+            if table is not None:
+                cursor.connection.commit()
+        if file_last_timestamp and (not next_last_timestamp[0] or file_last_timestamp > next_last_timestamp[0]):
+            next_last_timestamp[0] = file_last_timestamp
+        inode, size = (stat.st_ino, stat.st_size) if stat else (None, None)
+        if head_digest:
+            db_cur[None].execute(
+                'update processed_log_files set filename = %s, inode = %s, size = %s, "offset" = %s, last_timestamp = %s ' +
+                'where host_id = %s and head_digest = %s',
+                [filename, inode, size, offset, file_last_timestamp, host.id, head_digest])
+            db_cur[None].execute(
+                'insert into processed_log_files (host_id, head_digest, filename, inode, size, "offset", last_timestamp) ' +
+                'select %s, %s, %s, %s, %s, %s, %s ' +
+                'where not exists (select 1 from processed_log_files where host_id = %s and head_digest = %s)',
+                [host.id, head_digest, filename, inode, size, offset, file_last_timestamp, host.id, head_digest])
+        if next_last_timestamp[0]:
+            db_cur[None].execute(
+                'update processed_logs set last_timestamp = %s where host_id = %s',
+                [next_last_timestamp[0], host.id])
+            db_cur[None].execute(
+                'insert into processed_logs (host_id, last_timestamp) select %s, %s ' +
+                'where not exists (select 1 from processed_logs where host_id = %s)',
+                [host.id, next_last_timestamp[0], host.id])
+        db_cur[None].connection.commit()
+        return inserted
 
     # Don't record entries for testing or deployment-validation logs.
     # Manual and automated testing are typically done with a propagation channel
@@ -490,171 +916,75 @@ def process_stats(host, servers, db_cur, psinet, minimal, error_file=None):
     if TESTING_PROPAGATION_CHANNEL_NAME:
         excluded_propagation_channel_ids += [psinet.get_propagation_channel_by_name(TESTING_PROPAGATION_CHANNEL_NAME).id]
 
-    for filename in os.listdir(directory):
-        if re.match(HOST_LOG_FILENAME_PATTERN, filename):
-            path = os.path.join(directory, filename)
-            if filename.endswith('.gz'):
-                # Older log file archives are in gzip format
-                file = gzip.open(path)
-            else:
-                file = open(path)
-            print 'processing %s...' % (filename,)
-            lines_processed = 0
-            try:
-                lines = file.read().split('\n')
-                for line in reversed(lines):
-                    match = line_re.match(line)
-                    if (not match or
-                        not LOG_EVENT_TYPE_SCHEMA.has_key(match.group(3))):
-                        err = 'unexpected log line pattern: %s' % (line,)
-                        if error_file:
-                            error_file.write(err + '\n')
-                        continue
-
-                    # Note: We convert timestamps here to UTC so that they can all be rationally compared without
-                    #       taking the timezone into consideration. This eases matching of outbound statistics
-                    #       (and any other records that may not have consistent timezone info) to sessions.
-                    # Update: no longer calling iso8601_to_utc(timestamp) as database can perform translation
-
-                    timestamp = match.group(1)
-
-                    # If we cannot parse the matched string as an ISO8601 timestamp, zero out the time and
-                    # try to produce a valid timestamp. If this fails too, don't change the matched timestamp
-                    timestamp = fix_timestamp(timestamp)
-
-                    # Last timestamp check
-                    # Note: - assuming lexicographical order (ISO8601)
-                    #       - currently broken for 1 hour DST window or backwards moving server clock
-                    #       - Strict < check to not skip new logs in same time... but this will
-                    #         also guarantee reprocessing of the last line for each host
-
-                    if last_timestamp and timestamp < last_timestamp:
-                        # Assumes processing the lines in reverse chronological order
-                        break
-
-                    host_id = host.id
-                    event_type = match.group(3)
-
-                    if minimal:
-                        if event_type not in ['connected', 'page_views']:
-                            continue
-
-                    if not next_last_timestamp or timestamp > next_last_timestamp:
-                        next_last_timestamp = timestamp
-
-                    event_values = [event_value.decode('utf-8', 'replace') for event_value in match.group(4).split()]
-                    event_fields = LOG_EVENT_TYPE_SCHEMA[event_type]
-
-                    if len(event_values) != len(event_fields):
-                        # Backwards compatibility case
-                        event_type = '%s.%d' % (event_type, len(event_values))
-                        if event_type not in LOG_EVENT_TYPE_SCHEMA:
-                            err = 'invalid log line fields %s' % (line,)
-                            if error_file:
-                                error_file.write(err + '\n')
-                            continue
-                        event_fields = LOG_EVENT_TYPE_SCHEMA[event_type]
-
-                    if len(event_values) != len(event_fields):
-                        err = 'invalid log line fields %s' % (line,)
-                        if error_file:
-                            error_file.write(err + '\n')
-                        continue
-
-                    field_names = event_columns[event_type]
-
-                    field_values = [timestamp, host_id] + event_values
-                    assert(len(field_names) == len(field_values))
-
-                    # Check for invalid bytes value for bytes_transferred
-
-                    if event_type == 'bytes_transferred.8':
-                        assert(field_names[9] == 'bytes')
-                        # Client version 24 had a bug which resulted in
-                        # corrupt byte transferred values, so discard them
-                        assert(field_names[6] == 'client_version')
-                        if int(field_values[6]) == 24:
-                            continue
-
-                    invalid_byte_field = False
-                    for index, field_name in enumerate(field_names):
-                        if field_name == 'bytes':
-                            # This is an integer field
-                            if not (0 <= int(field_values[index]) < 2147483647):
-                                err = 'invalid byte fields %s' % (line,)
-                                print err
-                                if error_file:
-                                    error_file.write(err + '\n')
-                                invalid_byte_field = True
-                                break
-                    if invalid_byte_field:
-                        continue
-
-                    # Don't record entries for testing or deployment-validation logs
-                    try:
-                        if field_values[field_names.index('propagation_channel_id')] in excluded_propagation_channel_ids:
-                            continue
-                    except:
-                        # propagation_channel_id is not present
-                        pass
-
-                    # Replace server IP addresses with server IDs in
-                    # stats to keep IP addresses confidental in reporting.
-
-                    for index, field_name in enumerate(field_names):
-                        if field_name == 'server_id' or field_name == 'discovery_server_id':
-                            field_values[index] = server_ip_address_to_id.get(field_values[index], 'Unknown')
-
-                    # Fixup for last_connected: this field (in the log) contains either a timestamp,
-                    # 'None' (meaning a first time connection), or 'Unknown' (meaning an old client that
-                    # doesn't send this info connected)
-                    if event_type.find('connected') == 0:
-                        for index, field_name in enumerate(field_names):
-                            if field_name == 'last_connected':
-                                if field_values[index] == 'Unknown':
-                                    # Use alternate SQL that works with NULL values
-                                    event_type += '.last_connected_NULL'
-                                    field_values[index] = None
-                                elif field_values[index] == 'None':
-                                    field_values[index] = '1900-01-01T00:00:00Z'
-                                else:
-                                    field_values[index] = fix_timestamp(field_values[index])
-
-                    # SQL injection note: the table name isn't parameterized
-                    # and comes from log file data, but it's implicitly
-                    # validated by hash table lookups
-
-                    command = event_sql[event_type]
-
-                    try:
-                        table = event_type
-                        if table.find('.') != -1:
-                            table = table.split('.')[0]
-                        if table in db_cur:
-                            cursor = db_cur[table]
-                        else:
-                            cursor = db_cur[None]
-                        cursor.execute(command, field_values + field_values)
-                    except psycopg2.DataError as data_error:
-                        print host.id + ': ' + filename + ': ' + str(data_error)
-
+    # Process the newest log files first. Before there are any checkpoints,
+    # once a log file reaches the last timestamp, the older rotated log files
+    # can't have new lines.
+    filenames = [filename for filename in os.listdir(directory)
+                 if re.match(HOST_LOG_FILENAME_PATTERN, filename)]
+    filenames.sort(key=lambda filename: (get_log_file_rotation(filename) is None,
+                                         get_log_file_rotation(filename),
+                                         filename))
+    queue = manager.Queue(PARSE_QUEUE_SIZE)
+    reached_watermark = False
+
+    for filename in filenames:
+        if reached_watermark and get_log_file_rotation(filename) is not None:
+            continue
+        path = os.path.join(directory, filename)
+        stat = os.stat(path)
+        unchanged_file = unchanged_files.get((stat.st_ino, stat.st_size))
+        if unchanged_file:
+            head_digest, checkpoint_filename = unchanged_file
+            if checkpoint_filename != filename:
+                # Renamed by log rotation
+                db_cur[None].execute(
+                    'update processed_log_files set filename = %s where host_id = %s and head_digest = %s',
+                    [filename, host.id, head_digest])
+            continue
+        print 'processing %s...' % (filename,)
+        lines_processed = 0
+        lines_inserted = 0
+        buffered_rows = 0
+        parse_pool.apply_async(parse_log_file, [(queue, path, host.id, checkpoint_offsets, last_timestamp,
+                                                 server_ip_address_to_id, excluded_propagation_channel_ids,
+                                                 minimal)])
+        message = queue.get()
+        try:
+            if message[0] == 'start':
+                head_digest, start_offset = message[1:]
+                message = queue.get()
+            while message[0] == 'rows':
+                for event_type, field_values in message[1]:
+                    event_rows[event_type].append(field_values)
                     lines_processed += 1
-
-            finally:
-                file.close()
-
-            print '%d new lines processed' % (lines_processed)
-            sys.stdout.flush()
-
-    if next_last_timestamp:
-        if not last_timestamp:
-            db_cur[None].execute(
-                'insert into processed_logs (host_id, last_timestamp) values (%s, %s)',
-                [host.id, next_last_timestamp])
-        else:
-            db_cur[None].execute(
-                'update processed_logs set last_timestamp = %s where host_id = %s',
-                [next_last_timestamp, host.id])
+                buffered_rows += len(message[1])
+                if error_file:
+                    for err in message[2]:
+                        error_file.write(err + '\n')
+                if buffered_rows >= COPY_BATCH_SIZE:
+                    lines_inserted += checkpoint(filename, None, head_digest, message[3], message[4])
+                    buffered_rows = 0
+                message = queue.get()
+        finally:
+            # Drain the queue so that the worker isn't left blocked on it
+            while message[0] in ('start', 'rows'):
+                message = queue.get()
+
+        if message[0] == 'error':
+            raise Exception('failed to parse %s: %s' % (path, message[1]))
+        file_reached_watermark, offset, file_last_timestamp = message[1:]
+        if file_reached_watermark and not checkpoint_offsets and get_log_file_rotation(filename) is not None:
+            reached_watermark = True
+
+        lines_inserted += checkpoint(filename, stat, head_digest, offset, file_last_timestamp)
+
+        print '%d new lines processed from offset %d, %d inserted' % (lines_processed, start_offset, lines_inserted)
+        sys.stdout.flush()
+
+    # Remove the checkpoints of files that are gone
+    db_cur[None].execute(
+        'delete from processed_log_files where host_id = %s and not (filename = any(%s))',
+        [host.id, filenames])
 
 
 def reconstruct_sessions(db):
@@ -736,6 +1066,8 @@ def process_stats_on_host(args):
     servers = args[1]
     psinet = args[2]
     minimal = args[3]
+    parse_pool = args[4]
+    manager = args[5]
 
     db_conn = build_db_connections()
     cursors = {}
@@ -743,7 +1075,7 @@ def process_stats_on_host(args):
     try:
         for table, conn in db_conn.iteritems():
             cursors[table] = conn.cursor()
-        process_stats(host, servers, cursors, psinet, minimal)
+        process_stats(host, servers, cursors, psinet, minimal, parse_pool, manager)
         for cursor in cursors.itervalues():
             cursor.close()
         for connection in db_conn.itervalues():
@@ -784,12 +1116,22 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-m', '--minimal', dest='minimal', action='store_true',
                         help='minimal processing')
+    parser.add_argument('--benchmark', dest='benchmark', action='store_true',
+                        help='check and time log timestamp parsing, then exit')
     args = parser.parse_args()
 
+    if args.benchmark:
+        sys.exit(0 if benchmark_timestamps() else 1)
+
     start_time = time.time()
 
     psinet = psi_ops.PsiphonNetwork.load_from_file(PSI_OPS_DB_FILENAME)
 
+    # Log parsing is CPU bound, so it runs in a process per core. The parse
+    # workers are started before any database connections or threads exist.
+    parse_pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    manager = multiprocessing.Manager()
+
     db_conn = build_db_connections()
     print db_conn
 
@@ -803,8 +1145,10 @@ if __name__ == "__main__":
         update_sponsors(db_conn[None], sponsors)
         update_servers(db_conn[None], psinet)
 
-        pool = multiprocessing.pool.ThreadPool(4)
-        results = pool.map(process_stats_on_host, [(host, servers, psinet, args.minimal) for host in hosts])
+        # One database thread per parse worker, each processing one host at a time
+        pool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+        results = pool.map(process_stats_on_host, [(host, servers, psinet, args.minimal, parse_pool, manager)
+                                                   for host in hosts])
 
         # print results as a dict (sorted for visual inspection)
         print '{' + ','.join(['"%s": %f' % (host_id, host_time) for (host_id, host_time)
@@ -821,5 +1165,7 @@ if __name__ == "__main__":
     finally:
         for connection in db_conn.itervalues():
             connection.close()
+        parse_pool.terminate()
+        manager.shutdown()
 
     print 'Total stats processing elapsed time: %fs' % (time.time()-start_time,)
@@ -10,6 +10,28 @@ WITH (
   OIDS=FALSE
 );
 
+-- Table: processed_log_files
+
+-- A checkpoint per log file: the bytes of the (uncompressed) file processed
+-- so far, and the file's name, inode and size when it was processed. Log
+-- files are identified by head_digest, a digest of their first line, so that
+-- a checkpoint follows a file's contents when log rotation renames it.
+
+CREATE TABLE processed_log_files
+(
+  host_id text NOT NULL,
+  head_digest text NOT NULL,
+  filename text NOT NULL,
+  inode bigint,
+  size bigint,
+  "offset" bigint NOT NULL DEFAULT 0,
+  last_timestamp text,
+  CONSTRAINT processed_log_files_pkey PRIMARY KEY (host_id, head_digest)
+)
+WITH (
+  OIDS=FALSE
+);
+
 -- Table: connected
 
 CREATE TABLE connected
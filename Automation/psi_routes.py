@@ -201,20 +201,23 @@ def make_routes():
 
 def make_signed_routes(pem_key_pair, private_key_password):
     make_routes()
+    paths = []
+    routes_data = []
     for root, dirs, files in os.walk(GEO_ROUTES_ROOT):
         for name in files:
             if(name.endswith(GEO_ROUTES_EXTENSION)):
                 path = os.path.join(root, name)
                 with open(path, 'rb') as file:
                     data = file.read()
-                signed_routes_data  =  psi_ops_crypto_tools.make_signed_data(
-                        pem_key_pair,
-                        private_key_password,
-                        base64.b64encode(data))
-
-                signed_routes_filename = path + GEO_ROUTES_SIGNED_EXTENSION
-                with open(signed_routes_filename, 'w') as f:
-                    f.write(signed_routes_data)
+                paths.append(path)
+                routes_data.append(base64.b64encode(data))
+
+    # Sign all route files as one batch, across a process pool
+    signer = psi_ops_crypto_tools.get_signer(pem_key_pair, private_key_password)
+    for path, signed_routes_data in zip(paths, signer.sign_many(routes_data)):
+        signed_routes_filename = path + GEO_ROUTES_SIGNED_EXTENSION
+        with open(signed_routes_filename, 'w') as f:
+            f.write(signed_routes_data)
 
 if __name__ == "__main__":
     make_routes()
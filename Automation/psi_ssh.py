@@ -17,10 +17,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import atexit
 import base64
 import os
 import sys
 import socket
+import threading
 import time
 
 from io import StringIO
@@ -31,20 +33,164 @@ except ImportError as error:
     print(error)
     import ssh
 
+# Total time make_ssh_session waits between connection attempts, and the
+# longest single wait
+SSH_SESSION_WAIT_SECONDS = 60
+SSH_SESSION_MAX_RETRY_DELAY_SECONDS = 10
+
+# Authenticated connections released by SSH.close() are kept this long for
+# reuse by later SSH objects for the same host and credentials
+SSH_POOL_IDLE_TIMEOUT_SECONDS = 120
+SSH_POOL_MAX_IDLE_PER_HOST = 4
+
+# A pooled connection must open a session channel within this time to be
+# reused; otherwise a fresh connection is made
+SSH_POOL_HEALTH_CHECK_TIMEOUT_SECONDS = 5
+
+
 # SSH sessions are attempted soon after linodes are started.  We don't know when the ssh service
-# will be available so we can try every few seconds for up to a minute.
+# will be available so we retry, backing off from one second to every few seconds, for up to a minute.
 # This is basically a retrying SSH factory.
 def make_ssh_session(ip_address, ssh_port, username, password, host_public_key, host_auth_key=None, verbose=True):
-    for attempt in range(12):
+    waited = 0
+    delay = 1
+    while True:
         try:
             ssh = SSH(ip_address, ssh_port, username, password, host_public_key, host_auth_key)
             return ssh
         except socket.error:
+            if waited >= SSH_SESSION_WAIT_SECONDS:
+                break
             if verbose: print('Waiting for ssh...')
-            time.sleep(5)
+            time.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, SSH_SESSION_MAX_RETRY_DELAY_SECONDS)
     raise Exception('Took too long to establish an ssh session')
 
 
+class SSHConnectionPool(object):
+    '''
+    Process-wide pool of idle, authenticated SSH connections.
+
+    Connections are keyed by address, port, host key and credentials, and each
+    is used by only one SSH object at a time. An idle connection keeps its SFTP
+    session open for reuse. Before reuse, an idle connection must open a
+    session channel within SSH_POOL_HEALTH_CHECK_TIMEOUT_SECONDS. Idle
+    connections are closed after SSH_POOL_IDLE_TIMEOUT_SECONDS.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = {}
+        self.reaper = None
+
+    def acquire(self, key):
+        # Returns (client, sftp) for a healthy idle connection, or None. The
+        # health check round trip is made outside the lock.
+        while True:
+            with self.lock:
+                self.__reset_after_fork()
+                connections = self.idle.get(key, [])
+                if not connections:
+                    return None
+                client, sftp, _ = connections.pop()
+            if _is_healthy(client):
+                return client, sftp
+            _close_client(client, sftp)
+
+    def release(self, key, client, sftp):
+        if not _is_active(client):
+            _close_client(client, sftp)
+            return
+        with self.lock:
+            self.__reset_after_fork()
+            connections = self.idle.setdefault(key, [])
+            connections.append((client, sftp, time.time()))
+            while len(connections) > SSH_POOL_MAX_IDLE_PER_HOST:
+                client, sftp, _ = connections.pop(0)
+                _close_client(client, sftp)
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.__reap_idle_connections)
+                self.reaper.daemon = True
+                self.reaper.start()
+
+    def close_all(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            for connections in self.idle.values():
+                for client, sftp, _ in connections:
+                    _close_client(client, sftp)
+            self.idle = {}
+
+    def __reset_after_fork(self):
+        # Connections inherited by a forked process belong to the parent
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle = {}
+            self.reaper = None
+
+    def __reap_idle_connections(self):
+        while True:
+            time.sleep(SSH_POOL_IDLE_TIMEOUT_SECONDS / 4)
+            with self.lock:
+                expired = time.time() - SSH_POOL_IDLE_TIMEOUT_SECONDS
+                for key in list(self.idle.keys()):
+                    for connection in [c for c in self.idle[key] if c[2] < expired]:
+                        self.idle[key].remove(connection)
+                        _close_client(connection[0], connection[1])
+                    if not self.idle[key]:
+                        del self.idle[key]
+                if not self.idle:
+                    self.reaper = None
+                    return
+
+
+def _is_active(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+def _is_healthy(client):
+    # An active transport may still belong to a host that has rebooted or
+    # dropped off the network, so require the server to open a channel
+    if not _is_active(client):
+        return False
+    try:
+        channel = client.get_transport().open_session(timeout=SSH_POOL_HEALTH_CHECK_TIMEOUT_SECONDS)
+        channel.close()
+    except Exception:
+        return False
+    return True
+
+
+def _close_client(client, sftp=None):
+    if sftp is not None:
+        try:
+            sftp.close()
+        except Exception:
+            pass
+    try:
+        transport = client.get_transport()
+        if transport and transport.sock:
+            transport.sock.settimeout(1)
+    except Exception:
+        pass
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+connection_pool = SSHConnectionPool()
+atexit.register(connection_pool.close_all)
+
+
+def close_pooled_connections():
+    connection_pool.close_all()
+
+
 class SSH(object):
 
     def __init__(self,
@@ -53,14 +199,29 @@ class SSH(object):
                  ssh_username,
                  ssh_password,
                  ssh_host_key,
-                 ssh_pkey=None):
+                 ssh_pkey=None,
+                 pooled=True):
         '''
         If used, ssh_pkey must be a string with the complete PEM file contents.
+
+        When pooled, an idle connection to the same host with the same
+        credentials is reused if available, and close() returns the connection
+        to the pool instead of closing it. Use close(discard=True) after
+        rebooting the host.
         '''
 
-        self.ssh = ssh.SSHClient()
         self.ip_address = ip_address
         ssh_port = int(ssh_port)
+        self.sftp = None
+        self.pool_key = None
+        if pooled:
+            self.pool_key = (ip_address, ssh_port, ssh_username, ssh_password, ssh_host_key, ssh_pkey)
+            connection = connection_pool.acquire(self.pool_key)
+            if connection is not None:
+                self.ssh, self.sftp = connection
+                return
+
+        self.ssh = ssh.SSHClient()
         if ssh_host_key == None:
             self.ssh.set_missing_host_key_policy(ssh.AutoAddPolicy())
         else:
@@ -94,20 +255,44 @@ class SSH(object):
         try:
             self.ssh.connect(ip_address, ssh_port, ssh_username, ssh_password, pkey=ssh_pkey, timeout=30, banner_timeout=45, auth_timeout=45)
         except Exception:
+            self.pool_key = None
             self.close()
             raise
 
-    def close(self):
-        try:
-            transport = self.ssh.get_transport()
-            if transport and transport.sock:
-                transport.sock.settimeout(1)
-        except Exception:
-            pass
+    def close(self, discard=False):
+        if self.ssh is None:
+            return
+        if self.pool_key is not None and not discard:
+            connection_pool.release(self.pool_key, self.ssh, self.sftp)
+        else:
+            _close_client(self.ssh, self.sftp)
+        self.ssh = None
+        self.sftp = None
+
+    def __open_sftp(self, timeout=None):
+        # The SFTP session is kept open for later calls, and with the pooled
+        # connection, for later SSH objects
+        if self.sftp is None or self.sftp.get_channel().closed:
+            self.sftp = self.ssh.open_sftp()
+        self.sftp.get_channel().settimeout(timeout)
+        return self.sftp
+
+    def __discard_sftp(self):
+        # After a failed operation the session may be unusable
+        if self.sftp is not None:
+            try:
+                self.sftp.close()
+            except Exception:
+                pass
+            self.sftp = None
+
+    def __sftp_call(self, timeout, function):
+        sftp = self.__open_sftp(timeout)
         try:
-            self.ssh.close()
+            return function(sftp)
         except Exception:
-            pass
+            self.__discard_sftp()
+            raise
 
     def exec_command(self, command_line, muted=False, timeout=900):
         (_, output, _) = self.ssh.exec_command(command_line, timeout=timeout)
@@ -124,43 +309,52 @@ class SSH(object):
     def list_dir(self, remote_path, muted=False):
         if not muted:
             print('SSH %s: list dir %s' % (self.ip_address, remote_path))
-        sftp = self.ssh.open_sftp()
-        list = sftp.listdir(remote_path)
-        sftp.close()
-        return list
+        return self.__sftp_call(None, lambda sftp: sftp.listdir(remote_path))
 
     def list_dir_attributes(self, remote_path, muted=False):
         if not muted:
             print('SSH %s: list dir %s' % (self.ip_address, remote_path))
-        sftp = self.ssh.open_sftp()
-        list = sftp.listdir_attr(remote_path)
-        sftp.close()
-        return list
+        return self.__sftp_call(None, lambda sftp: sftp.listdir_attr(remote_path))
 
     def stat_file(self, remote_path, muted=False):
         if not muted:
             print('SSH %s: stat file %s' % (self.ip_address, remote_path))
-        sftp = self.ssh.open_sftp()
-        attributes = sftp.lstat(remote_path)
-        sftp.close()
-        return attributes
+        return self.__sftp_call(None, lambda sftp: sftp.lstat(remote_path))
 
     def put_file(self, local_path, remote_path, muted=False):
         if not muted:
             print('SSH %s: put file %s %s' % (self.ip_address, local_path, remote_path))
-        sftp = self.ssh.open_sftp()
-        try:
-            sftp.get_channel().settimeout(600)
-            sftp.put(local_path, remote_path)
-        finally:
-            sftp.close()
+        self.__sftp_call(600, lambda sftp: sftp.put(local_path, remote_path))
+
+    def put_files(self, local_and_remote_paths, muted=False):
+        # Uploads several files over a single SFTP session
+        def put_files(sftp):
+            for local_path, remote_path in local_and_remote_paths:
+                if not muted:
+                    print('SSH %s: put file %s %s' % (self.ip_address, local_path, remote_path))
+                sftp.put(local_path, remote_path)
+        self.__sftp_call(600, put_files)
 
     def get_file(self, remote_path, local_path, muted=False):
         if not muted:
             print('SSH %s: get file %s %s' % (self.ip_address, local_path, remote_path))
-        sftp = self.ssh.open_sftp()
-        try:
-            sftp.get_channel().settimeout(600)
-            sftp.get(remote_path, local_path)
-        finally:
-            sftp.close()
+        self.__sftp_call(600, lambda sftp: sftp.get(remote_path, local_path))
+
+    def get_file_range(self, remote_path, local_file, offset, length, muted=False):
+        # Copies length bytes of the remote file, from offset, to the open
+        # local_file, pipelining the reads like get_file
+        if not muted:
+            print('SSH %s: get file range %s %d+%d' % (self.ip_address, remote_path, offset, length))
+        def get_file_range(sftp):
+            with sftp.open(remote_path, 'rb') as remote_file:
+                remote_file.seek(offset)
+                if length > 0:
+                    remote_file.prefetch(offset + length)
+                remaining = length
+                while remaining > 0:
+                    data = remote_file.read(min(remaining, 1024*1024))
+                    if not data:
+                        raise Exception('%s is shorter than expected' % (remote_path,))
+                    local_file.write(data)
+                    remaining -= len(data)
+        self.__sftp_call(600, get_file_range)
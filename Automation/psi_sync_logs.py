@@ -21,13 +21,14 @@ import os
 import sys
 import time
 import re
-import multiprocessing
 import collections
 import json
-import pexpect
-import base64
 import hashlib
+import pipes
 import posixpath
+import shutil
+import traceback
+from multiprocessing.pool import ThreadPool
 
 import psi_ssh
 
@@ -37,33 +38,86 @@ HOST_LOG_FILENAME_PATTERN = 'psiphonv.log*'
 LOCAL_LOG_ROOT = os.path.join(os.path.abspath('.'), 'logs')
 PSI_OPS_DB_FILENAME = os.path.join(os.path.abspath('.'), 'psi_ops_stats.dat')
 
+# Hosts synced at once; each sync is one SSH connection, mostly waiting on
+# the network
+SYNC_CONCURRENCY = 50
 
-# Use this function on platforms with no rsync; it's much less efficient
-def pull_log_files(host):
-    start_time = time.time()
+# A local file is taken to be a prefix of a remote file when these many
+# bytes at its start and at its end match the remote file's
+SYNC_FINGERPRINT_SIZE = 4096
 
-    print 'pull log files from host %s...' % (host.id,)
+# Files are transferred to temporary files, named so that they don't match
+# HOST_LOG_FILENAME_PATTERN, and moved into place once verified
+SYNC_TEMP_PREFIX = '.'
+SYNC_TEMP_SUFFIX = '.sync-tmp'
 
-    ssh = psi_ssh.SSH(
-            host.ip_address, host.ssh_port,
-            host.stats_ssh_username, host.stats_ssh_password,
-            host.ssh_host_key)
 
-    dirlist = ssh.list_dir(HOST_LOG_DIR)
-    for filename in dirlist:
-        if re.match(HOST_LOG_FILENAME_PATTERN, filename):
-            try:
-                os.makedirs(os.path.join(LOCAL_LOG_ROOT, host.id))
-            except OSError:
-                pass
-            ssh.get_file(
-                posixpath.join(HOST_LOG_DIR, filename),
-                os.path.join(LOCAL_LOG_ROOT, host.id, filename))
-    ssh.close()
+# Syncing a host's logs into its local mirror directory:
+#
+# - The remote files are listed over SFTP. Local files with the same size
+#   and modification time as a remote file are taken to have the same
+#   contents, whether under the same name or, after log rotation renamed the
+#   remote file, another name.
+# - For the remaining files, a single remote command fingerprints the start
+#   and end of the remote files at the sizes of the local uncompressed logs.
+#   A local file that matches is a prefix of the remote file, so only the
+#   bytes appended since are transferred: the growth of the active log, or
+#   the last lines written to a log before rotation. Everything else, like a
+#   newly rotated gzip archive, is transferred whole.
+# - Transferred bytes go to temporary files and are checked against SHA-256
+#   digests from a second remote command. Then verified new files are moved
+#   into place, and verified appends are appended to the local file. So a
+#   local file only ever holds verified bytes, a prefix of the remote file,
+#   which the next sync continues from.
 
-    print 'completed host %s' % (host.id,)
 
-    return time.time()-start_time
+def get_sync_temp_path(dest, filename):
+    return os.path.join(dest, SYNC_TEMP_PREFIX + filename + SYNC_TEMP_SUFFIX)
+
+
+def get_local_fingerprint(path, size):
+    with open(path, 'rb') as file:
+        head = file.read(min(size, SYNC_FINGERPRINT_SIZE))
+        tail_offset = max(0, size - SYNC_FINGERPRINT_SIZE)
+        file.seek(tail_offset)
+        tail = file.read(size - tail_offset)
+    return hashlib.sha256(head + tail).hexdigest()
+
+
+def make_remote_fingerprint_command(path, size):
+    # Same bytes as get_local_fingerprint, for the first size bytes of path
+    tail_offset = max(0, size - SYNC_FINGERPRINT_SIZE)
+    return '{ head -c %d %s; tail -c +%d %s | head -c %d; } 2>/dev/null | sha256sum' % (
+        min(size, SYNC_FINGERPRINT_SIZE), pipes.quote(path),
+        tail_offset + 1, pipes.quote(path), size - tail_offset)
+
+
+def make_remote_digest_command(path, offset, length):
+    return 'tail -c +%d %s 2>/dev/null | head -c %d | sha256sum' % (
+        offset + 1, pipes.quote(path), length)
+
+
+def get_file_digest(path, offset=0):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        while True:
+            data = file.read(1024*1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def run_remote_digests(ssh, commands):
+    # Runs the digest commands in one remote shell, returning the digests
+    if not commands:
+        return []
+    output = ssh.exec_command('; '.join(commands), muted=True)
+    digests = [line.split()[0] for line in output.splitlines() if line.strip()]
+    if len(digests) != len(commands):
+        raise Exception('unexpected digest output: %s' % (output[:100],))
+    return digests
 
 
 def sync_log_files(host):
@@ -76,33 +130,118 @@ def sync_log_files(host):
     if not os.path.exists(dest):
         os.makedirs(dest)
 
-    # Get the RSA key fingerprint from the host's SSH_Host_Key
-    # Based on:
-    # http://stackoverflow.com/questions/6682815/deriving-an-ssh-fingerprint-from-a-public-key-in-python
-
-    base64_key = base64.b64decode(host.ssh_host_key.split(' ')[1])
-    md5_hash = hashlib.md5(base64_key).hexdigest()
-    fingerprint = ':'.join(a + b for a, b in zip(md5_hash[::2], md5_hash[1::2]))
-    command = 'rsync -ae "ssh -p %s -l %s" --include="%s" --exclude=* %s:%s/ %s' % (
-                 host.ssh_port,
-                 host.stats_ssh_username,
-                 HOST_LOG_FILENAME_PATTERN,
-                 host.ip_address,
-                 HOST_LOG_DIR,
-                 dest)
-    rsync = pexpect.spawn(command)
+    for filename in os.listdir(dest):
+        if filename.startswith(SYNC_TEMP_PREFIX) and filename.endswith(SYNC_TEMP_SUFFIX):
+            # Left by an interrupted sync
+            os.remove(os.path.join(dest, filename))
+
+    bytes_transferred = 0
+    ssh = None
     try:
-        prompt = rsync.expect([fingerprint, 'password:'])
-        if prompt == 0:
-            rsync.sendline('yes')
-            rsync.expect('password:')
-            rsync.sendline(host.stats_ssh_password)
-        else:
-            rsync.sendline(host.stats_ssh_password)
-        rsync.wait()
-        print 'completed host %s' % (host.id,)
-    except pexpect.ExceptionPexpect as e:
+        ssh = psi_ssh.SSH(
+                host.ip_address, host.ssh_port,
+                host.stats_ssh_username, host.stats_ssh_password,
+                host.ssh_host_key, pooled=False)
+
+        remote_files = [(attributes.filename, attributes.st_size, attributes.st_mtime)
+                        for attributes in ssh.list_dir_attributes(HOST_LOG_DIR, muted=True)
+                        if re.match(HOST_LOG_FILENAME_PATTERN, attributes.filename)]
+        local_files = {}
+        for filename in os.listdir(dest):
+            if re.match(HOST_LOG_FILENAME_PATTERN, filename):
+                stat = os.stat(os.path.join(dest, filename))
+                local_files[filename] = (stat.st_size, int(stat.st_mtime))
+
+        # For each remote file to sync, (source filename, source size): the
+        # local file its contents start with, or None
+        sources = {}
+        unmatched = []
+        for filename, size, mtime in remote_files:
+            if local_files.get(filename) == (size, mtime):
+                continue
+            same_files = [local_filename for local_filename, local_file in local_files.items()
+                          if local_file == (size, mtime)]
+            if same_files:
+                sources[filename] = (same_files[0], size)
+            else:
+                unmatched.append((filename, size))
+
+        # Local uncompressed logs that may be a prefix of a remote file,
+        # preferring the same file name and then the longest
+        candidates = []
+        for filename, size in unmatched:
+            if filename.endswith('.gz'):
+                continue
+            for local_filename, (local_size, _) in local_files.items():
+                if 0 < local_size <= size and not local_filename.endswith('.gz'):
+                    candidates.append((filename, local_filename, local_size))
+        remote_fingerprints = run_remote_digests(
+            ssh, [make_remote_fingerprint_command(posixpath.join(HOST_LOG_DIR, filename), local_size)
+                  for filename, _, local_size in candidates])
+        for (filename, local_filename, local_size), remote_fingerprint in zip(candidates, remote_fingerprints):
+            if remote_fingerprint != get_local_fingerprint(os.path.join(dest, local_filename), local_size):
+                continue
+            source = sources.get(filename)
+            if (source is None or
+                    (local_filename == filename, local_size) > (source[0] == filename, source[1])):
+                sources[filename] = (local_filename, local_size)
+
+        # Transfer into temporary files. Local files are only read here, so
+        # the sources are all as they were listed.
+        appends = set(filename for filename, (source, _) in sources.items() if source == filename)
+        transfers = []
+        for filename, size, mtime in remote_files:
+            if local_files.get(filename) == (size, mtime):
+                continue
+            source, offset = sources.get(filename, (None, 0))
+            temp_path = get_sync_temp_path(dest, filename)
+            if source is not None and source != filename:
+                if offset == size and source not in appends:
+                    os.link(os.path.join(dest, source), temp_path)
+                else:
+                    shutil.copyfile(os.path.join(dest, source), temp_path)
+            with open(temp_path, 'ab' if source != filename else 'wb') as temp_file:
+                if size > offset:
+                    ssh.get_file_range(posixpath.join(HOST_LOG_DIR, filename), temp_file, offset, size - offset,
+                                       muted=True)
+            bytes_transferred += size - offset
+            transfers.append((filename, size, mtime, source == filename, offset))
+
+        remote_digests = run_remote_digests(
+            ssh, [make_remote_digest_command(posixpath.join(HOST_LOG_DIR, filename), offset, size - offset)
+                  for filename, size, _, _, offset in transfers])
+
+        failed = []
+        for (filename, size, mtime, is_append, offset), remote_digest in zip(transfers, remote_digests):
+            temp_path = get_sync_temp_path(dest, filename)
+            path = os.path.join(dest, filename)
+            if remote_digest != get_file_digest(temp_path, 0 if is_append else offset):
+                # Changed or replaced while it was being transferred; the next
+                # sync will get it
+                os.remove(temp_path)
+                failed.append(filename)
+                continue
+            if is_append:
+                with open(temp_path, 'rb') as temp_file:
+                    with open(path, 'ab') as file:
+                        shutil.copyfileobj(temp_file, file)
+                        file.flush()
+                        os.fsync(file.fileno())
+                os.remove(temp_path)
+            else:
+                os.rename(temp_path, path)
+            os.utime(path, (mtime, mtime))
+
+        print 'completed host %s: %d bytes transferred%s' % (
+                host.id, bytes_transferred,
+                ', failed to verify %s' % (', '.join(failed),) if failed else '')
+    except Exception as e:
         print 'failed host %s: %s' % (host.id, str(e))
+        for line in traceback.format_exc().split('\n'):
+            print line
+    finally:
+        if ssh:
+            ssh.close()
 
     sys.stdout.flush()
     return time.time()-start_time
@@ -128,13 +267,7 @@ if __name__ == "__main__":
                   host['stats_ssh_password'])
              for host in psinet['_PsiphonNetwork__hosts'].itervalues()]
 
-    # Remove the known_hosts file entry for each host.  Since servers are destroyed
-    # and recreated often, it is possible to have an old entry in the known_hosts file
-    # that matches a current host's ip address and port
-    for host in hosts:
-        os.system('ssh-keygen -R [%s]:%s' % (host.ip_address, host.ssh_port))
-
-    pool = multiprocessing.Pool(200)
+    pool = ThreadPool(SYNC_CONCURRENCY)
     results = pool.map(sync_log_files, hosts)
 
     print 'Sync log files elapsed time: %fs' % (time.time()-start_time,)
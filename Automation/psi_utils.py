@@ -24,6 +24,7 @@ from keyword import iskeyword
 import random
 import string
 import tempfile
+import weakref
 
 if sys.version_info >= (3, 0):
     basestring = str
@@ -139,7 +140,7 @@ def recordtype(typename, field_names, verbose=False, logs=True, **default_kwds):
 
             def get_logs(self):
                 if not %(logs)s: return None
-                return self.logs
+                return read_record_logs(self)
 
             def __len__(self):
                 return %(numfields)d
@@ -170,7 +171,7 @@ def recordtype(typename, field_names, verbose=False, logs=True, **default_kwds):
                 return hash(object)
     ''') % locals()
     # Execute the template string in a temporary namespace
-    namespace = {}
+    namespace = {'read_record_logs': read_record_logs}
     try:
         exec(template, namespace)
         if verbose: print(template)
@@ -189,6 +190,24 @@ def recordtype(typename, field_names, verbose=False, logs=True, **default_kwds):
     return cls
 
 
+# Logs which have been saved are kept out of the records, by the owner of the
+# records (see PsiphonNetwork). Owners register a reader, which returns a
+# record's saved and unsaved logs, or None for a record it doesn't own.
+_record_log_readers = weakref.WeakKeyDictionary()
+
+
+def register_record_log_reader(owner, reader):
+    _record_log_readers[owner] = reader
+
+
+def read_record_logs(record):
+    for owner, reader in list(_record_log_readers.items()):
+        logs = reader(owner, record)
+        if logs is not None:
+            return logs
+    return record.logs
+
+
 def make_recordtype_diff_log(rcd, **kwargs):
     diff = []
     rcddict = rcd.todict()